@@ -0,0 +1,109 @@
+"""Admission control for the endpoints that hash passwords.
+
+Every POST to /login, /signup and /users/profile costs a bcrypt hash. The
+hasher already caps how many run at once (see hashing.py); this stops a
+credential-stuffing burst before it gets that far, with token buckets per
+client IP and per username and endpoint:
+
+    ADMISSION_IP_BURST, ADMISSION_IP_PER_MINUTE
+    ADMISSION_USERNAME_BURST, ADMISSION_USERNAME_PER_MINUTE
+
+Each bucket holds up to `BURST` attempts and refills at `PER_MINUTE`.
+Username buckets are kept apart per endpoint, so a flood of logins for
+someone doesn't lock them out of editing their profile.
+
+Requests over the limit get a 429 with `Retry-After` straight away,
+without touching the database or the hasher. `ADMISSION_CONTROL=0` turns
+it off.
+
+Buckets are kept per process, in an LRU of at most `max_keys`, so with N
+processes a client gets up to N times the configured rate. Behind a
+proxy, `request.remote_addr` must be the client's address (ProxyFix).
+"""
+
+import math
+import os
+import time
+from collections import OrderedDict
+from functools import wraps
+from threading import Lock
+
+from flask import current_app, request
+
+
+class TokenBuckets:
+    """Token buckets by key, least recently used ones dropped first."""
+
+    def __init__(self, max_keys=10000):
+        self.max_keys = max_keys
+        self.buckets = OrderedDict()
+        self.lock = Lock()
+
+    def take(self, key, burst, per_minute):
+        """Take a token from `key`'s bucket. Returns 0 if there was one,
+        or else the seconds until there will be."""
+
+        now = time.monotonic()
+        rate = per_minute / 60
+
+        with self.lock:
+            tokens, updated = self.buckets.pop(key, (burst, now))
+            tokens = min(burst, tokens + (now - updated) * rate)
+
+            if tokens >= 1:
+                tokens -= 1
+                wait = 0
+            else:
+                wait = (1 - tokens) / rate
+
+            self.buckets[key] = (tokens, now)
+            while len(self.buckets) > self.max_keys:
+                self.buckets.popitem(last=False)
+
+        return wait
+
+    def clear(self):
+        with self.lock:
+            self.buckets.clear()
+
+
+buckets = TokenBuckets()
+
+
+def init_admission_control(app):
+    app.config.setdefault('ADMISSION_CONTROL',
+                          os.environ.get('ADMISSION_CONTROL', '1') not in ('0', 'false', ''))
+    app.config.setdefault('ADMISSION_IP_BURST', 20)
+    app.config.setdefault('ADMISSION_IP_PER_MINUTE', 20)
+    app.config.setdefault('ADMISSION_USERNAME_BURST', 5)
+    app.config.setdefault('ADMISSION_USERNAME_PER_MINUTE', 5)
+
+
+def admission_control(username=lambda: None):
+    """Rate-limit POSTs to a view by client IP, and by the username that
+    `username()` returns, if any (counted for this view only)."""
+
+    def decorator(view):
+        @wraps(view)
+        def admitted(*args, **kwargs):
+            config = current_app.config
+            if request.method == 'POST' and config['ADMISSION_CONTROL']:
+                wait = buckets.take(('ip', request.remote_addr),
+                                    config['ADMISSION_IP_BURST'],
+                                    config['ADMISSION_IP_PER_MINUTE'])
+
+                name = not wait and username()
+                if name:
+                    wait = buckets.take(('username', request.endpoint, name.lower()),
+                                        config['ADMISSION_USERNAME_BURST'],
+                                        config['ADMISSION_USERNAME_PER_MINUTE'])
+
+                if wait:
+                    return ("Too many attempts, please try again shortly.", 429,
+                            {'Retry-After': str(math.ceil(wait))})
+
+            return view(*args, **kwargs)
+
+        return admitted
+
+    return decorator
@@ -0,0 +1,277 @@
+"""Versioned JSON API, for clients that don't want rendered pages.
+
+    GET    /api/v1/timeline                    the logged-in user's home timeline
+    GET    /api/v1/users/<id>                  a profile
+    GET    /api/v1/users/<id>/messages         a user's messages
+    GET    /api/v1/users/<id>/likes            messages a user liked
+    GET    /api/v1/users/<id>/following        users a user follows
+    GET    /api/v1/users/<id>/followers        a user's followers
+    GET    /api/v1/messages/<id>               a message
+    POST   /api/v1/messages                    post {"text": ...}
+    DELETE /api/v1/messages/<id>               delete your message
+
+Lists come back as `{"data": [...], "next": cursor}`; pass `next` back as
+`?before=` (messages) or `?after=` (users) for the next page, and `limit`
+for a shorter one. `?fields=id,text` trims every item to those fields;
+fields that cost a query (a message's `likes` and `liked`, a user's
+`is_following`) are only looked up when asked for.
+
+Views call the same model methods as the HTML routes. Items are turned
+into dicts by a table of getters per type and dumped with orjson when it
+is installed, which is several times faster than the standard library.
+Sessions are shared with the site, so a logged-in browser can use the API
+too. Under ASGI, the busiest reads here are answered by async versions of
+these views instead; see asgi.py.
+"""
+
+import json
+
+from flask import Blueprint, Response, abort, g, request
+
+from models import db, User, Message, MessageArchive, MessageLikeCount, TimelineEntry
+from pagination import PAGE_SIZE, decode_cursor
+from user_cache import user_changed
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+api = Blueprint('api', __name__, url_prefix='/api/v1')
+
+
+def timestamp(value):
+    return value.isoformat() + 'Z'
+
+
+# field name -> getter, in output order; the lookups (like state, follow
+# state) come from `extras`, filled in only for requested fields
+CARD_FIELDS = {
+    'id': lambda user, extras: user.id,
+    'username': lambda user, extras: user.username,
+    'image_url': lambda user, extras: user.image_url,
+    'header_image_url': lambda user, extras: user.header_image_url,
+    'bio': lambda user, extras: user.bio,
+    'is_following': lambda user, extras: user.id in extras['following'],
+}
+
+USER_FIELDS = dict(CARD_FIELDS, **{
+    'location': lambda user, extras: user.location,
+    'messages_count': lambda user, extras: user.messages_count,
+    'following_count': lambda user, extras: user.following_count,
+    'followers_count': lambda user, extras: user.followers_count,
+    'likes_count': lambda user, extras: user.likes_count,
+})
+
+MESSAGE_FIELDS = {
+    'id': lambda msg, extras: msg.id,
+    'text': lambda msg, extras: msg.text,
+    'timestamp': lambda msg, extras: timestamp(msg.timestamp),
+    'user': lambda msg, extras: {
+        'id': msg.user.id,
+        'username': msg.user.username,
+        'image_url': msg.user.image_url,
+    },
+    'likes': lambda msg, extras: extras['like_counts'].get(msg.id, 0),
+    'liked': lambda msg, extras: msg.id in extras['liked'],
+}
+
+
+def choose_fields(fields, names):
+    """The `fields` named in the comma-separated `names`, or all of them if
+    there are none; ValueError on unknown names."""
+
+    if not names:
+        return fields
+
+    names = [name.strip() for name in names.split(',') if name.strip()]
+    unknown = [name for name in names if name not in fields]
+    if unknown:
+        raise ValueError(f"unknown fields: {', '.join(unknown)}")
+
+    return {name: fields[name] for name in names}
+
+
+def selected(fields):
+    """The fields named in `?fields=`, or all of `fields`; 400 on unknown
+    names."""
+
+    try:
+        return choose_fields(fields, request.args.get('fields'))
+    except ValueError as e:
+        abort(400, str(e))
+
+
+def serialize(items, fields, extras):
+    return [{name: get(item, extras) for name, get in fields.items()}
+            for item in items]
+
+
+def message_extras(fields, messages):
+    """Like counts and the viewer's likes, if any field needs them."""
+
+    extras = {'liked': set(), 'like_counts': {}}
+    if 'likes' in fields or 'liked' in fields:
+        ids = [msg.id for msg in messages]
+        if g.user:
+            extras['liked'], extras['like_counts'] = MessageLikeCount.for_viewer(g.user.id, ids)
+        else:
+            extras['like_counts'] = MessageLikeCount.totals(ids)
+    return extras
+
+
+def user_extras(fields, users):
+    extras = {'following': set()}
+    if 'is_following' in fields and g.user:
+        g.follow_state.resolve(users)
+        extras['following'] = g.follow_state.following
+    return extras
+
+
+def dumps(body):
+    if orjson:
+        return orjson.dumps(body)
+    return json.dumps(body, separators=(',', ':')).encode()
+
+
+def respond(body, status=200):
+    return Response(dumps(body), status=status, mimetype='application/json')
+
+
+def page_limit():
+    return max(1, min(request.args.get('limit', PAGE_SIZE, type=int), PAGE_SIZE))
+
+
+def message_page(page):
+    fields = selected(MESSAGE_FIELDS)
+    return respond({
+        'data': serialize(page.items, fields, message_extras(fields, page.items)),
+        'next': page.next_cursor,
+    })
+
+
+def user_page(page):
+    fields = selected(CARD_FIELDS)
+    return respond({
+        'data': serialize(page.items, fields, user_extras(fields, page.items)),
+        'next': page.next_cursor,
+    })
+
+
+def login_required():
+    if not g.user:
+        abort(401)
+
+
+@api.errorhandler(400)
+@api.errorhandler(401)
+@api.errorhandler(403)
+@api.errorhandler(404)
+def error(e):
+    return respond({'error': e.description}, e.code)
+
+
+##############################################################################
+# Reads
+
+@api.route('/timeline')
+def timeline():
+    login_required()
+
+    page = TimelineEntry.home_timeline(g.user, before=decode_cursor(request.args.get('before')),
+                                       limit=page_limit())
+    return message_page(page)
+
+
+@api.route('/users/<int:user_id>')
+def profile(user_id):
+    fields = selected(USER_FIELDS)
+    user = User.visible_or_404(user_id)
+
+    return respond(serialize([user], fields, user_extras(fields, [user]))[0])
+
+
+@api.route('/users/<int:user_id>/messages')
+def user_messages(user_id):
+    User.visible_or_404(user_id)
+    page = Message.for_user(user_id, before=decode_cursor(request.args.get('before')),
+                            limit=page_limit())
+    return message_page(page)
+
+
+@api.route('/users/<int:user_id>/likes')
+def user_likes(user_id):
+    login_required()
+    User.visible_or_404(user_id)
+
+    page = Message.liked_by(user_id, before=decode_cursor(request.args.get('before')),
+                            limit=page_limit())
+    return message_page(page)
+
+
+@api.route('/users/<int:user_id>/following')
+def user_following(user_id):
+    login_required()
+
+    return user_page(User.following_of(user_id, after=request.args.get('after', type=int),
+                                       limit=page_limit()))
+
+
+@api.route('/users/<int:user_id>/followers')
+def user_followers(user_id):
+    login_required()
+
+    return user_page(User.followers_of(user_id, after=request.args.get('after', type=int),
+                                       limit=page_limit()))
+
+
+@api.route('/messages/<int:message_id>')
+def message(message_id):
+    fields = selected(MESSAGE_FIELDS)
+    msg = (Message.with_author().filter(Message.id == message_id).first()
+           or MessageArchive.get(message_id))
+    if msg is None:
+        abort(404)
+
+    return respond(serialize([msg], fields, message_extras(fields, [msg]))[0])
+
+
+##############################################################################
+# Writes
+
+@api.route('/messages', methods=['POST'])
+def create_message():
+    login_required()
+
+    body = request.get_json(silent=True)
+    text = body.get('text') if isinstance(body, dict) else None
+    if not isinstance(text, str) or not text.strip():
+        abort(400, 'text is required')
+    if len(text) > 140:
+        abort(400, 'text must be at most 140 characters')
+    # before the write, so a bad request posts nothing
+    fields = selected(MESSAGE_FIELDS)
+
+    msg = Message(text=text)
+    g.user.messages.append(msg)
+    db.session.flush()
+    TimelineEntry.publish(msg)
+    db.session.commit()
+    user_changed()
+
+    return respond(serialize([msg], fields, message_extras(fields, [msg]))[0], 201)
+
+
+@api.route('/messages/<int:message_id>', methods=['DELETE'])
+def delete_message(message_id):
+    login_required()
+
+    msg = Message.query.get_or_404(message_id)
+    if msg.user_id != g.user.id:
+        abort(403)
+
+    db.session.delete(msg)
+    db.session.commit()
+    user_changed()
+
+    return Response(status=204)
@@ -1,13 +1,24 @@
 import os 
 # The OS module in Python provides functions for interacting with the operating system. OS comes under Python’s standard utility modules. 
+from datetime import datetime
 
-from flask import Flask, render_template, request, flash, redirect, session, g
+from flask import Flask, render_template, request, flash, redirect, session, g, abort, jsonify, url_for
 # need to import "g" https://flask.palletsprojects.com/en/1.1.x/api/#flask.g
 from flask_debugtoolbar import DebugToolbarExtension
 from sqlalchemy.exc import IntegrityError
 
 from forms import UserAddForm, LoginForm, MessageForm, UserUpdateForm
-from models import db, connect_db, User, Message, Follows, Likes
+from admission import admission_control, init_admission_control
+from api import api
+from hashing import HasherBusy
+from models import db, connect_db, hasher, User, Message, Follows, Likes, MessageLikeCount, MessageArchive, TimelineEntry, FollowState, Job, SEARCH_PAGE_SIZE
+from http_cache import init_http_cache, conditional, cache_policy
+from instrumentation import init_instrumentation
+from pagination import decode_cursor
+from pooling import engine_options, init_prepared_statements, pool_stats
+from replicas import init_replicas, pin_to_primary, replica_binds
+from user_cache import CurrentUserCache, CURR_USER_VERSION_KEY, new_version, user_changed
+from fragment_cache import FragmentCache
 
 CURR_USER_KEY = "curr_user"
 
@@ -18,13 +29,43 @@ app = Flask(__name__)
 app.config['SQLALCHEMY_DATABASE_URI'] = (
     os.environ.get('DATABASE_URL', 'postgresql:///warbler'))
 
+# comma-separated URLs of read replicas for GET requests; see replicas.py
+replica_urls = [url for url in os.environ.get('DATABASE_REPLICA_URLS', '').split(',') if url]
+app.config['SQLALCHEMY_BINDS'] = replica_binds(replica_urls)
+app.config['READ_REPLICAS'] = list(app.config['SQLALCHEMY_BINDS'])
+
+# pool size, overflow, recycle, ... from DB_POOL_* variables; see pooling.py
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(os.environ)
+# "pgbouncer" when connecting through PgBouncer in transaction mode
+app.config['DB_POOL_MODE'] = os.environ.get('DB_POOL_MODE', 'session')
+
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['SQLALCHEMY_ECHO'] = False
 app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', "it's a secret")
+# statements slower than this are logged with their EXPLAIN plan
+app.config['SLOW_QUERY_MS'] = int(os.environ.get('SLOW_QUERY_MS', 250))
 # toolbar = DebugToolbarExtension(app)
 
 connect_db(app)
+# bcrypt cost and worker pool size (BCRYPT_LOG_ROUNDS, HASH_WORKERS)
+hasher.init_app(app)
+# per-IP and per-username limits on the routes that hash; see admission.py
+init_admission_control(app)
+# the logged-in user, without a query per request; see user_cache.py
+user_cache = CurrentUserCache(User)
+user_cache.init_app(app)
+# Cache-Control for pages served with ETags; see http_cache.py
+init_http_cache(app)
+# rendered message rows and user cards; see fragment_cache.py
+fragment_cache = FragmentCache()
+fragment_cache.init_app(app)
+# queries marked prepare=True run as server-side prepared statements
+init_prepared_statements(app)
+# before any other before_request hook, so their queries are counted too
+init_instrumentation(app, db.Model)
+# before add_user_to_g, which already reads from the chosen database
+init_replicas(app)
 
 
 ##############################################################################
@@ -36,17 +77,32 @@ def add_user_to_g():
     """If we're logged in, add curr user to Flask global."""
 
     if CURR_USER_KEY in session:
-        g.user = User.query.get(session[CURR_USER_KEY])
+        user_id = session[CURR_USER_KEY]
+        version = session.get(CURR_USER_VERSION_KEY)
+
+        g.user = version and user_cache.get(db.session, user_id, version)
+        if not g.user:
+            g.user = User.query.execution_options(prepare=True).get(user_id)
+            if g.user and version:
+                user_cache.put(g.user, version)
+        # a session on another device, after the account was deleted
+        if g.user and g.user.deleted_at:
+            g.user = None
         # g is an object for storing data during the application context of a running Flask web app. By adding the user to g, we can use user info anywhere.
 
     else:
         g.user = None
 
+    # follow buttons ask this rather than g.user.is_following, so a page of
+    # user cards costs one query
+    g.follow_state = FollowState(g.user) if g.user else None
+
 
 def do_login(user):
     """Log in user."""
     # user is put in session
     session[CURR_USER_KEY] = user.id
+    session[CURR_USER_VERSION_KEY] = new_version()
 
 
 def do_logout():
@@ -55,8 +111,11 @@ def do_logout():
     if CURR_USER_KEY in session:
         del session[CURR_USER_KEY]
 
+    session.pop(CURR_USER_VERSION_KEY, None)
+
 
 @app.route('/signup', methods=["GET", "POST"])
+@admission_control(username=lambda: request.form.get('username'))
 def signup():
     """Handle user signup.
 
@@ -88,6 +147,8 @@ def signup():
             return render_template('users/signup.html', form=form)
 
         do_login(user)
+        # the new account is only on the primary until the replicas catch up
+        pin_to_primary()
 
         return redirect("/")
 
@@ -96,6 +157,7 @@ def signup():
 
 
 @app.route('/login', methods=["GET", "POST"])
+@admission_control(username=lambda: request.form.get('username'))
 def login():
     """Handle user login."""
 
@@ -106,7 +168,12 @@ def login():
                                  form.password.data)
 
         if user:
+            # saves the new hash if authenticate upgraded it
+            rehashed = db.session.is_modified(user)
+            db.session.commit()
             do_login(user)
+            if rehashed:
+                pin_to_primary()
             flash(f"Hello, {user.username}!", "success")
             return redirect("/")
 
@@ -133,37 +200,79 @@ def logout():
 def list_users():
     """Page with listing of users.
 
-    Can take a 'q' param in querystring to search by that username.
+    Can take a 'q' param in querystring to search by username, bio and
+    location (see User.search), and a 'page' param for more results.
+    Without 'q', lists everyone a page at a time, after the 'after' id.
     """
 
     search = request.args.get('q')
+    next_url = None
 
     if not search:
-        users = User.query.all()
+        page = User.directory(after=request.args.get('after', type=int))
+        users = page.items
+        if page.next_cursor:
+            next_url = url_for('list_users', after=page.next_cursor)
     else:
-        users = User.query.filter(User.username.like(f"%{search}%")).all()
+        page = max(request.args.get('page', 1, type=int), 1)
+        users = User.search(search, page=page)
+        if len(users) == SEARCH_PAGE_SIZE:
+            next_url = url_for('list_users', q=search, page=page + 1)
+
+    if g.user:
+        g.follow_state.resolve(users)
+
+    return render_template('users/index.html', users=users, next_url=next_url)
+
+
+@app.route('/users/autocomplete')
+def autocomplete_users():
+    """Usernames starting with 'q', as JSON, for the search box."""
+
+    users = User.autocomplete(request.args.get('q', ''))
+
+    return jsonify([
+        {'id': id, 'username': username, 'image_url': image_url}
+        for id, username, image_url in users
+    ])
 
-    return render_template('users/index.html', users=users)
+
+def profile_version(user_id):
+    """The profile changes with the user's row (its messages_count too)."""
+
+    count, updated_at = User.version(user_id)
+    return count and ((updated_at,), updated_at)
 
 
 @app.route('/users/<int:user_id>')
+@conditional(profile_version)
 def users_show(user_id):
     """Show user profile."""
 
-    user = User.query.get_or_404(user_id)
+    user = User.visible_or_404(user_id)
 
     # snagging messages in order from the database;
     # user.messages won't be in order by default
-    messages = (Message
-                .query
-                .filter(Message.user_id == user_id)
-                .order_by(Message.timestamp.desc())
-                .limit(100)
-                .all())
-    return render_template('users/show.html', user=user, messages=messages)
+    page = Message.for_user(user_id, before=decode_cursor(request.args.get('before')))
+    return render_template('users/show.html', user=user, messages=page.items,
+                           next_cursor=page.next_cursor, feed='user')
+
+
+def following_version(user_id):
+    """The list changes with the user and everyone on it."""
+
+    if not g.user:
+        return None
+
+    count, updated_at = User.version(
+        user_id,
+        db.session.query(Follows.user_being_followed_id)
+        .filter(Follows.user_following_id == user_id))
+    return count and ((count, updated_at), updated_at)
 
 
 @app.route('/users/<int:user_id>/following')
+@conditional(following_version)
 def show_following(user_id):
     """Show list of people this user is following."""
 
@@ -171,11 +280,26 @@ def show_following(user_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    user = User.query.get_or_404(user_id)
-    return render_template('users/following.html', user=user)
+    user = User.visible_or_404(user_id)
+
+    users = [other for other in user.following if not other.deleted_at]
+    g.follow_state.resolve(users + [user])
+    return render_template('users/following.html', user=user, users=users)
+
+
+def followers_version(user_id):
+    if not g.user:
+        return None
+
+    count, updated_at = User.version(
+        user_id,
+        db.session.query(Follows.user_following_id)
+        .filter(Follows.user_being_followed_id == user_id))
+    return count and ((count, updated_at), updated_at)
 
 
 @app.route('/users/<int:user_id>/followers')
+@conditional(followers_version)
 def users_followers(user_id):
     """Show list of followers of this user."""
 
@@ -183,8 +307,11 @@ def users_followers(user_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    user = User.query.get_or_404(user_id)
-    return render_template('users/followers.html', user=user)
+    user = User.visible_or_404(user_id)
+
+    users = [other for other in user.followers if not other.deleted_at]
+    g.follow_state.resolve(users + [user])
+    return render_template('users/followers.html', user=user, users=users)
 
 
 @app.route('/users/follow/<int:follow_id>', methods=['POST'])
@@ -195,9 +322,16 @@ def add_follow(follow_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
+    if follow_id == g.user.id:
+        flash("You can't follow yourself.", "danger")
+        return redirect(f"/users/{g.user.id}")
+
     followed_user = User.query.get_or_404(follow_id)
     g.user.following.append(followed_user)
+    db.session.flush()
+    TimelineEntry.backfill(g.user.id, followed_user.id)
     db.session.commit()
+    user_changed(followed_user.id)
 
     return redirect(f"/users/{g.user.id}/following")
 
@@ -212,12 +346,15 @@ def stop_following(follow_id):
 
     followed_user = User.query.get(follow_id)
     g.user.following.remove(followed_user)
+    TimelineEntry.remove_author(g.user.id, followed_user.id)
     db.session.commit()
+    user_changed(followed_user.id)
 
     return redirect(f"/users/{g.user.id}/following")
 
 
 @app.route('/users/profile', methods=["GET", "POST"])
+@admission_control(username=lambda: g.user and g.user.username)
 def profile():
     """Update profile for current user."""
 
@@ -240,6 +377,7 @@ def profile():
             
             db.session.add(g.user)
             db.session.commit()
+            user_changed()
 
             flash(f"User Profile Updated!", "success")
             return redirect(f'/users/{g.user.id}')
@@ -263,8 +401,13 @@ def delete_user():
         return redirect("/")
 
     do_logout()
+    user_cache.invalidate(g.user.id)
 
-    db.session.delete(g.user)
+    # deleting everything they ever posted, liked and followed can take a
+    # while, so a job does it in batches (see User.purge); until then the
+    # account just can't be seen or logged into
+    g.user.deleted_at = datetime.utcnow()
+    Job.enqueue('purge_user', key=f'purge_user:{g.user.id}', user_id=g.user.id)
     db.session.commit()
 
     return redirect("/signup")
@@ -277,31 +420,85 @@ def toggle_likes(msg_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
     
-    clicked_msg = Message.query.get(msg_id)
-    likes = [msg.id for msg in g.user.likes]
-    
-    if( msg_id in likes ):
-        g.user.likes.remove(clicked_msg)
-    else:
-        g.user.likes.append(clicked_msg)
-    
-    # db.session.add(g.user)   
-    db.session.commit()
+    try:
+        Likes.toggle(g.user.id, msg_id)
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        abort(404)
+    user_changed()
 
     return redirect('/')
 
+
+@app.route('/messages/<int:message_id>/like', methods=['POST'])
+def messages_like(message_id):
+    """Like or unlike a message, for the like buttons' JavaScript.
+
+    Returns JSON with the new state and the message's like count, so the
+    page can update in place instead of reloading the timeline.
+    """
+
+    if not g.user:
+        return jsonify(error="Access unauthorized."), 401
+
+    try:
+        liked = Likes.toggle(g.user.id, message_id)
+        count = MessageLikeCount.totals([message_id]).get(message_id, 0)
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        abort(404)
+    user_changed()
+
+    return jsonify(message_id=message_id, liked=liked, likes=count)
+
+def likes_version(user_id):
+    """The page shown: which messages it lists (liking or unliking also
+    moves the user's likes_count), their authors' names and pictures, and
+    their like counts, which anyone's like changes. Looked up for that one
+    page, however many likes the user has.
+
+    Like counts have no timestamp, so the page goes without Last-Modified.
+    """
+
+    if not g.user:
+        return None
+
+    liked = Message.liked_keys(user_id, decode_cursor(request.args.get('before')))
+    message_ids = [message_id for (message_id,) in db.session.query(liked.c.message_id)]
+
+    count, updated_at = User.version(user_id, db.session.query(liked.c.author_id))
+    like_counts = sorted(MessageLikeCount.totals(message_ids).items())
+    return count and ((count, updated_at, like_counts), None)
+
+
+def like_state(messages):
+    """Template variables for the like buttons on a page of `messages`.
+
+    `likes` is the set of them the viewer likes and `like_counts` maps ids to
+    like counts: one query, however many likes anyone has.
+    """
+
+    likes, like_counts = MessageLikeCount.for_viewer(
+        g.user.id, [msg.id for msg in messages])
+    return {'likes': likes, 'like_counts': like_counts}
+
+
 @app.route('/users/<int:user_id>/likes')
+@conditional(likes_version)
 def show_liked_message(user_id):
 
     if not g.user:
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    user = User.query.get_or_404(user_id)
-    liked_messages = user.likes
-    likes = [msg.id for msg in g.user.likes]
+    user = User.visible_or_404(user_id)
+    page = Message.liked_by(user_id, before=decode_cursor(request.args.get('before')))
     
-    return render_template('users/likes.html', user=user, messages=liked_messages, likes=likes)
+    return render_template('users/likes.html', user=user, messages=page.items,
+                           next_cursor=page.next_cursor, feed='likes',
+                           **like_state(page.items))
 
 ########################################################################    ######
 # Messages routes:
@@ -322,19 +519,79 @@ def messages_add():
     if form.validate_on_submit():
         msg = Message(text=form.text.data)
         g.user.messages.append(msg)
+        db.session.flush()
+        TimelineEntry.publish(msg)
         db.session.commit()
+        user_changed()
 
         return redirect(f"/users/{g.user.id}")
 
     return render_template('messages/new.html', form=form)
 
 
+@app.route('/messages/older')
+def messages_older():
+    """Load older: render just the next page of a feed.
+
+    Takes `feed` (home, user or likes), `user_id` for user and likes feeds,
+    and the `before` cursor from the previous page. Returns only the
+    message list items, for the page to append.
+    """
+
+    feed = request.args.get('feed', 'home')
+    user_id = request.args.get('user_id', type=int)
+    before = decode_cursor(request.args.get('before'))
+    with_likes = True
+
+    if feed == 'user':
+        user = User.visible_or_404(user_id)
+        page = Message.for_user(user.id, before=before)
+        with_likes = False
+
+    elif not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    elif feed == 'home':
+        user = g.user
+        page = TimelineEntry.home_timeline(g.user, before=before)
+
+    elif feed == 'likes':
+        user = User.visible_or_404(user_id)
+        page = Message.liked_by(user.id, before=before)
+
+    else:
+        abort(404)
+
+    return render_template('messages/_items.html', user=user, messages=page.items,
+                           next_cursor=page.next_cursor, feed=feed,
+                           **(like_state(page.items) if with_likes else {}))
+
+
+def message_version(message_id):
+    """Messages never change, but their author's name and picture can."""
+
+    row = (db.session
+           .query(Message.timestamp, User.updated_at)
+           .join(User, User.id == Message.user_id)
+           .filter(Message.id == message_id)
+           .first())
+    return row and ((row.updated_at,), max(row))
+
+
 @app.route('/messages/<int:message_id>', methods=["GET"])
+@conditional(message_version)
 def messages_show(message_id):
     """Show a message."""
 
-    msg = Message.query.get(message_id)
-    return render_template('messages/show.html', message=msg)
+    msg = Message.with_author().filter(Message.id == message_id).first()
+    archived = msg is None
+    if archived:
+        msg = MessageArchive.get(message_id)
+        if msg is None:
+            abort(404)
+
+    return render_template('messages/show.html', message=msg, archived=archived)
 
 
 @app.route('/messages/<int:message_id>/delete', methods=["POST"])
@@ -345,13 +602,15 @@ def messages_destroy(message_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    msg = Message.query.get(message_id)
+    msg = Message.query.get_or_404(message_id)
     if msg.user_id != g.user.id:
             flash("Access unauthorized.", "danger")
             return redirect("/")
     
+    # ondelete cascade also drops it from every timeline it was fanned out to
     db.session.delete(msg)
     db.session.commit()
+    user_changed()
 
     return redirect(f"/users/{g.user.id}")
 
@@ -365,27 +624,32 @@ def homepage():
     """Show homepage:
 
     - anon users: no messages
-    - logged in: 100 most recent messages of followed_users
+    - logged in: 100 most recent messages of followed_users, with a
+      `before` cursor for older pages
+
+    Messages come from the user's materialized timeline (see TimelineEntry),
+    which is kept up to date when messages are posted and follows change.
     """
 
     if g.user:
-        # I tried to use User.following but this will not pull out the information for currently logged in user, but will pull all id in following table
-        following_users= [u.id for u in g.user.following] + [g.user.id]
-        messages = (Message
-                    .query
-                    .order_by(Message.timestamp.desc())
-                    .filter(Message.user_id.in_(following_users))
-                    .limit(100))
-                    # Message.user_id (Message is necessary due to filter())
-        likes = [msg.id for msg in g.user.likes]
-
-        return render_template('home.html', messages=messages, likes=likes)
+        page = TimelineEntry.home_timeline(g.user, before=decode_cursor(request.args.get('before')))
+
+        return render_template('home.html', messages=page.items,
+                               next_cursor=page.next_cursor, feed='home',
+                               **like_state(page.items))
 
     else:
         return render_template('home-anon.html')
 
 
 
+@app.errorhandler(HasherBusy)
+def hasher_busy(e):
+    """Too many passwords being hashed at once: ask the client to retry."""
+
+    return "Too many sign-ins right now, please try again shortly.", 429, {'Retry-After': '1'}
+
+
 ############################
 # how to show error 404 html
 #############################
@@ -396,6 +660,25 @@ def homepage():
 
 #     return render_template('404.html'), 404
 
+##############################################################################
+# Operations
+
+@app.route('/internal/pool-stats')
+def show_pool_stats():
+    """Connection pool stats for each database, for local monitoring only."""
+
+    if request.remote_addr not in ('127.0.0.1', '::1'):
+        abort(404)
+
+    return jsonify(pool_stats(db, app))
+
+
+##############################################################################
+# JSON API: see api.py
+
+app.register_blueprint(api)
+
+
 ##############################################################################
 # Turn off all caching in Flask
 #   (useful for dev; in production, this kind of stuff is typically
@@ -405,7 +688,16 @@ def homepage():
 
 @app.after_request
 def add_header(req):
-    """Add non-caching headers on every request."""
+    """Add non-caching headers on every request.
+
+    Pages with a policy in `CACHE_POLICIES` get that instead; they carry
+    ETags, so clients can revalidate them cheaply.
+    """
+
+    policy = cache_policy()
+    if policy:
+        req.headers['Cache-Control'] = policy
+        return req
 
     req.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
     req.headers["Pragma"] = "no-cache"
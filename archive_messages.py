@@ -0,0 +1,46 @@
+"""Move old messages out of `messages` into the compressed archive.
+
+Keeps the `messages` table (and its indexes) down to recent history; see
+`MessageArchive`. Run it from cron, e.g. nightly:
+
+    python archive_messages.py --days 365
+"""
+
+import argparse
+from datetime import datetime, timedelta
+
+from app import db
+from models import MessageArchive
+
+
+def archive_all(before):
+    """Archive everyone's messages older than `before`, ARCHIVE_BATCH_SIZE
+    at a time. Returns how many messages were moved."""
+
+    moved = 0
+    after = None
+
+    while True:
+        # each batch is its own short transaction
+        count, after = MessageArchive.archive(before, after)
+        db.session.commit()
+
+        if not count:
+            break
+        moved += count
+
+    return moved
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--days', type=int, default=365,
+                        help='archive messages older than this many days (default 365)')
+    args = parser.parse_args()
+
+    before = datetime.utcnow() - timedelta(days=args.days)
+    print(f'archived {archive_all(before)} messages older than {before:%Y-%m-%d}')
+
+
+if __name__ == '__main__':
+    main()
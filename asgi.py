@@ -0,0 +1,526 @@
+"""ASGI entry point: the busiest JSON reads on an event loop, Flask for the
+rest.
+
+    uvicorn asgi:application --workers 4
+
+Under WSGI a request holds a worker thread for as long as it runs,
+including every wait on the database, so a process serves as many
+requests at once as it has threads. Here these reads are answered by async
+views with asyncpg, and a process keeps many of them in flight:
+
+    GET /api/v1/timeline
+    GET /api/v1/users/<id>
+    GET /api/v1/users/<id>/messages
+    GET /api/v1/messages/<id>
+
+They return the same JSON as the views in api.py, including `?fields=`,
+cursors and the lookups that only run for the fields asked for. Every
+other request (the HTML pages, forms, writes and the rest of the API) goes
+to the Flask app unchanged, on a pool of `ASGI_THREADS` threads. So do
+archived messages, which only the models can read: a page of a user's
+messages that runs into the archive, or a message that isn't in
+`messages`.
+
+The async views use a pool of up to `ASYNC_DB_POOL_SIZE` connections to
+the primary, and one to each read replica, chosen and pinned as in
+replicas.py. Both sizes default to `DB_POOL_SIZE + DB_MAX_OVERFLOW`, the
+most connections the Flask side may open, so serving a process this way
+costs no more connections or threads than serving it under WSGI. The
+logged-in user comes from the site's session cookie.
+"""
+
+import asyncio
+import io
+import os
+import random
+import re
+import sys
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+import asyncpg
+from itsdangerous import BadSignature
+from sqlalchemy.engine.url import make_url
+from werkzeug.exceptions import NotFound, Unauthorized
+from werkzeug.http import parse_cookie
+from werkzeug.urls import url_decode
+
+from api import USER_FIELDS, MESSAGE_FIELDS, choose_fields, dumps, serialize
+from app import app, CURR_USER_KEY
+from pagination import PAGE_SIZE, decode_cursor, make_page
+from replicas import PIN_KEY
+
+# the columns the API's getters read, in the order the queries select them
+Author = namedtuple('Author', ['id', 'username', 'image_url'])
+MessageRow = namedtuple('MessageRow', ['id', 'text', 'timestamp', 'user'])
+UserRow = namedtuple('UserRow', ['id', 'username', 'image_url', 'header_image_url', 'bio',
+                                 'location', 'messages_count', 'following_count',
+                                 'followers_count', 'likes_count'])
+
+USER_SELECT = (f"SELECT {', '.join(UserRow._fields)} FROM users "
+               "WHERE id = $1 AND deleted_at IS NULL")
+
+# messages by deleted accounts are left out, as Message.with_author does
+MESSAGE_SELECT = """
+    SELECT messages.id, messages.text, messages.timestamp,
+           users.id, users.username, users.image_url
+    FROM messages JOIN users ON users.id = messages.user_id
+    WHERE users.deleted_at IS NULL
+"""
+
+STORED_TIMELINE = """
+    SELECT messages.id, messages.text, messages.timestamp,
+           users.id, users.username, users.image_url
+    FROM timelines
+    JOIN messages ON messages.id = timelines.message_id
+    JOIN users ON users.id = messages.user_id
+    WHERE timelines.user_id = $1 AND users.deleted_at IS NULL
+"""
+
+FOLLOWED_BIG_AUTHORS = """
+    SELECT user_being_followed_id FROM follows
+    WHERE user_following_id = $1
+      AND user_being_followed_id IN (SELECT id FROM users WHERE fanout_on_read)
+"""
+
+FOLLOWED = """
+    SELECT user_being_followed_id, users.fanout_on_read FROM follows
+    JOIN users ON users.id = follows.user_being_followed_id
+    WHERE user_following_id = $1 AND users.deleted_at IS NULL
+"""
+
+LIKE_TOTALS = """
+    SELECT message_id, sum(count) FROM message_like_counts
+    WHERE message_id = ANY($1::integer[])
+    GROUP BY message_id
+"""
+
+LIKES_FOR_VIEWER = """
+    SELECT message_id, sum(count), bool_or(liked) FROM (
+        SELECT message_id, count, false AS liked FROM message_like_counts
+        WHERE message_id = ANY($2::integer[])
+        UNION ALL
+        SELECT message_id, 0, true FROM likes
+        WHERE user_id = $1 AND message_id = ANY($2::integer[])
+    ) AS rows
+    GROUP BY message_id
+"""
+
+FOLLOWING_AMONG = """
+    SELECT user_being_followed_id FROM follows
+    WHERE user_following_id = $1 AND user_being_followed_id = ANY($2::integer[])
+"""
+
+VIEWER = "SELECT id FROM users WHERE id = $1 AND deleted_at IS NULL"
+
+
+def paginate(sql, args, timestamp_col, id_col, before=None, limit=PAGE_SIZE):
+    """`sql` (which ends in a WHERE clause) limited to one page of rows
+    older than `before`, as pagination.paginate does for queries."""
+
+    args = list(args)
+    if before:
+        sql += f" AND ({timestamp_col}, {id_col}) < (${len(args) + 1}, ${len(args) + 2})"
+        args += before
+    sql += f" ORDER BY {timestamp_col} DESC, {id_col} DESC LIMIT ${len(args) + 1}"
+    return sql, args + [limit]
+
+
+def by_authors(author_ids, before, limit):
+    """A page of each author's messages, UNION ALLed and merged into one
+    page, as TimelineEntry.home_timeline reads past the stored timeline."""
+
+    args = [limit] + list(before or ())
+    keyset = " AND (timestamp, id) < ($2, $3)" if before else ""
+    branches = [f"(SELECT * FROM messages WHERE user_id = ${len(args) + i}{keyset}"
+                f" ORDER BY timestamp DESC, id DESC LIMIT $1)"
+                for i in range(1, len(author_ids) + 1)]
+
+    sql = f"""
+        SELECT messages.id, messages.text, messages.timestamp,
+               users.id, users.username, users.image_url
+        FROM ({' UNION ALL '.join(branches)}) AS messages
+        JOIN users ON users.id = messages.user_id
+        WHERE users.deleted_at IS NULL
+        ORDER BY messages.timestamp DESC, messages.id DESC LIMIT $1
+    """
+    return sql, args + list(author_ids)
+
+
+def message_row(record):
+    return MessageRow(*record[:3], Author(*record[3:]))
+
+
+class HTTPError(Exception):
+    def __init__(self, code, description):
+        self.code = code
+        self.description = description
+
+
+class Request:
+    """What the async views need from an ASGI request."""
+
+    def __init__(self, scope, session, conn):
+        self.args = url_decode(scope['query_string'])
+        self.session = session
+        self.conn = conn
+        self.viewer_id = None
+
+    async def viewer(self):
+        """The logged-in user's id, or None; like g.user, None for a
+        deleted account."""
+
+        user_id = self.session.get(CURR_USER_KEY)
+        if user_id and self.viewer_id is None:
+            self.viewer_id = await self.conn.fetchval(VIEWER, user_id) or 0
+        return self.viewer_id or None
+
+    async def login_required(self):
+        if not await self.viewer():
+            raise HTTPError(401, Unauthorized.description)
+
+    def selected(self, fields):
+        try:
+            return choose_fields(fields, self.args.get('fields'))
+        except ValueError as e:
+            raise HTTPError(400, str(e))
+
+    def page_limit(self):
+        return max(1, min(self.args.get('limit', PAGE_SIZE, type=int), PAGE_SIZE))
+
+    def before(self):
+        return decode_cursor(self.args.get('before'))
+
+
+def read_session(scope):
+    """The Flask session in the request's cookie, as open_session reads it."""
+
+    cookies = parse_cookie(b'; '.join(value for name, value in scope['headers']
+                                      if name == b'cookie').decode('latin-1'))
+    value = cookies.get(app.session_cookie_name)
+    if not value:
+        return {}
+
+    serializer = app.session_interface.get_signing_serializer(app)
+    try:
+        return serializer.loads(value, max_age=int(app.permanent_session_lifetime.total_seconds()))
+    except BadSignature:
+        return {}
+
+
+async def message_extras(request, fields, messages):
+    extras = {'liked': set(), 'like_counts': {}}
+    if 'likes' in fields or 'liked' in fields:
+        ids = [msg.id for msg in messages]
+        viewer = await request.viewer()
+        if viewer:
+            for message_id, total, liked in await request.conn.fetch(LIKES_FOR_VIEWER,
+                                                                     viewer, ids):
+                if liked:
+                    extras['liked'].add(message_id)
+                if total:
+                    extras['like_counts'][message_id] = total
+        else:
+            extras['like_counts'] = dict(await request.conn.fetch(LIKE_TOTALS, ids))
+    return extras
+
+
+async def user_extras(request, fields, users):
+    extras = {'following': set()}
+    if 'is_following' in fields:
+        viewer = await request.viewer()
+        if viewer:
+            extras['following'] = {id for (id,) in await request.conn.fetch(
+                FOLLOWING_AMONG, viewer, [user.id for user in users])}
+    return extras
+
+
+async def message_page(request, page):
+    fields = request.selected(MESSAGE_FIELDS)
+    extras = await message_extras(request, fields, page.items)
+    return {'data': serialize(page.items, fields, extras), 'next': page.next_cursor}
+
+
+##############################################################################
+# Views: each returns the response body, or None to leave the request to
+# Flask
+
+async def timeline(request):
+    """TimelineEntry.home_timeline, query for query."""
+
+    await request.login_required()
+    user_id = await request.viewer()
+    before, limit = request.before(), request.page_limit()
+    conn = request.conn
+
+    sql, args = paginate(STORED_TIMELINE, [user_id], 'timelines.timestamp',
+                         'timelines.message_id', before, limit)
+    messages = [message_row(record) for record in await conn.fetch(sql, *args)]
+
+    if len(messages) < limit:
+        authors = await conn.fetch(FOLLOWED, user_id)
+        followed_big_authors = [(id,) for id, big in authors if big]
+    else:
+        followed_big_authors = await conn.fetch(FOLLOWED_BIG_AUTHORS, user_id)
+
+    pulled = []
+    for (author_id,) in followed_big_authors:
+        sql, args = paginate(MESSAGE_SELECT + " AND messages.user_id = $1", [author_id],
+                             'messages.timestamp', 'messages.id', before, limit)
+        pulled += [message_row(record) for record in await conn.fetch(sql, *args)]
+
+    if pulled:
+        merged = {msg.id: msg for msg in messages + pulled}
+        messages = sorted(merged.values(), key=lambda msg: (msg.timestamp, msg.id),
+                          reverse=True)[:limit]
+
+    if len(messages) < limit:
+        if messages:
+            before = (messages[-1].timestamp, messages[-1].id)
+        sql, args = by_authors([user_id] + [id for id, big in authors], before,
+                               limit - len(messages))
+        messages += [message_row(record) for record in await conn.fetch(sql, *args)]
+
+    return await message_page(request, make_page(messages, limit,
+                                                  lambda msg: (msg.timestamp, msg.id)))
+
+
+async def profile(request, user_id):
+    fields = request.selected(USER_FIELDS)
+    record = await request.conn.fetchrow(USER_SELECT, user_id)
+    if record is None:
+        raise HTTPError(404, NotFound.description)
+
+    user = UserRow(*record)
+    return serialize([user], fields, await user_extras(request, fields, [user]))[0]
+
+
+async def user_messages(request, user_id):
+    before, limit = request.before(), request.page_limit()
+
+    count = await request.conn.fetchval(
+        "SELECT messages_count FROM users WHERE id = $1 AND deleted_at IS NULL", user_id)
+    if count is None:
+        raise HTTPError(404, NotFound.description)
+
+    sql, args = paginate(MESSAGE_SELECT + " AND messages.user_id = $1", [user_id],
+                         'messages.timestamp', 'messages.id', before, limit)
+    messages = [message_row(record) for record in await request.conn.fetch(sql, *args)]
+
+    # a short page may go on into the archive (see Message.for_user)
+    if len(messages) < limit:
+        if before or count > len(messages):
+            return None
+
+    return await message_page(request, make_page(messages, limit,
+                                                  lambda msg: (msg.timestamp, msg.id)))
+
+
+async def message(request, message_id):
+    fields = request.selected(MESSAGE_FIELDS)
+    record = await request.conn.fetchrow(MESSAGE_SELECT + " AND messages.id = $1",
+                                         message_id)
+    # archived, or not there at all
+    if record is None:
+        return None
+
+    msg = message_row(record)
+    return serialize([msg], fields, await message_extras(request, fields, [msg]))[0]
+
+
+ROUTES = [
+    (re.compile(r'/api/v1/timeline'), timeline),
+    (re.compile(r'/api/v1/users/(\d+)'), profile),
+    (re.compile(r'/api/v1/users/(\d+)/messages'), user_messages),
+    (re.compile(r'/api/v1/messages/(\d+)'), message),
+]
+
+
+##############################################################################
+# Running Flask for everything else
+
+def wsgi_environ(scope, body):
+    """A WSGI environ for an ASGI HTTP request and its body."""
+
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode().decode('latin-1'),
+        'PATH_INFO': scope['path'].encode().decode('latin-1'),
+        'QUERY_STRING': scope['query_string'].decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'REMOTE_ADDR': client[0],
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+
+    for name, value in scope['headers']:
+        name, value = name.decode('latin-1').upper().replace('-', '_'), value.decode('latin-1')
+        if name == 'CONTENT_LENGTH':
+            continue
+        if name != 'CONTENT_TYPE':
+            name = 'HTTP_' + name
+        environ[name] = f'{environ[name]},{value}' if name in environ else value
+
+    # the body is already read in full, even if it came chunked
+    environ['CONTENT_LENGTH'] = str(len(body))
+    return environ
+
+
+def run_wsgi(wsgi_app, environ):
+    """Run one request through `wsgi_app`; `(status, headers, body)`."""
+
+    started = []
+
+    def start_response(status, headers, exc_info=None):
+        started[:] = [int(status.split(' ', 1)[0]),
+                      [(name.lower().encode('latin-1'), value.encode('latin-1'))
+                       for name, value in headers]]
+
+    result = wsgi_app(environ, start_response)
+    try:
+        body = b''.join(result)
+    finally:
+        if hasattr(result, 'close'):
+            result.close()
+
+    return started[0], started[1], body
+
+
+##############################################################################
+# The application
+
+class Application:
+    """ASGI app: the routes above on the event loop, Flask on threads."""
+
+    def __init__(self, flask_app):
+        options = flask_app.config['SQLALCHEMY_ENGINE_OPTIONS']
+        connections = options.get('pool_size', 5) + options.get('max_overflow', 10)
+        flask_app.config.setdefault('ASGI_THREADS',
+                                    int(os.environ.get('ASGI_THREADS', connections)))
+        flask_app.config.setdefault('ASYNC_DB_POOL_SIZE',
+                                    int(os.environ.get('ASYNC_DB_POOL_SIZE', connections)))
+
+        self.flask_app = flask_app
+        self.executor = ThreadPoolExecutor(flask_app.config['ASGI_THREADS'],
+                                           thread_name_prefix='wsgi')
+        # bind name ('primary' or a replica's) -> asyncpg pool, per event loop
+        self.pools = None
+        self.pools_lock = None
+
+    async def open_pools(self):
+        config = self.flask_app.config
+        urls = {'primary': config['SQLALCHEMY_DATABASE_URI']}
+        for bind in config['READ_REPLICAS']:
+            urls[bind] = config['SQLALCHEMY_BINDS'][bind]
+
+        pools = {}
+        for bind, url in urls.items():
+            url = make_url(url)
+            url.drivername = 'postgresql'
+            pools[bind] = await asyncpg.create_pool(
+                str(url), min_size=1, max_size=config['ASYNC_DB_POOL_SIZE'],
+                # asyncpg prepares every statement; PgBouncer's transaction
+                # mode can't keep them
+                statement_cache_size=100 if config['PREPARED_STATEMENTS'] else 0)
+        self.pools = pools
+
+    async def close(self):
+        if self.pools:
+            await asyncio.gather(*(pool.close() for pool in self.pools.values()))
+        self.pools = None
+
+    async def pool(self, session):
+        if self.pools is None:
+            if self.pools_lock is None:
+                self.pools_lock = asyncio.Lock()
+            async with self.pools_lock:
+                if self.pools is None:
+                    await self.open_pools()
+
+        replicas = self.flask_app.config['READ_REPLICAS']
+        if replicas and session.get(PIN_KEY, 0) < time.time():
+            return self.pools[random.choice(replicas)]
+        return self.pools['primary']
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self.lifespan(receive, send)
+        if scope['type'] != 'http':
+            return
+
+        if scope['method'] == 'GET':
+            for pattern, view in ROUTES:
+                match = pattern.fullmatch(scope['path'])
+                if match:
+                    if await self.run_async(view, [int(arg) for arg in match.groups()],
+                                            scope, send):
+                        return
+                    break
+
+        await self.run_flask(scope, receive, send)
+
+    async def run_async(self, view, args, scope, send):
+        """Answer with `view`; False if it left the request to Flask."""
+
+        session = read_session(scope)
+        async with (await self.pool(session)).acquire() as conn:
+            request = Request(scope, session, conn)
+            try:
+                body, status = await view(request, *args), 200
+            except HTTPError as e:
+                body, status = {'error': e.description}, e.code
+
+        if body is None:
+            return False
+
+        data = dumps(body)
+        await send({'type': 'http.response.start', 'status': status,
+                    'headers': [(b'content-type', b'application/json'),
+                                (b'content-length', str(len(data)).encode())]})
+        await send({'type': 'http.response.body', 'body': data})
+        return True
+
+    async def run_flask(self, scope, receive, send):
+        body = []
+        while True:
+            message = await receive()
+            body.append(message.get('body', b''))
+            if not message.get('more_body'):
+                break
+
+        status, headers, data = await asyncio.get_running_loop().run_in_executor(
+            self.executor, run_wsgi, self.flask_app,
+            wsgi_environ(scope, b''.join(body)))
+
+        await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+        await send({'type': 'http.response.body', 'body': data})
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                try:
+                    await self.open_pools()
+                except Exception as e:
+                    await send({'type': 'lifespan.startup.failed', 'message': str(e)})
+                    return
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await self.close()
+                self.executor.shutdown()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+
+application = Application(app)
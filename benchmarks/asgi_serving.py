@@ -0,0 +1,210 @@
+"""WSGI versus ASGI serving benchmark.
+
+Fills a scratch database as load_test.py does, then serves the app on it
+twice, each time with the same number of worker processes, threads and
+database connections per process:
+
+    wsgi    gunicorn --workers W --threads T app:app
+    asgi    uvicorn --workers W asgi:application   (ASGI_THREADS and
+                                                    ASYNC_DB_POOL_SIZE = T)
+
+At each `--connections` level it opens that many keep-alive connections,
+each logged in as its own user, and reads the JSON API through them for
+`--seconds`: home timelines, profiles, users' messages and single
+messages. Prints throughput, p50/p99 latency and errors per level, and the
+server's memory (RSS of all its processes) after each.
+
+    createdb warbler-bench
+    pip install gunicorn
+    python benchmarks/asgi_serving.py --connections 10 100 500 --seconds 10
+
+The load comes from this process, on the same machine as the servers;
+give the servers fewer workers than there are cores so it doesn't starve
+them. The scratch database is dropped and recreated; don't point this at
+real data.
+"""
+
+import argparse
+import asyncio
+import os
+import random
+import re
+import statistics
+import subprocess
+import sys
+import time
+import urllib.request
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+sys.path.insert(0, ROOT)
+os.environ['DATABASE_URL'] = os.environ.get(
+    'BENCH_DATABASE_URL', 'postgresql:///warbler-bench')
+
+from app import app, CURR_USER_KEY  # noqa: E402
+from load_test import set_up  # noqa: E402
+
+PORT = 5097
+
+CONTENT_LENGTH = re.compile(rb'content-length: *(\d+)', re.IGNORECASE)
+
+
+def servers(workers, threads):
+    """`{name: command}` for the two ways of serving the app."""
+
+    bind = f'127.0.0.1:{PORT}'
+    return {
+        'wsgi': [sys.executable, '-m', 'gunicorn', '--workers', str(workers),
+                 '--threads', str(threads), '--bind', bind, '--log-level', 'warning',
+                 'app:app'],
+        'asgi': [sys.executable, '-m', 'uvicorn', '--workers', str(workers),
+                 '--port', str(PORT), '--log-level', 'warning', '--no-access-log',
+                 'asgi:application'],
+    }
+
+
+def start(command, threads):
+    env = dict(os.environ, ASGI_THREADS=str(threads), ASYNC_DB_POOL_SIZE=str(threads),
+               DB_POOL_SIZE=str(threads), DB_MAX_OVERFLOW='0')
+    server = subprocess.Popen(command, cwd=ROOT, env=env)
+
+    deadline = time.time() + 30
+    while True:
+        try:
+            urllib.request.urlopen(f'http://127.0.0.1:{PORT}/api/v1/users/1').read()
+            return server
+        except OSError:
+            if time.time() > deadline or server.poll() is not None:
+                server.kill()
+                raise RuntimeError(f"{' '.join(command)} didn't start")
+            time.sleep(0.2)
+
+
+def rss_mb(pid):
+    """Resident memory of `pid` and all its descendants, in MB."""
+
+    total = 0
+    pids = [pid]
+    while pids:
+        pid = pids.pop()
+        try:
+            with open(f'/proc/{pid}/status') as status:
+                total += int(next(line for line in status if line.startswith('VmRSS')).split()[1])
+            with open(f'/proc/{pid}/task/{pid}/children') as children:
+                pids += [int(child) for child in children.read().split()]
+        except (OSError, StopIteration):
+            pass
+    return total / 1024
+
+
+def cookie(user_id):
+    serializer = app.session_interface.get_signing_serializer(app)
+    return f'{app.session_cookie_name}={serializer.dumps({CURR_USER_KEY: user_id})}'
+
+
+def paths(args, rng):
+    """An endless mix of API reads."""
+
+    while True:
+        user_id = rng.randint(1, args.users)
+        yield rng.choice([
+            '/api/v1/timeline?limit=20',
+            f'/api/v1/users/{user_id}',
+            f'/api/v1/users/{user_id}/messages?limit=20',
+            f'/api/v1/messages/{rng.randint(1, args.users * args.messages)}',
+        ])
+
+
+async def connection(user_id, args, stop_at, results):
+    """Send requests down one keep-alive connection until `stop_at`."""
+
+    headers = f'Host: 127.0.0.1\r\nCookie: {cookie(user_id)}\r\n\r\n'
+    requests = paths(args, random.Random(user_id))
+    writer = None
+
+    while time.perf_counter() < stop_at:
+        started = time.perf_counter()
+        try:
+            if writer is None:
+                reader, writer = await asyncio.open_connection('127.0.0.1', PORT)
+            writer.write(f'GET {next(requests)} HTTP/1.1\r\n{headers}'.encode())
+            head = await reader.readuntil(b'\r\n\r\n')
+            await reader.readexactly(int(CONTENT_LENGTH.search(head).group(1)))
+            ok = head.split(b' ', 2)[1] == b'200'
+        except (OSError, asyncio.IncompleteReadError, AttributeError):
+            ok = False
+            if writer:
+                writer.close()
+            writer = None
+        results['timings' if ok else 'errors'].append(time.perf_counter() - started)
+
+    if writer:
+        writer.close()
+
+
+async def load(connections, seconds, args):
+    results = {'timings': [], 'errors': []}
+    stop_at = time.perf_counter() + seconds
+    tasks = [asyncio.ensure_future(connection(i % args.users + 1, args, stop_at, results))
+             for i in range(connections)]
+
+    # a connection stuck waiting on the server counts as an error
+    done, pending = await asyncio.wait(tasks, timeout=seconds + 30)
+    for task in pending:
+        task.cancel()
+    results['errors'] += [None] * len(pending)
+
+    return results
+
+
+def report(name, connections, results, seconds, memory):
+    timings = sorted(t * 1000 for t in results['timings'])
+    if not timings:
+        print(f"{name:6} {connections:6}  no successful requests, "
+              f"{len(results['errors'])} errors")
+        return
+
+    print(f"{name:6} {connections:6} {len(timings) / seconds:9.1f} "
+          f"{statistics.median(timings):9.2f} {timings[int(len(timings) * .99)]:9.2f} "
+          f"{len(results['errors']):7} {memory:8.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--connections', type=int, nargs='+', default=[10, 100, 500],
+                        help='concurrent connections, one level after another')
+    parser.add_argument('--seconds', type=float, default=10, help='per level')
+    parser.add_argument('--workers', type=int, default=1, help='server processes')
+    parser.add_argument('--threads', type=int, default=15,
+                        help='threads and database connections per process')
+    parser.add_argument('--users', type=int, default=2000)
+    parser.add_argument('--messages', type=int, default=20, help='messages per user')
+    parser.add_argument('--only', choices=['wsgi', 'asgi'])
+    parser.add_argument('--no-setup', dest='setup', action='store_false',
+                        help='reuse the data from the last run')
+    args = parser.parse_args()
+
+    if args.setup:
+        set_up(args)
+
+    print(f"{args.workers} worker(s), {args.threads} threads/connections each\n")
+    print(f"{'server':6} {'conns':>6} {'req/s':>9} {'p50 ms':>9} {'p99 ms':>9} "
+          f"{'errors':>7} {'rss MB':>8}")
+
+    for name, command in servers(args.workers, args.threads).items():
+        if args.only and name != args.only:
+            continue
+
+        server = start(command, args.threads)
+        try:
+            asyncio.run(load(10, 2, args))  # warm up
+            for connections in args.connections:
+                results = asyncio.run(load(connections, args.seconds, args))
+                report(name, connections, results, args.seconds, rss_mb(server.pid))
+        finally:
+            server.terminate()
+            server.wait()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,408 @@
+"""HTTP load test with weighted user scenarios.
+
+Fills a scratch database with users who follow each other and have posted,
+serves the app on a local threaded server (or targets `--url`), and runs
+`--clients` virtual users for `--seconds`. Each virtual user logs in as its
+own account and then loops over scenarios picked by weight: browsing the
+home timeline, reading profiles and follow lists, posting, liking,
+following and unfollowing, searching, and logging in again.
+
+Prints throughput, p50/p95/p99 latency and error rate per route, and saves
+them as JSON under `benchmarks/results/`, named by time and git commit.
+`--compare` prints the change from an earlier run (by default the most
+recent one saved):
+
+    createdb warbler-bench
+    python benchmarks/load_test.py --clients 16 --seconds 60
+    git checkout some-branch
+    python benchmarks/load_test.py --clients 16 --seconds 60 --compare
+
+To load a production-like server instead, start it on the same database
+(e.g. `DATABASE_URL=postgresql:///warbler-bench gunicorn -w 4 app:app`)
+and pass `--url http://127.0.0.1:8000`. Forms are posted with their CSRF
+tokens, so CSRF protection can stay on.
+
+The scratch database is dropped and recreated; don't point this at real
+data.
+"""
+
+import argparse
+import glob
+import json
+import os
+import random
+import re
+import subprocess
+import sys
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from collections import defaultdict
+from datetime import datetime
+from http.cookiejar import CookieJar
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+os.environ['DATABASE_URL'] = os.environ.get(
+    'BENCH_DATABASE_URL', 'postgresql:///warbler-bench')
+
+from werkzeug.serving import WSGIRequestHandler, make_server  # noqa: E402
+
+from app import app  # noqa: E402
+from models import db, hasher, TimelineEntry  # noqa: E402
+
+PORT = 5098
+
+RESULTS_DIR = os.path.join(os.path.dirname(__file__), 'results')
+
+PASSWORD = 'password'
+
+# each user follows the next FOLLOWING users (wrapping around), so anyone
+# further away is free to follow and unfollow
+FOLLOWING = 20
+
+SEARCH_TERMS = ['user1', 'word7', 'city3', 'word42 city9', 'us']
+
+FILL = [
+    """
+    INSERT INTO users (id, email, username, password, bio, location)
+    SELECT i, 'user' || i || '@example.com', 'user' || i, :password,
+           'word' || (i * 7919) % 500 || ' and word' || (i * 104729) % 500,
+           'city' || (i * 31) % 50
+    FROM generate_series(1, :users) AS i
+    """,
+    "SELECT setval(pg_get_serial_sequence('users', 'id'), :users)",
+    """
+    INSERT INTO follows (user_following_id, user_being_followed_id)
+    SELECT i, (i + j - 1) % :users + 1
+    FROM generate_series(1, :users) AS i, generate_series(1, :following) AS j
+    """,
+    """
+    INSERT INTO messages (text, timestamp, user_id)
+    SELECT 'warble ' || j || ' from user' || i,
+           timezone('utc', now()) - (random() * interval '30 days'),
+           i
+    FROM generate_series(1, :users) AS i, generate_series(1, :messages) AS j
+    """,
+]
+
+CSRF_TOKEN = re.compile(r'name="csrf_token" type="hidden" value="([^"]+)"')
+
+
+class QuietHandler(WSGIRequestHandler):
+    def log_request(self, *args, **kwargs):
+        pass
+
+
+class NoRedirect(urllib.request.HTTPRedirectHandler):
+    """Time the redirecting request alone, as a browser's first hop."""
+
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+class Stats:
+    """Latencies and errors per route, shared by every client."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.timings = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.recording = False
+
+    def record(self, route, elapsed, ok):
+        if not self.recording:
+            return
+
+        with self.lock:
+            self.timings[route].append(elapsed * 1000)
+            if not ok:
+                self.errors[route] += 1
+
+
+class Client:
+    """One virtual user: a cookie jar, an account and a random stream."""
+
+    def __init__(self, base, user_id, args, stats, seed):
+        self.base = base
+        self.user_id = user_id
+        self.args = args
+        self.stats = stats
+        self.rng = random.Random(seed)
+        self.new_session()
+
+    def new_session(self):
+        self.opener = urllib.request.build_opener(
+            NoRedirect, urllib.request.HTTPCookieProcessor(CookieJar()))
+
+    def request(self, route, path, data=None):
+        """Make one request, recording its latency under `route`; returns
+        the body (for 2xx) or None."""
+
+        body = None
+        encoded = urllib.parse.urlencode(data).encode() if data is not None else None
+
+        started = time.perf_counter()
+        try:
+            with self.opener.open(self.base + path, encoded, timeout=30) as resp:
+                body = resp.read().decode()
+            ok = True
+        except urllib.error.HTTPError as err:
+            err.read()
+            ok = err.code < 400
+        except OSError:
+            ok = False
+        self.stats.record(route, time.perf_counter() - started, ok)
+
+        return body
+
+    def post_form(self, route, path, data):
+        """GET the form at `path` for its CSRF token, then POST it."""
+
+        page = self.request(f'GET {route}', path) or ''
+        token = CSRF_TOKEN.search(page)
+        if token:
+            data = dict(data, csrf_token=token.group(1))
+        self.request(f'POST {route}', path, data)
+
+    def random_user(self):
+        return self.rng.randint(1, self.args.users)
+
+    def random_message(self):
+        return self.rng.randint(1, self.args.users * self.args.messages)
+
+    # Scenarios
+
+    def log_in(self):
+        self.new_session()
+        self.post_form('/login', '/login', {
+            'username': f'user{self.user_id}',
+            'password': PASSWORD,
+        })
+
+    def browse_timeline(self):
+        self.request('GET /', '/')
+
+    def read_profile(self):
+        user_id = self.random_user()
+        self.request('GET /users/<id>', f'/users/{user_id}')
+        self.request('GET /users/<id>/followers', f'/users/{user_id}/followers')
+
+    def post(self):
+        self.post_form('/messages/new', '/messages/new', {
+            'text': f'load test warble {self.rng.random():.6f}',
+        })
+
+    def like(self):
+        self.request('POST /messages/<id>/like',
+                     f'/messages/{self.random_message()}/like', {})
+
+    def follow(self):
+        # someone outside the FOLLOWING users after us, and not us
+        target = (self.user_id - 1
+                  + self.rng.randint(FOLLOWING + 1, self.args.users - 1)) % self.args.users + 1
+        self.request('POST /users/follow/<id>', f'/users/follow/{target}', {})
+        self.request('POST /users/stop-following/<id>', f'/users/stop-following/{target}', {})
+
+    def search(self):
+        term = self.rng.choice(SEARCH_TERMS)
+        self.request('GET /users?q=', '/users?' + urllib.parse.urlencode({'q': term}))
+        self.request('GET /users/autocomplete', '/users/autocomplete?'
+                     + urllib.parse.urlencode({'q': term[:3]}))
+
+    SCENARIOS = {
+        'browse_timeline': 40,
+        'read_profile': 15,
+        'like': 15,
+        'search': 10,
+        'follow': 8,
+        'post': 7,
+        'log_in': 5,
+    }
+
+    def run(self, stop):
+        self.log_in()
+
+        names = list(self.SCENARIOS)
+        weights = list(self.SCENARIOS.values())
+        while not stop.is_set():
+            getattr(self, self.rng.choices(names, weights)[0])()
+            if self.args.think:
+                time.sleep(self.rng.expovariate(1000 / self.args.think))
+
+
+def set_up(args):
+    """Fill the scratch database for `args.users` users."""
+
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+
+        params = {
+            'users': args.users,
+            'following': FOLLOWING,
+            'messages': args.messages,
+            'password': hasher.hash(PASSWORD),
+        }
+        for statement in FILL:
+            db.session.execute(statement, params)
+        db.session.commit()
+
+        for user_id in range(1, args.users + 1):
+            TimelineEntry.rebuild(user_id)
+        db.session.commit()
+        db.session.execute('ANALYZE')
+
+
+def percentile(timings, q):
+    """Nearest-rank percentile of sorted `timings`."""
+
+    return timings[min(int(len(timings) * q), len(timings) - 1)]
+
+
+def summarize(stats, elapsed):
+    routes = {}
+    for route, timings in sorted(stats.timings.items()):
+        timings.sort()
+        routes[route] = {
+            'requests': len(timings),
+            'rps': round(len(timings) / elapsed, 2),
+            'p50_ms': round(percentile(timings, .50), 2),
+            'p95_ms': round(percentile(timings, .95), 2),
+            'p99_ms': round(percentile(timings, .99), 2),
+            'error_rate': round(stats.errors[route] / len(timings), 4),
+        }
+
+    everything = sorted(t for timings in stats.timings.values() for t in timings)
+    total = {
+        'requests': len(everything),
+        'rps': round(len(everything) / elapsed, 2),
+        'p50_ms': round(percentile(everything, .50), 2) if everything else None,
+        'p95_ms': round(percentile(everything, .95), 2) if everything else None,
+        'p99_ms': round(percentile(everything, .99), 2) if everything else None,
+        'error_rate': round(sum(stats.errors.values()) / max(len(everything), 1), 4),
+    }
+    return routes, total
+
+
+def git_commit():
+    def git(*args):
+        return subprocess.run(['git', *args], capture_output=True, text=True,
+                              cwd=os.path.dirname(__file__)).stdout.strip()
+
+    return git('rev-parse', '--short', 'HEAD') or 'unknown', bool(git('status', '--porcelain', '-uno'))
+
+
+def change(new, old):
+    if not old:
+        return ''
+    return f'{(new - old) / old * 100:+6.1f}%'
+
+
+def report(result, baseline=None):
+    rows = list(result['routes'].items()) + [('TOTAL', result['total'])]
+    old_routes = dict(baseline['routes'], TOTAL=baseline['total']) if baseline else {}
+
+    print(f"\n{'route':<34} {'reqs':>7} {'req/s':>8} {'p50':>9} {'p95':>9} "
+          f"{'p99':>9} {'errors':>7}")
+    for route, row in rows:
+        print(f"{route:<34} {row['requests']:>7} {row['rps']:>8.1f} "
+              f"{row['p50_ms']:>7.1f}ms {row['p95_ms']:>7.1f}ms {row['p99_ms']:>7.1f}ms "
+              f"{row['error_rate']:>6.1%}")
+
+        old = old_routes.get(route)
+        if old:
+            print(f"{'  vs ' + baseline['commit']:<34} {'':>7} "
+                  f"{change(row['rps'], old['rps']):>8} {change(row['p50_ms'], old['p50_ms']):>9} "
+                  f"{change(row['p95_ms'], old['p95_ms']):>9} "
+                  f"{change(row['p99_ms'], old['p99_ms']):>9}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--clients', type=int, default=8, help='concurrent virtual users')
+    parser.add_argument('--seconds', type=float, default=30)
+    parser.add_argument('--warmup', type=float, default=5,
+                        help='seconds to run before recording')
+    parser.add_argument('--think', type=float, default=0,
+                        help='mean pause between scenarios, in ms')
+    parser.add_argument('--users', type=int, default=2000)
+    parser.add_argument('--messages', type=int, default=20, help='messages per user')
+    parser.add_argument('--url', help='target this server instead of starting one')
+    parser.add_argument('--no-setup', dest='setup', action='store_false',
+                        help='reuse the data from the last run')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--compare', nargs='?', const='latest',
+                        help='a saved result to compare with (default: the latest)')
+    args = parser.parse_args()
+
+    if args.clients > args.users:
+        parser.error('need at least as many users as clients')
+
+    previous = sorted(glob.glob(os.path.join(RESULTS_DIR, '*.json')))
+    baseline = None
+    if args.compare == 'latest' and previous:
+        baseline = json.load(open(previous[-1]))
+    elif args.compare and args.compare != 'latest':
+        baseline = json.load(open(args.compare))
+
+    if args.setup:
+        set_up(args)
+
+    server = None
+    base = args.url
+    if not base:
+        # every virtual user logs in from 127.0.0.1; don't rate-limit them
+        app.config['ADMISSION_CONTROL'] = False
+        server = make_server('127.0.0.1', PORT, app, threaded=True,
+                             request_handler=QuietHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        base = f'http://127.0.0.1:{PORT}'
+
+    stats = Stats()
+    stop = threading.Event()
+    clients = [Client(base, i + 1, args, stats, seed=f'{args.seed}-{i}')
+               for i in range(args.clients)]
+    threads = [threading.Thread(target=client.run, args=(stop,)) for client in clients]
+    for thread in threads:
+        thread.start()
+
+    time.sleep(args.warmup)
+    stats.recording = True
+    started = time.perf_counter()
+    time.sleep(args.seconds)
+    stats.recording = False
+    elapsed = time.perf_counter() - started
+
+    stop.set()
+    for thread in threads:
+        thread.join()
+    if server:
+        server.shutdown()
+
+    commit, dirty = git_commit()
+    routes, total = summarize(stats, elapsed)
+    result = {
+        'commit': commit + ('-dirty' if dirty else ''),
+        'started': datetime.now().isoformat(timespec='seconds'),
+        'target': args.url or 'in-process threaded server',
+        'settings': {key: value for key, value in vars(args).items()
+                     if key not in ('compare', 'setup')},
+        'seconds': round(elapsed, 2),
+        'routes': routes,
+        'total': total,
+    }
+
+    report(result, baseline)
+
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    path = os.path.join(RESULTS_DIR,
+                        f"{datetime.now():%Y%m%d-%H%M%S}-{result['commit']}.json")
+    with open(path, 'w') as file:
+        json.dump(result, file, indent=2)
+    print(f'\nsaved {path}')
+
+
+if __name__ == '__main__':
+    main()
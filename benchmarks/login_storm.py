@@ -0,0 +1,145 @@
+"""Login storm benchmark.
+
+Serves the app on a local threaded server, hammers POST /login from many
+threads, and meanwhile times a cheap route (GET /users/autocomplete) from
+one probe thread. Prints the probe's latency before and during the storm,
+and the login throughput.
+
+With hashing on the bounded pool, probe latency should barely move during
+the storm; compare with `HASH_WORKERS` set to the number of cores, which
+approximates hashing on every request thread.
+
+The storm all comes from one address and one username, so admission
+control (admission.py) turns most of it away with 429s before it reaches
+the hasher; `--no-admission` lets it all through to measure the hasher
+alone.
+
+    createdb warbler-bench
+    HASH_WORKERS=2 python benchmarks/login_storm.py --logins 16 --seconds 10
+
+The scratch database is dropped and recreated; don't point this at real
+data.
+"""
+
+import argparse
+import os
+import statistics
+import sys
+import threading
+import time
+import urllib.parse
+import urllib.request
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+os.environ['DATABASE_URL'] = os.environ.get(
+    'BENCH_DATABASE_URL', 'postgresql:///warbler-bench')
+
+from werkzeug.serving import WSGIRequestHandler, make_server  # noqa: E402
+
+from app import app  # noqa: E402
+from models import db, User  # noqa: E402
+
+PORT = 5099
+
+
+class QuietHandler(WSGIRequestHandler):
+    def log_request(self, *args, **kwargs):
+        pass
+
+
+class NoRedirect(urllib.request.HTTPRedirectHandler):
+    """Stop at the login redirect instead of rendering the home page."""
+
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+opener = urllib.request.build_opener(NoRedirect)
+
+
+def probe(url, seconds):
+    """Latencies in ms of GETting `url` back to back for `seconds`."""
+
+    timings = []
+    stop = time.perf_counter() + seconds
+    while time.perf_counter() < stop:
+        started = time.perf_counter()
+        urllib.request.urlopen(url).read()
+        timings.append((time.perf_counter() - started) * 1000)
+    return timings
+
+
+def log_in(url, stop, counts):
+    """POST good credentials to `url` until `stop` is set."""
+
+    data = urllib.parse.urlencode({'username': 'storm', 'password': 'password'}).encode()
+    while not stop.is_set():
+        try:
+            opener.open(url, data).read()
+        except urllib.error.HTTPError as err:
+            if err.code == 302:
+                counts['ok'] += 1
+            else:
+                counts[err.code] = counts.get(err.code, 0) + 1
+
+
+def summary(timings):
+    timings = sorted(timings)
+    return (f"p50 {statistics.median(timings):7.2f}ms  "
+            f"p95 {timings[int(len(timings) * .95)]:7.2f}ms  "
+            f"p99 {timings[int(len(timings) * .99)]:7.2f}ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--logins', type=int, default=16,
+                        help='concurrent login threads')
+    parser.add_argument('--seconds', type=float, default=10)
+    parser.add_argument('--no-admission', action='store_true',
+                        help='turn off per-IP and per-username rate limits')
+    args = parser.parse_args()
+
+    app.config['WTF_CSRF_ENABLED'] = False
+    app.config['ADMISSION_CONTROL'] = not args.no_admission
+
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        User.signup('storm', 'storm@example.com', 'password', None)
+        db.session.commit()
+
+    server = make_server('127.0.0.1', PORT, app, threaded=True,
+                         request_handler=QuietHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    base = f'http://127.0.0.1:{PORT}'
+    probe_url = f'{base}/users/autocomplete?q=st'
+
+    print(f"bcrypt cost {app.config['BCRYPT_LOG_ROUNDS']}, "
+          f"{app.config['HASH_WORKERS']} hash workers, {args.logins} login threads, "
+          f"admission control {'on' if app.config['ADMISSION_CONTROL'] else 'off'}")
+    print(f"idle:        {summary(probe(probe_url, args.seconds / 2))}")
+
+    stop = threading.Event()
+    counts = {'ok': 0}
+    storm = [threading.Thread(target=log_in, args=(f'{base}/login', stop, counts))
+             for _ in range(args.logins)]
+    for thread in storm:
+        thread.start()
+
+    started = time.perf_counter()
+    timings = probe(probe_url, args.seconds)
+    elapsed = time.perf_counter() - started
+
+    stop.set()
+    for thread in storm:
+        thread.join()
+    server.shutdown()
+
+    print(f"under storm: {summary(timings)}")
+    print(f"logins: {counts['ok'] / elapsed:.1f}/s, "
+          f"rejected: { {k: v for k, v in counts.items() if k != 'ok'} }")
+
+
+if __name__ == '__main__':
+    main()
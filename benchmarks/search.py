@@ -0,0 +1,92 @@
+"""Search latency benchmark.
+
+Grows a scratch database's users table through a series of sizes and, at
+each size, times `User.search` and `User.autocomplete` for a fixed set of
+terms. With the indexes in place the latencies should stay roughly flat as
+the table grows. (Words that match a fixed fraction of all users still
+cost more as the table grows, because the full-text index has to gather
+every match before the candidate limit applies; bios here are drawn from
+a few thousand words, so that fraction stays small, as it does in real
+bios.)
+
+    createdb warbler-bench
+    python benchmarks/search.py --sizes 10000 100000 1000000 10000000
+
+The scratch database is dropped and recreated; don't point this at real
+data.
+"""
+
+import argparse
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+os.environ['DATABASE_URL'] = os.environ.get(
+    'BENCH_DATABASE_URL', 'postgresql:///warbler-bench')
+
+from app import app  # noqa: E402
+from models import db, User  # noqa: E402
+
+VOCABULARY = 5000
+CITIES = 500
+
+SEARCH_TERMS = ['user42', 'word17', 'word5 city3', 'USER1234', 'word99', 'zzz']
+AUTOCOMPLETE_TERMS = ['u', 'user9', 'user12345', 'x']
+
+FILL_USERS = f"""
+    INSERT INTO users (email, username, password, bio, location)
+    SELECT 'user' || i || '@example.com',
+           'user' || i || '_' || substr(md5(i::text), 1, 6),
+           'not-a-hash',
+           'word' || (i::bigint * 7919) % {VOCABULARY} || ' and ' ||
+           'word' || (i::bigint * 104729) % {VOCABULARY},
+           'city' || (i * 31) % {CITIES}
+    FROM generate_series(:start, :stop) AS i
+"""
+
+
+def time_calls(fn, terms, repeat):
+    """Median and worst latency in ms of calling `fn` on each term."""
+
+    timings = []
+    for _ in range(repeat):
+        for term in terms:
+            started = time.perf_counter()
+            fn(term)
+            timings.append((time.perf_counter() - started) * 1000)
+
+    return statistics.median(timings), max(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        default=[10_000, 100_000, 1_000_000])
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+
+        print(f"{'users':>12} {'search p50':>11} {'max':>8} "
+              f"{'autocomplete p50':>17} {'max':>8}")
+
+        loaded = 0
+        for size in sorted(args.sizes):
+            db.session.execute(FILL_USERS, {'start': loaded + 1, 'stop': size})
+            db.session.commit()
+            db.session.execute('ANALYZE users')
+            loaded = size
+
+            search = time_calls(User.search, SEARCH_TERMS, args.repeat)
+            complete = time_calls(User.autocomplete, AUTOCOMPLETE_TERMS, args.repeat)
+
+            print(f"{size:>12,} {search[0]:>9.2f}ms {search[1]:>6.2f}ms "
+                  f"{complete[0]:>15.2f}ms {complete[1]:>6.2f}ms")
+
+
+if __name__ == '__main__':
+    main()
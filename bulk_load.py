@@ -0,0 +1,362 @@
+"""Bulk loading of CSV data into a fresh database, for `seed.py`.
+
+Rows are streamed to PostgreSQL with `COPY` in chunks of `chunk_rows`, by a
+pool of worker processes each holding its own connection, so memory stays
+bounded by the chunk size however large the files are. Chunks of users,
+messages and follows are interleaved: with foreign keys deferred nothing
+needs to load in any particular order.
+
+Before loading, secondary indexes, unique constraints and foreign keys on
+the loaded tables are dropped and the triggers disabled; afterwards the
+indexes are rebuilt in parallel, the constraints re-added (and validated),
+and the tables ANALYZEd. Counters and home timelines, which the triggers
+and `fan_out` would normally maintain, are then rebuilt in id batches.
+
+Users and messages in the CSVs have no ids; they are numbered from 1 in
+file order, which is what the generator's `user_id` columns refer to.
+"""
+
+import csv
+import io
+import multiprocessing
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from itertools import islice
+
+import psycopg2
+
+CHUNK_ROWS = 50000
+
+# rows per batch when rebuilding counters and timelines
+REBUILD_BATCH = 10000
+
+
+class Source:
+    """A CSV file to COPY into `table`.
+
+    `numbered` sources get an `id` column from their row numbers.
+    """
+
+    def __init__(self, table, path, numbered):
+        self.table = table
+        self.path = path
+        self.numbered = numbered
+
+    def chunks(self, chunk_rows):
+        """Yield `copy_chunk` arguments for each chunk of the file.
+
+        Records are split on newlines outside quotes, so the text is never
+        parsed here; workers do that.
+        """
+
+        with open(self.path, newline='') as file:
+            columns = next(csv.reader([file.readline()]))
+            if self.numbered:
+                columns = ['id'] + columns
+
+            first_id = 1
+            while True:
+                records = list(islice(csv_records(file), chunk_rows))
+                if not records:
+                    return
+
+                yield (self.table, columns, first_id if self.numbered else None,
+                       ''.join(records))
+                first_id += len(records)
+
+
+def csv_records(file):
+    """Yield the raw text of each CSV record in `file`.
+
+    A record may span lines when a quoted field contains a newline; since
+    quotes inside fields are doubled, a record is complete once it holds an
+    even number of them.
+    """
+
+    record = ''
+    for line in file:
+        record += line
+        if record.count('"') % 2 == 0:
+            yield record
+            record = ''
+
+    if record:
+        yield record
+
+
+class Progress:
+    """Rows loaded per table, redrawn on one line of stderr."""
+
+    def __init__(self, tables):
+        self.rows = dict.fromkeys(tables, 0)
+        self.started = time.perf_counter()
+
+    def add(self, table, rows):
+        self.rows[table] += rows
+        total = sum(self.rows.values())
+        rate = total / max(time.perf_counter() - self.started, 1e-6)
+
+        counts = ', '.join(f'{table} {rows:,}' for table, rows in self.rows.items())
+        sys.stderr.write(f'\r{counts} ({rate:,.0f} rows/s)')
+        sys.stderr.flush()
+
+    def done(self, label):
+        elapsed = time.perf_counter() - self.started
+        sys.stderr.write(f'\n{label} in {elapsed:.1f}s\n')
+
+
+##############################################################################
+# Worker processes
+
+_conn = None
+
+
+def connect_worker(dsn):
+    """Pool initializer: one connection per worker process."""
+
+    global _conn
+    _conn = psycopg2.connect(dsn)
+    with _conn.cursor() as cursor:
+        # a failed seed is simply rerun
+        cursor.execute('SET synchronous_commit = off')
+    _conn.commit()
+
+
+def number_rows(text, first_id):
+    """Put an id before each record of CSV `text`, counting up from
+    `first_id`. Returns the new text and the number of records."""
+
+    out = io.StringIO()
+    writer = csv.writer(out)
+    rows = 0
+    for rows, row in enumerate(csv.reader(io.StringIO(text, newline='')), 1):
+        writer.writerow([first_id + rows - 1] + row)
+
+    return out.getvalue(), rows
+
+
+def copy_chunk(table, columns, first_id, text):
+    """COPY one chunk of CSV text into `table`; returns the row count."""
+
+    if first_id is not None:
+        text, rows = number_rows(text, first_id)
+    else:
+        rows = None
+
+    with _conn.cursor() as cursor:
+        cursor.copy_expert(
+            f"COPY {table} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv)",
+            io.StringIO(text))
+        rows = cursor.rowcount if rows is None else rows
+    _conn.commit()
+
+    return table, rows
+
+
+def run_statement(statement):
+    """Run one DDL statement (e.g. a CREATE INDEX) in its own transaction."""
+
+    with _conn.cursor() as cursor:
+        cursor.execute('SET maintenance_work_mem = %s', ('512MB',))
+        cursor.execute(statement)
+    _conn.commit()
+
+    return statement
+
+
+def rebuild_users(first_id, last_id, timelines):
+    """Reconcile counters, and optionally rebuild timelines, for a range of
+    user ids."""
+
+    from app import db
+    from models import User, TimelineEntry
+
+    user_ids = [id for (id,) in (db.session
+                                 .query(User.id)
+                                 .filter(User.id.between(first_id, last_id)))]
+    User.reconcile_counters(user_ids)
+
+    # authors too popular to fan out to everyone are read at request time
+    (User.query
+     .filter(User.id.between(first_id, last_id),
+             User.followers_count > TimelineEntry.FANOUT_LIMIT)
+     .update({User.fanout_on_read: True}, synchronize_session=False))
+    db.session.commit()
+
+    if timelines:
+        for user_id in user_ids:
+            TimelineEntry.rebuild(user_id)
+        db.session.commit()
+
+    return last_id - first_id + 1
+
+
+##############################################################################
+# Loading
+
+class BulkLoader:
+    """Load `sources` into the database at `dsn` with `workers` processes."""
+
+    def __init__(self, dsn, sources, workers, chunk_rows=CHUNK_ROWS):
+        self.dsn = dsn
+        self.sources = sources
+        self.workers = workers
+        self.chunk_rows = chunk_rows
+        self.tables = [source.table for source in sources]
+
+    def run(self, timelines=True):
+        conn = psycopg2.connect(self.dsn)
+        conn.autocommit = True
+
+        # spawned, not forked: the parent's connections stay its own
+        context = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(self.workers, mp_context=context,
+                                 initializer=connect_worker,
+                                 initargs=(self.dsn,)) as pool:
+            with conn.cursor() as cursor:
+                constraints, indexes = self.defer(cursor)
+                self.load(pool)
+                self.restore(cursor, pool, constraints, indexes)
+
+            self.rebuild(conn, pool, timelines)
+
+        conn.close()
+
+    def defer(self, cursor):
+        """Drop foreign keys, unique constraints and secondary indexes on the
+        loaded tables, and disable their triggers.
+
+        Returns the constraint and index definitions, in the order to
+        recreate them.
+        """
+
+        cursor.execute("""
+            SELECT conrelid::regclass::text, conname, pg_get_constraintdef(oid)
+              FROM pg_constraint
+             WHERE conrelid = ANY(%s::regclass[]) AND contype IN ('f', 'u')
+             ORDER BY contype DESC  -- unique before foreign keys
+        """, (self.tables,))
+        constraints = cursor.fetchall()
+
+        cursor.execute("""
+            SELECT indexname, indexdef
+              FROM pg_indexes
+             WHERE tablename = ANY(%s)
+               AND indexname NOT IN (SELECT conname FROM pg_constraint)
+        """, (self.tables,))
+        indexes = cursor.fetchall()
+
+        # foreign keys from other tables (likes, timelines, ...) block
+        # dropping the unique constraints they may rely on, and their
+        # checks would slow the load; defer those too
+        cursor.execute("""
+            SELECT conrelid::regclass::text, conname, pg_get_constraintdef(oid)
+              FROM pg_constraint
+             WHERE confrelid = ANY(%s::regclass[])
+               AND NOT conrelid = ANY(%s::regclass[])
+               AND contype = 'f'
+        """, (self.tables, self.tables))
+        constraints += cursor.fetchall()
+
+        # foreign keys first, in case a unique constraint backs one
+        for table, name, _ in reversed(constraints):
+            cursor.execute(f'ALTER TABLE {table} DROP CONSTRAINT {name}')
+        for name, _ in indexes:
+            cursor.execute(f'DROP INDEX {name}')
+        for table in self.tables:
+            cursor.execute(f'ALTER TABLE {table} DISABLE TRIGGER USER')
+
+        return constraints, indexes
+
+    def load(self, pool):
+        """COPY every source, a chunk at a time, keeping the pool busy but
+        holding at most two chunks per worker in memory."""
+
+        progress = Progress(self.tables)
+        chunks = interleave([source.chunks(self.chunk_rows)
+                             for source in self.sources])
+
+        pending = set()
+        for args in chunks:
+            if len(pending) >= self.workers * 2:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    progress.add(*future.result())
+            pending.add(pool.submit(copy_chunk, *args))
+
+        for future in pending:
+            progress.add(*future.result())
+
+        progress.done('Loaded')
+
+    def restore(self, cursor, pool, constraints, indexes):
+        """Rebuild indexes in parallel, then re-add constraints and ANALYZE."""
+
+        started = time.perf_counter()
+
+        for table in self.tables:
+            cursor.execute(f'ALTER TABLE {table} ENABLE TRIGGER USER')
+
+        # ids were supplied, so move the sequences past them
+        for source in self.sources:
+            if source.numbered:
+                cursor.execute(f"""
+                    SELECT setval(pg_get_serial_sequence('{source.table}', 'id'), max(id))
+                      FROM {source.table}
+                    HAVING count(*) > 0
+                """)
+
+        for future in [pool.submit(run_statement, definition)
+                       for _, definition in indexes]:
+            future.result()
+
+        # each takes a lock on both tables; one at a time avoids deadlocks
+        cursor.execute('SET maintenance_work_mem = %s', ('512MB',))
+        for table, name, definition in constraints:
+            cursor.execute(f'ALTER TABLE {table} ADD CONSTRAINT {name} {definition}')
+
+        for table in self.tables:
+            cursor.execute(f'ANALYZE {table}')
+
+        sys.stderr.write(f'Rebuilt {len(indexes)} indexes and {len(constraints)} '
+                         f'constraints in {time.perf_counter() - started:.1f}s\n')
+
+    def rebuild(self, conn, pool, timelines):
+        """Reconcile counters and rebuild timelines, in parallel batches."""
+
+        with conn.cursor() as cursor:
+            cursor.execute('SELECT min(id), max(id) FROM users')
+            first, last = cursor.fetchone()
+
+        if first is None:
+            return
+
+        started = time.perf_counter()
+        futures = [pool.submit(rebuild_users, lo, min(lo + REBUILD_BATCH - 1, last),
+                               timelines)
+                   for lo in range(first, last + 1, REBUILD_BATCH)]
+
+        users = 0
+        for future in futures:
+            users += future.result()
+            sys.stderr.write(f'\rRebuilt counters{" and timelines" if timelines else ""} '
+                             f'for {users:,} users')
+            sys.stderr.flush()
+
+        with conn.cursor() as cursor:
+            cursor.execute('ANALYZE')
+
+        sys.stderr.write(f' in {time.perf_counter() - started:.1f}s\n')
+
+
+def interleave(iterables):
+    """Round-robin over `iterables` until all are exhausted."""
+
+    iterators = [iter(it) for it in iterables]
+    while iterators:
+        for it in list(iterators):
+            try:
+                yield next(it)
+            except StopIteration:
+                iterators.remove(it)
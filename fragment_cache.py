@@ -0,0 +1,99 @@
+"""Per-process cache of rendered template fragments.
+
+Timelines and user lists render the same message rows and user cards for
+every viewer. Templates wrap the shared part of each in a call block:
+
+    {% call fragment('message', msg.id, (msg.timestamp, msg.user.username,
+                                         msg.user.image_url)) %}
+      ...markup that only depends on the message and its author...
+    {% endcall %}
+
+and keep anything that depends on the viewer (like buttons, follow
+buttons) outside it. The key is the fragment's kind, the entity's id and a
+version that changes whenever the markup would (the profile fields it
+shows, and a message's timestamp in case its id is reused by a rebuilt
+database), so entries never need invalidating; stale versions just age out
+of the LRU. (Not a user's `updated_at`: the counter triggers move that on
+every follow, like and message.)
+
+The cache is bounded by the total length of the markup it holds, and
+counts hits, misses and evictions so its hit rate can be watched.
+"""
+
+from collections import OrderedDict
+from threading import Lock
+
+from markupsafe import Markup
+
+
+class FragmentCache:
+    """LRU of `{(kind, id, version): markup}`, at most `max_size` characters."""
+
+    def __init__(self, max_size=8 * 1024 * 1024):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.size = 0
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def init_app(self, app):
+        app.config.setdefault('FRAGMENT_CACHE_SIZE', self.max_size)
+        self.max_size = app.config['FRAGMENT_CACHE_SIZE']
+        app.jinja_env.globals['fragment'] = self.fragment
+
+    def fragment(self, kind, entity_id, version, caller):
+        """Return the cached markup for this key, rendering it with
+        `caller` (the call block's body) on a miss."""
+
+        key = (kind, entity_id, version)
+
+        with self.lock:
+            markup = self.entries.get(key)
+            if markup is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return markup
+            self.misses += 1
+
+        markup = Markup(caller())
+        self.put(key, markup)
+        return markup
+
+    def put(self, key, markup):
+        if len(markup) > self.max_size:
+            return
+
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old)
+
+            self.entries[key] = markup
+            self.size += len(markup)
+            while self.size > self.max_size:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= len(evicted)
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    @property
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def stats(self):
+        return {
+            'entries': len(self.entries),
+            'size': self.size,
+            'max_size': self.max_size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': round(self.hit_rate, 4),
+        }
@@ -2,15 +2,35 @@
 
 Students won't need to run this for the exercise; they will just use the CSV
 files that this generates. You should only need to run this if you wanted to
-tweak the CSV formats or generate fewer/more rows.
+tweak the CSV formats or generate fewer/more rows:
+
+    python generator/create_csvs.py --users 10000000 --messages 100000000 \\
+        --follows-per-user 20 --workers 16 --seed 1
+
+Runs offline, and the same arguments always produce the same files,
+whatever the number of workers. Rows are generated in chunks by a pool of
+processes and streamed to disk in order, so memory doesn't grow with the
+row counts.
+
+The data is skewed like a real site's: who gets followed and who posts
+follow power laws (see `helpers.PowerLaw`), following counts are
+heavy-tailed, and message timestamps grow busier towards the present with
+a daily rhythm (see `helpers.get_realistic_datetime`). Messages are written
+in roughly chronological order, so ids increase with time as they would in
+production.
 """
 
+import argparse
 import csv
-from random import choice, randint, sample
-from itertools import permutations
-import requests
+import io
+import os
+import random
+from datetime import datetime
+from multiprocessing import Pool
+
 from faker import Faker
-from helpers import get_random_datetime
+from faker.providers.lorem.en_US import Provider as Lorem
+from helpers import PowerLaw, get_realistic_datetime
 
 MAX_WARBLER_LENGTH = 140
 
@@ -20,11 +40,26 @@ FOLLOWS_CSV_HEADERS = ['user_being_followed_id', 'user_following_id']
 
 NUM_USERS = 300
 NUM_MESSAGES = 1000
-NUM_FOLLWERS = 5000
+FOLLOWS_PER_USER = 16
+
+CHUNK_ROWS = 10000
+
+# everyone's password is "password"
+PASSWORD = '$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe'
 
-fake = Faker()
+# popularity skew: how strongly follows and posting concentrate on a few users
+FOLLOWED_EXPONENT = 1.0
+POSTING_EXPONENT = 0.8
 
-# Generate random profile image URLs to use for users
+# following counts are Pareto distributed with this shape; lower is more skewed
+FOLLOWING_SHAPE = 2.0
+MAX_FOLLOWING = 5000
+
+# fixed, so timestamps don't depend on when the generator runs
+NOW = datetime(2024, 1, 1)
+
+# Profile and header image URLs; only the URLs are generated, nothing is
+# fetched
 
 image_urls = [
     f"https://randomuser.me/api/portraits/{kind}/{i}.jpg"
@@ -32,46 +67,158 @@ image_urls = [
     for i in range(count)
 ]
 
-# Generate random header image URLs to use for users
-
 header_image_urls = [
-    requests.get(f"http://www.splashbase.co/api/v1/images/{i}").json()['url']
-    for i in range(1, 46)
+    "/static/images/warbler-hero.jpg",
+    "/static/images/signed-out-home.jpg",
 ]
 
-with open('generator/users.csv', 'w') as users_csv:
-    users_writer = csv.DictWriter(users_csv, fieldnames=USERS_CSV_HEADERS)
-    users_writer.writeheader()
-
-    for i in range(NUM_USERS):
-        users_writer.writerow(dict(
-            email=fake.email(),
-            username=fake.user_name(),
-            image_url=choice(image_urls),
-            password='$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe',
-            bio=fake.sentence(),
-            header_image_url=choice(header_image_urls),
-            location=fake.city()
-        ))
-
-with open('generator/messages.csv', 'w') as messages_csv:
-    messages_writer = csv.DictWriter(messages_csv, fieldnames=MESSAGES_CSV_HEADERS)
-    messages_writer.writeheader()
-
-    for i in range(NUM_MESSAGES):
-        messages_writer.writerow(dict(
-            text=fake.paragraph()[:MAX_WARBLER_LENGTH],
-            timestamp=get_random_datetime(),
-            user_id=randint(1, NUM_USERS)
-        ))
-
-# Generate follows.csv from random pairings of users
-
-with open('generator/follows.csv', 'w') as follows_csv:
-    all_pairs = list(permutations(range(1, NUM_USERS + 1), 2))
-
-    users_writer = csv.DictWriter(follows_csv, fieldnames=FOLLOWS_CSV_HEADERS)
-    users_writer.writeheader()
-
-    for followed_user, follower in sample(all_pairs, NUM_FOLLWERS):
-        users_writer.writerow(dict(user_being_followed_id=followed_user, user_following_id=follower))
+# word and name pools for each worker, built once from a seeded Faker;
+# composing rows from them is many times faster than calling Faker per row
+pools = None
+
+
+def build_pools(seed):
+    global pools
+
+    fake = Faker()
+    fake.seed_instance(seed)
+    pools = {
+        'usernames': [fake.user_name() for i in range(5000)],
+        'domains': [fake.free_email_domain() for i in range(50)],
+        'cities': [fake.city() for i in range(2000)],
+        'words': Lorem.word_list,
+    }
+
+
+def sentence(rng, min_words=4, max_words=12):
+    words = rng.choices(pools['words'], k=rng.randint(min_words, max_words))
+    return ' '.join(words).capitalize() + '.'
+
+
+def to_csv(rows):
+    out = io.StringIO()
+    csv.writer(out).writerows(rows)
+    return out.getvalue()
+
+
+def users_chunk(args):
+    """CSV rows for users `first_id` up to (not including) `last_id`."""
+
+    seed, first_id, last_id = args
+    rng = random.Random(f'{seed}-users-{first_id}')
+
+    rows = []
+    for user_id in range(first_id, last_id):
+        # ids keep usernames and emails unique; pool names have no "_"
+        name = rng.choice(pools['usernames'])
+        rows.append([
+            f"{name}.{user_id}@{rng.choice(pools['domains'])}",
+            f"{name}_{user_id}",
+            rng.choice(image_urls),
+            PASSWORD,
+            sentence(rng),
+            rng.choice(header_image_urls),
+            rng.choice(pools['cities']),
+        ])
+
+    return to_csv(rows)
+
+
+def messages_chunk(args):
+    """CSV rows for the `chunk`th of `chunks` slices of the timeline."""
+
+    seed, chunk, chunks, count, num_users = args
+    rng = random.Random(f'{seed}-messages-{chunk}')
+    authors = PowerLaw(num_users, POSTING_EXPONENT, salt=seed + 1)
+
+    rows = []
+    for i in range(count):
+        quantile = (chunk + rng.random()) / chunks
+        text = ' '.join(sentence(rng) for _ in range(rng.randint(1, 3)))
+        rows.append([
+            text[:MAX_WARBLER_LENGTH],
+            get_realistic_datetime(quantile, rng=rng, now=NOW),
+            authors.draw(rng),
+        ])
+
+    rows.sort(key=lambda row: row[1])
+    return to_csv(rows)
+
+
+def follows_chunk(args):
+    """CSV rows for the users followed by followers `first_id` to `last_id`."""
+
+    seed, first_id, last_id, num_users, follows_per_user = args
+    rng = random.Random(f'{seed}-follows-{first_id}')
+    followed = PowerLaw(num_users, FOLLOWED_EXPONENT, salt=seed)
+
+    # Pareto with this scale averages `follows_per_user`
+    scale = follows_per_user * (FOLLOWING_SHAPE - 1) / FOLLOWING_SHAPE
+
+    rows = []
+    for follower in range(first_id, last_id):
+        wanted = min(int(scale * rng.paretovariate(FOLLOWING_SHAPE)),
+                     num_users - 1, MAX_FOLLOWING)
+
+        # the most popular users come up again and again, so give up after
+        # a few tries rather than hunting for the last unfollowed one
+        following = set()
+        for attempt in range(wanted * 3):
+            if len(following) == wanted:
+                break
+            user_id = followed.draw(rng)
+            if user_id != follower:
+                following.add(user_id)
+
+        rows.extend([user_id, follower] for user_id in sorted(following))
+
+    return to_csv(rows)
+
+
+def id_ranges(count):
+    return [(first, min(first + CHUNK_ROWS, count + 1))
+            for first in range(1, count + 1, CHUNK_ROWS)]
+
+
+def write_csv(path, headers, pool, fn, tasks):
+    """Write the chunks `fn` makes from `tasks`, in order, to `path`."""
+
+    with open(path, 'w', newline='') as file:
+        csv.writer(file).writerow(headers)
+        for done, text in enumerate(pool.imap(fn, tasks), 1):
+            file.write(text)
+            print(f'\r{path}: {done}/{len(tasks)} chunks', end='', flush=True)
+    print()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate CSVs of random data for Warbler.')
+    parser.add_argument('--users', type=int, default=NUM_USERS)
+    parser.add_argument('--messages', type=int, default=NUM_MESSAGES)
+    parser.add_argument('--follows-per-user', type=float, default=FOLLOWS_PER_USER)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--out', default='generator')
+    args = parser.parse_args()
+
+    users = id_ranges(args.users)
+    chunks = max(-(-args.messages // CHUNK_ROWS), 1)
+    messages = [(args.seed, chunk, chunks,
+                 args.messages // chunks + (chunk < args.messages % chunks),
+                 args.users)
+                for chunk in range(chunks)]
+
+    with Pool(args.workers, initializer=build_pools, initargs=(args.seed,)) as pool:
+        write_csv(os.path.join(args.out, 'users.csv'), USERS_CSV_HEADERS, pool,
+                  users_chunk, [(args.seed, first, last) for first, last in users])
+
+        write_csv(os.path.join(args.out, 'messages.csv'), MESSAGES_CSV_HEADERS, pool,
+                  messages_chunk, messages)
+
+        write_csv(os.path.join(args.out, 'follows.csv'), FOLLOWS_CSV_HEADERS, pool,
+                  follows_chunk, [(args.seed, first, last, args.users, args.follows_per_user)
+                                  for first, last in users])
+
+
+if __name__ == '__main__':
+    main()
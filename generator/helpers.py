@@ -1,14 +1,86 @@
 """Support functions for CSV generation."""
 
-from datetime import datetime
-from random import uniform
+import math
+import random
+from datetime import datetime, timedelta
 
+# relative number of messages posted in each hour of the day (UTC): quiet
+# overnight, building through the day to an evening peak
+HOURLY_ACTIVITY = [
+    3, 2, 1, 1, 1, 1, 2, 4, 6, 7, 7, 7,
+    8, 8, 7, 7, 7, 8, 9, 10, 10, 9, 7, 5,
+]
 
-def get_random_datetime(year_gap=2):
-    """Get a random datetime within the last few years."""
 
-    now = datetime.now()
+def get_random_datetime(year_gap=2, rng=random, now=None):
+    """Get a random datetime within the last few years.
+
+    Pass a seeded `rng` and a fixed `now` for repeatable results.
+    """
+
+    now = now or datetime.now()
     then = now.replace(year=now.year - year_gap)
-    random_timestamp = uniform(then.timestamp(), now.timestamp())
+    random_timestamp = rng.uniform(then.timestamp(), now.timestamp())
 
     return datetime.fromtimestamp(random_timestamp)
+
+
+def get_realistic_datetime(quantile, year_gap=2, rng=random, now=None, growth=2.0):
+    """Get a datetime within the last few years, like a real site's posts.
+
+    Daily volume grows by a factor of `growth` each year, so recent days
+    are busier, and times of day follow HOURLY_ACTIVITY. `quantile` (0 to 1)
+    picks the day: the same quantile always lands on the same day, and
+    increasing quantiles give increasing days, so callers can hand out
+    ordered slices of it.
+    """
+
+    now = now or datetime.now()
+    then = now.replace(year=now.year - year_gap)
+
+    # invert the CDF of volume growing as growth ** years
+    rate = math.log(growth)
+    years = math.log1p(quantile * math.expm1(rate * year_gap)) / rate
+    day = then + timedelta(days=math.floor(years * (now - then).days / year_gap))
+
+    hour = rng.choices(range(24), HOURLY_ACTIVITY)[0]
+    moment = day.replace(hour=hour, minute=0, second=0, microsecond=0)
+    moment += timedelta(seconds=rng.uniform(0, 3600))
+
+    return min(moment, now)
+
+
+class PowerLaw:
+    """Draws ids from 1 to `n` with Zipf-like popularity.
+
+    The id at popularity rank r is drawn with probability proportional to
+    r ** -exponent (exponent 1 is Zipf's law; 0 is uniform). Ranks are
+    scattered over the ids by a fixed permutation picked by `salt`, so the
+    most popular ids are not simply the lowest ones, and different salts
+    make different ids popular. Uses no memory per id.
+    """
+
+    def __init__(self, n, exponent=1.0, salt=0):
+        self.n = n
+        self.exponent = exponent
+
+        # any stride coprime with n maps ranks to ids one-to-one; one near
+        # n / golden ratio spreads neighbouring ranks across the whole range
+        self.stride = max(int(n * 0.6180339887), 1)
+        while math.gcd(self.stride, n) != 1:
+            self.stride += 1
+        self.offset = (salt * 7919) % n
+
+    def rank(self, u):
+        """The popularity rank (1 to n) at quantile `u`."""
+
+        if self.exponent == 1:
+            x = (self.n + 1) ** u
+        else:
+            power = 1 - self.exponent
+            x = (1 + u * ((self.n + 1) ** power - 1)) ** (1 / power)
+
+        return min(int(x), self.n)
+
+    def draw(self, rng):
+        return ((self.rank(rng.random()) - 1) * self.stride + self.offset) % self.n + 1
@@ -0,0 +1,91 @@
+"""Password hashing on a bounded worker pool.
+
+bcrypt is deliberately slow: at cost 12 one hash pins a core for a few
+hundred milliseconds. Running it on the request thread lets a burst of
+logins use every core and starve every other route. Instead, hashes run on
+a small pool of `HASH_WORKERS` threads (bcrypt releases the GIL while it
+works), so at most that many cores are ever spent on hashing and the rest
+stay free for everything else.
+
+The cost factor comes from `BCRYPT_LOG_ROUNDS`. Stored hashes made with a
+different cost are re-hashed at the next successful login (see
+`User.authenticate`), so changing it takes effect gradually.
+"""
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+from threading import BoundedSemaphore
+
+import bcrypt
+
+
+class HasherBusy(Exception):
+    """Raised when too many hashes are already queued or running."""
+
+
+class PasswordHasher:
+    """bcrypt hashing and checking on a bounded thread pool."""
+
+    def __init__(self, rounds=12, workers=2, max_pending=64):
+        self.configure(rounds, workers, max_pending)
+
+    def init_app(self, app):
+        """Configure from `app.config`, with defaults from the environment."""
+
+        app.config.setdefault('BCRYPT_LOG_ROUNDS',
+                              int(os.environ.get('BCRYPT_LOG_ROUNDS', 12)))
+        app.config.setdefault('HASH_WORKERS',
+                              int(os.environ.get('HASH_WORKERS',
+                                                 max((os.cpu_count() or 2) // 2, 1))))
+        # a few hashes' wait at most; any longer and the client is better
+        # off told to retry than left hanging
+        app.config.setdefault('HASH_MAX_PENDING',
+                              int(os.environ.get('HASH_MAX_PENDING',
+                                                 4 * app.config['HASH_WORKERS'])))
+
+        self.configure(app.config['BCRYPT_LOG_ROUNDS'],
+                       app.config['HASH_WORKERS'],
+                       app.config['HASH_MAX_PENDING'])
+
+    def configure(self, rounds, workers, max_pending):
+        if getattr(self, 'executor', None):
+            self.executor.shutdown(wait=False)
+
+        self.rounds = rounds
+        self.workers = workers
+        self.executor = ThreadPoolExecutor(max_workers=workers,
+                                           thread_name_prefix='bcrypt')
+        # hashes queued or running; past this, callers get HasherBusy
+        # instead of waiting behind a queue that will never drain in time
+        self.pending = BoundedSemaphore(max_pending)
+
+    def run(self, fn, *args):
+        """Run `fn(*args)` on the pool and wait for its result."""
+
+        if not self.pending.acquire(blocking=False):
+            raise HasherBusy()
+
+        try:
+            return self.executor.submit(fn, *args).result()
+        finally:
+            self.pending.release()
+
+    def hash(self, password):
+        """Hash `password` at the configured cost; returns a str."""
+
+        if not password:
+            raise ValueError('Password must be non-empty.')
+
+        salt = bcrypt.gensalt(self.rounds)
+        return self.run(bcrypt.hashpw, password.encode('utf-8'), salt).decode('utf-8')
+
+    def check(self, hashed, password):
+        """Does `password` match the stored `hashed`?"""
+
+        return self.run(bcrypt.checkpw, password.encode('utf-8'), hashed.encode('utf-8'))
+
+    def needs_rehash(self, hashed):
+        """Was `hashed` made with a different cost than the configured one?"""
+
+        # bcrypt hashes look like $2b$12$<salt and hash>
+        return int(hashed.split('$')[2]) != self.rounds
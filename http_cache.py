@@ -0,0 +1,101 @@
+"""Conditional GET (ETag / Last-Modified) for pages that rarely change.
+
+A view decorated with `@conditional(validators)` first calls
+`validators(**view_args)`, which should cost one or two small indexed
+queries. From their result it builds a weak ETag and a Last-Modified date,
+and answers `304 Not Modified` if the client already has that version,
+without running the view's queries or rendering its template.
+
+The cache policy for each endpoint comes from `app.config['CACHE_POLICIES']`;
+endpoints not listed there keep the app-wide no-cache headers.
+"""
+
+import hashlib
+from functools import wraps
+
+from flask import current_app, g, make_response, request, session
+
+DEFAULT_CACHE_POLICIES = {
+    'users_show': 'private, no-cache',
+    'show_following': 'private, no-cache',
+    'users_followers': 'private, no-cache',
+    'show_liked_message': 'private, no-cache',
+    'messages_show': 'private, no-cache',
+}
+
+
+def init_http_cache(app):
+    app.config.setdefault('CACHE_POLICIES', dict(DEFAULT_CACHE_POLICIES))
+
+
+def cache_policy():
+    """The Cache-Control value configured for this request's endpoint."""
+
+    return current_app.config['CACHE_POLICIES'].get(request.endpoint)
+
+
+def make_etag(*parts):
+    """Hash `parts` (anything with a stable repr) into an ETag value."""
+
+    return hashlib.blake2b(repr(parts).encode(), digest_size=12).hexdigest()
+
+
+def conditional(validators):
+    """Answer 304 when the client's copy of the page is still current.
+
+    `validators(**view_args)` returns `(parts, last_modified)`, where
+    `parts` is a tuple of whatever the page depends on (row versions,
+    counters, ...), or something false to skip straight to the view (e.g.
+    so it can 404). The viewer, their session version and the query string are
+    added to `parts` here, since every page shows the viewer's nav bar and
+    buttons. `last_modified` is None for a page that can change without
+    any timestamp moving; it is only revalidated by its ETag.
+    """
+
+    def decorator(view):
+        @wraps(view)
+        def wrapper(**kwargs):
+            # flashed messages are a one-off part of the page
+            if '_flashes' in session:
+                return view(**kwargs)
+
+            # a logged-in viewer without a version token (see
+            # `user_cache.CURR_USER_VERSION_KEY`) could have changed anything since
+            # the client cached the page
+            viewer = g.user.id if g.user else None
+            version = session.get('curr_user_version')
+            if viewer and not version:
+                return view(**kwargs)
+
+            found = validators(**kwargs)
+            if not found:
+                return view(**kwargs)
+
+            parts, last_modified = found
+            if g.user and last_modified:
+                # the viewer's own follows and likes show on every page
+                last_modified = max(last_modified, g.user.updated_at)
+            etag = make_etag(request.endpoint, request.query_string,
+                             viewer, version, *parts)
+
+            if request.if_none_match:
+                current = request.if_none_match.contains_weak(etag)
+            elif request.if_modified_since and last_modified:
+                current = (last_modified.replace(microsecond=0)
+                           <= request.if_modified_since.replace(tzinfo=None))
+            else:
+                current = False
+
+            if current:
+                response = make_response('', 304)
+            else:
+                response = make_response(view(**kwargs))
+
+            response.set_etag(etag, weak=True)
+            if last_modified:
+                response.last_modified = last_modified
+            return response
+
+        return wrapper
+
+    return decorator
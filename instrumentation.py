@@ -0,0 +1,178 @@
+"""Per-request SQL instrumentation.
+
+Counts statements, database time, rows and ORM objects loaded for each
+request, and reports them in a `Server-Timing` header and one JSON log line
+per request. Statements slower than `SLOW_QUERY_MS` are logged with their
+parameters and `EXPLAIN` output.
+
+It's cheap enough to leave on: each statement costs two `perf_counter()`
+calls and a few additions.
+"""
+
+import json
+import logging
+import time
+
+from flask import g, has_request_context, request
+from psycopg2.extensions import TRANSACTION_STATUS_INTRANS
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger('warbler.sql')
+
+
+class RequestStats:
+    """What one request has cost the database so far."""
+
+    __slots__ = ('queries', 'db_time', 'rows', 'objects', 'started')
+
+    def __init__(self):
+        self.queries = 0
+        self.db_time = 0.0
+        self.rows = 0
+        self.objects = 0
+        self.started = time.perf_counter()
+
+    def server_timing(self):
+        """Format as a Server-Timing header value."""
+
+        total = (time.perf_counter() - self.started) * 1000
+        return (f'db;dur={self.db_time * 1000:.2f};desc="{self.queries} queries", '
+                f'db-rows;desc="{self.rows}", '
+                f'orm;desc="{self.objects} objects", '
+                f'app;dur={total:.2f}')
+
+    def as_dict(self):
+        return {
+            'queries': self.queries,
+            'db_ms': round(self.db_time * 1000, 2),
+            'rows': self.rows,
+            'orm_objects': self.objects,
+            'total_ms': round((time.perf_counter() - self.started) * 1000, 2),
+        }
+
+
+def current_stats():
+    """Return this request's RequestStats, or None outside a request."""
+
+    if not has_request_context():
+        return None
+
+    stats = g.get('sql_stats')
+    if stats is None:
+        stats = g.sql_stats = RequestStats()
+    return stats
+
+
+def init_instrumentation(app, model_base):
+    """Start instrumenting every engine and every request of `app`.
+
+    `model_base` is the declarative base (`db.Model`) whose instances are
+    counted as they are loaded.
+    """
+
+    app.config.setdefault('SQL_INSTRUMENTATION', True)
+    app.config.setdefault('SLOW_QUERY_MS', 250)
+
+    if not app.config['SQL_INSTRUMENTATION']:
+        return
+
+    slow_query_seconds = float(app.config['SLOW_QUERY_MS']) / 1000
+
+    @event.listens_for(Engine, 'before_cursor_execute')
+    def start_timer(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+    @event.listens_for(Engine, 'after_cursor_execute')
+    def record_query(conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info['query_started'].pop()
+
+        stats = current_stats()
+        if stats is not None:
+            stats.queries += 1
+            stats.db_time += elapsed
+            if cursor.description is not None and cursor.rowcount > 0:
+                stats.rows += cursor.rowcount
+
+        if elapsed >= slow_query_seconds and not executemany:
+            # the statement as compiled, before any rewrite (e.g. into an
+            # EXECUTE of a prepared statement; see pooling.py), so it can be
+            # explained
+            if context is not None and context.statement:
+                statement = context.statement
+            log_slow_query(cursor, statement, parameters, elapsed)
+
+    @event.listens_for(Engine, 'handle_error')
+    def stop_timer(context):
+        # a failed statement never reaches after_cursor_execute; drop its
+        # start time so the next statement on the connection isn't timed
+        # from it
+        conn = context.connection
+        if conn is not None and conn.info.get('query_started'):
+            conn.info['query_started'].pop()
+
+    @event.listens_for(model_base, 'load', propagate=True)
+    def count_object(target, context):
+        stats = current_stats()
+        if stats is not None:
+            stats.objects += 1
+
+    @app.before_request
+    def start_request_stats():
+        g.sql_stats = RequestStats()
+
+    @app.after_request
+    def report_request_stats(response):
+        stats = current_stats()
+        response.headers['Server-Timing'] = stats.server_timing()
+
+        logger.info(json.dumps({
+            'method': request.method,
+            'path': request.path,
+            'endpoint': request.endpoint,
+            'status': response.status_code,
+            **stats.as_dict(),
+        }))
+        return response
+
+
+EXPLAINABLE = ('SELECT', 'INSERT', 'UPDATE', 'DELETE', 'WITH')
+
+
+def log_slow_query(cursor, statement, parameters, elapsed):
+    """Log a slow statement with its parameters and query plan."""
+
+    plan = None
+
+    if statement.lstrip().upper().startswith(EXPLAINABLE):
+        # a fresh DBAPI cursor on the same connection, so the EXPLAIN is
+        # neither counted nor timed by the hooks above; inside a
+        # transaction, the savepoint keeps a failed EXPLAIN from aborting
+        # it (outside one, in autocommit, there is nothing to abort, and
+        # SAVEPOINT would fail)
+        explain = cursor.connection.cursor()
+        savepoint = (cursor.connection.get_transaction_status()
+                     == TRANSACTION_STATUS_INTRANS)
+        try:
+            if savepoint:
+                explain.execute('SAVEPOINT explain_slow_query')
+            explain.execute('EXPLAIN ' + statement, parameters)
+            plan = '\n'.join(row[0] for row in explain.fetchall())
+            if savepoint:
+                explain.execute('RELEASE SAVEPOINT explain_slow_query')
+        except Exception as exc:
+            plan = f'(EXPLAIN failed: {exc})'
+            if savepoint:
+                try:
+                    explain.execute('ROLLBACK TO SAVEPOINT explain_slow_query')
+                except Exception:
+                    logger.exception('could not roll back a failed EXPLAIN')
+        finally:
+            explain.close()
+
+    logger.warning(json.dumps({
+        'slow_query_ms': round(elapsed * 1000, 2),
+        'statement': statement,
+        'parameters': repr(parameters),
+        'plan': plan,
+    }))
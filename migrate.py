@@ -0,0 +1,95 @@
+"""Apply the SQL migrations in migrations/ that haven't run yet.
+
+`db.create_all()` creates missing tables, with their indexes and
+triggers, but never changes tables that already exist; changes to those
+(new columns, indexes and triggers) are migrations, numbered files applied
+in order:
+
+    python migrate.py           # apply pending migrations
+    python migrate.py --list    # show which have been applied
+
+Statements run one at a time outside a transaction, so indexes can be
+built CONCURRENTLY without blocking writes. A migration that fails part
+way keeps the statements before the failure, so write them to be safe to
+run again (IF NOT EXISTS, IF EXISTS).
+"""
+
+import argparse
+import glob
+import os
+
+from app import db
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'migrations')
+
+
+def migrations():
+    """`(version, path)` for every migration file, in order."""
+
+    paths = sorted(glob.glob(os.path.join(MIGRATIONS_DIR, '*.sql')))
+    return [(os.path.basename(path)[:-len('.sql')], path) for path in paths]
+
+
+def statements(sql):
+    """Split a migration into statements, at semicolons ending a line
+    outside $$-quoted function bodies."""
+
+    pieces = []
+    for piece in sql.split(';\n'):
+        if pieces and pieces[-1].count('$$') % 2:
+            pieces[-1] += ';\n' + piece
+        else:
+            pieces.append(piece)
+
+    return [statement.strip() for statement in pieces
+            if statement.strip() and not all(
+                line.strip().startswith('--') or not line.strip()
+                for line in statement.splitlines())]
+
+
+def migrate(list_only=False):
+    db.create_all()
+
+    # a connection of its own, since autocommit shouldn't go back to the pool
+    conn = db.engine.raw_connection()
+    conn.detach()
+    conn.rollback()
+    conn.connection.autocommit = True
+    try:
+        cursor = conn.cursor()
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS schema_migrations (
+                version text PRIMARY KEY,
+                applied_at timestamp NOT NULL DEFAULT timezone('utc', now())
+            )
+        """)
+        cursor.execute('SELECT version, applied_at FROM schema_migrations')
+        applied = dict(cursor.fetchall())
+
+        for version, path in migrations():
+            if list_only:
+                print(f"{version}: {applied.get(version) or 'pending'}")
+                continue
+            if version in applied:
+                continue
+
+            print(f'applying {version}')
+            with open(path) as file:
+                for statement in statements(file.read()):
+                    cursor.execute(statement)
+            cursor.execute('INSERT INTO schema_migrations (version) VALUES (%s)', (version,))
+    finally:
+        conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--list', action='store_true',
+                        help='show applied and pending migrations, apply nothing')
+    args = parser.parse_args()
+
+    migrate(list_only=args.list)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,145 @@
+-- The columns, constraints and triggers that db.create_all() gives a new
+-- database but never adds to the original likes and users tables, which
+-- the later migrations' indexes rely on. Databases created by
+-- db.create_all() already have them, and skip all of this.
+--
+-- Needs PostgreSQL 14 (CREATE OR REPLACE TRIGGER). Rows that existed
+-- before have zero counters and no like counts until
+--
+--     python reconcile_counters.py
+--
+-- has been run, and likes made before get the migration's time as theirs.
+
+-- when a like was made; the likes page is ordered by it
+ALTER TABLE likes
+    ADD COLUMN IF NOT EXISTS timestamp timestamp NOT NULL DEFAULT timezone('utc', now());
+
+ALTER TABLE likes ALTER COLUMN timestamp DROP DEFAULT;
+
+-- a user likes a message once, rather than a message being liked once
+CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS uq_likes_user_id_message_id
+    ON likes (user_id, message_id);
+
+DO $$
+BEGIN
+    IF NOT EXISTS (SELECT FROM pg_constraint
+                    WHERE conname = 'uq_likes_user_id_message_id') THEN
+        ALTER TABLE likes ADD CONSTRAINT uq_likes_user_id_message_id
+            UNIQUE USING INDEX uq_likes_user_id_message_id;
+    END IF;
+END;
+$$;
+
+ALTER TABLE likes DROP CONSTRAINT IF EXISTS likes_message_id_key;
+
+-- full-text search over username, bio and location
+ALTER TABLE users
+    ADD COLUMN IF NOT EXISTS search_vector tsvector GENERATED ALWAYS AS (
+        to_tsvector('simple', coalesce(username, '') || ' ' ||
+                              coalesce(bio, '') || ' ' ||
+                              coalesce(location, ''))
+    ) STORED;
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_users_search_vector
+    ON users USING gin (search_vector);
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_users_username_lower
+    ON users ((lower(username) COLLATE "C"));
+
+-- row version, and the denormalized counters
+ALTER TABLE users
+    ADD COLUMN IF NOT EXISTS updated_at timestamp NOT NULL DEFAULT timezone('utc', now()),
+    ADD COLUMN IF NOT EXISTS messages_count integer NOT NULL DEFAULT 0,
+    ADD COLUMN IF NOT EXISTS following_count integer NOT NULL DEFAULT 0,
+    ADD COLUMN IF NOT EXISTS followers_count integer NOT NULL DEFAULT 0,
+    ADD COLUMN IF NOT EXISTS likes_count integer NOT NULL DEFAULT 0,
+    ADD COLUMN IF NOT EXISTS fanout_on_read boolean NOT NULL DEFAULT false;
+
+-- the triggers at the bottom of models.py
+
+CREATE OR REPLACE FUNCTION touch_updated_at() RETURNS trigger AS $$
+BEGIN
+    NEW.updated_at := timezone('utc', clock_timestamp());
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE TRIGGER users_updated_at
+BEFORE UPDATE ON users
+FOR EACH ROW EXECUTE FUNCTION touch_updated_at();
+
+CREATE OR REPLACE FUNCTION count_follows() RETURNS trigger AS $$
+DECLARE
+    pair follows;
+    step integer;
+BEGIN
+    IF TG_OP = 'INSERT' THEN pair := NEW; step := 1;
+    ELSE pair := OLD; step := -1;
+    END IF;
+
+    UPDATE users
+       SET following_count = following_count
+               + CASE WHEN id = pair.user_following_id THEN step ELSE 0 END,
+           followers_count = followers_count
+               + CASE WHEN id = pair.user_being_followed_id THEN step ELSE 0 END
+     WHERE id IN (pair.user_following_id, pair.user_being_followed_id);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE TRIGGER follows_counters
+AFTER INSERT OR DELETE ON follows
+FOR EACH ROW EXECUTE FUNCTION count_follows();
+
+CREATE OR REPLACE FUNCTION count_likes() RETURNS trigger AS $$
+BEGIN
+    IF current_setting('warbler.archiving', true) = 'on' THEN
+        RETURN NULL;
+    END IF;
+
+    IF TG_OP = 'INSERT' THEN
+        UPDATE users SET likes_count = likes_count + 1
+         WHERE id = NEW.user_id;
+
+        INSERT INTO message_like_counts (message_id, shard, count)
+        VALUES (NEW.message_id, floor(random() * 8), 1)
+        ON CONFLICT (message_id, shard)
+        DO UPDATE SET count = message_like_counts.count + 1;
+    ELSE
+        UPDATE users SET likes_count = likes_count - 1
+         WHERE id = OLD.user_id;
+
+        INSERT INTO message_like_counts (message_id, shard, count)
+        SELECT OLD.message_id, floor(random() * 8), -1
+         WHERE EXISTS (SELECT FROM messages WHERE id = OLD.message_id)
+        ON CONFLICT (message_id, shard)
+        DO UPDATE SET count = message_like_counts.count - 1;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE TRIGGER likes_counters
+AFTER INSERT OR DELETE ON likes
+FOR EACH ROW EXECUTE FUNCTION count_likes();
+
+CREATE OR REPLACE FUNCTION count_messages() RETURNS trigger AS $$
+BEGIN
+    IF current_setting('warbler.archiving', true) = 'on' THEN
+        RETURN NULL;
+    END IF;
+
+    IF TG_OP = 'INSERT' THEN
+        UPDATE users SET messages_count = messages_count + 1
+         WHERE id = NEW.user_id;
+    ELSE
+        UPDATE users SET messages_count = messages_count - 1
+         WHERE id = OLD.user_id;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE TRIGGER messages_counters
+AFTER INSERT OR DELETE ON messages
+FOR EACH ROW EXECUTE FUNCTION count_messages();
@@ -0,0 +1,26 @@
+-- Indexes for the hot queries: profile and home timelines, follow lists,
+-- likes, and like counts. Built CONCURRENTLY so writes carry on meanwhile.
+-- Databases created by db.create_all() already have them.
+
+-- a user's messages, newest first (profiles, timeline fallback)
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_messages_user_id_timestamp
+    ON messages (user_id, timestamp, id);
+
+-- who a user follows; the primary key only serves "who follows a user"
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_follows_user_following_id
+    ON follows (user_following_id, user_being_followed_id);
+
+-- a user's likes, most recent first
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_likes_user_id_timestamp
+    ON likes (user_id, timestamp, id);
+
+-- a message's likes (the unlike in Likes.toggle, cascades)
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_likes_message_id
+    ON likes (message_id);
+
+-- a stored home timeline in (timestamp, message_id) order; without
+-- message_id every page ended in a sort
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_timelines_user_id_timestamp_message_id
+    ON timelines (user_id, timestamp, message_id);
+
+DROP INDEX CONCURRENTLY IF EXISTS ix_timelines_user_id_timestamp;
@@ -0,0 +1,4 @@
+-- Soft-deleted accounts, purged in the background by a purge_user job.
+-- (The jobs table itself is new, so db.create_all() makes it.)
+
+ALTER TABLE users ADD COLUMN IF NOT EXISTS deleted_at timestamp;
@@ -0,0 +1,48 @@
+-- Archiving a message keeps its likes, in archived_likes (a new table, so
+-- db.create_all() makes it), and leaves the counters alone: both counter
+-- triggers skip rows moved while warbler.archiving is on.
+
+CREATE OR REPLACE FUNCTION count_likes() RETURNS trigger AS $$
+BEGIN
+    IF current_setting('warbler.archiving', true) = 'on' THEN
+        RETURN NULL;
+    END IF;
+
+    IF TG_OP = 'INSERT' THEN
+        UPDATE users SET likes_count = likes_count + 1
+         WHERE id = NEW.user_id;
+
+        INSERT INTO message_like_counts (message_id, shard, count)
+        VALUES (NEW.message_id, floor(random() * 8), 1)
+        ON CONFLICT (message_id, shard)
+        DO UPDATE SET count = message_like_counts.count + 1;
+    ELSE
+        UPDATE users SET likes_count = likes_count - 1
+         WHERE id = OLD.user_id;
+
+        INSERT INTO message_like_counts (message_id, shard, count)
+        SELECT OLD.message_id, floor(random() * 8), -1
+         WHERE EXISTS (SELECT FROM messages WHERE id = OLD.message_id)
+        ON CONFLICT (message_id, shard)
+        DO UPDATE SET count = message_like_counts.count - 1;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION count_messages() RETURNS trigger AS $$
+BEGIN
+    IF current_setting('warbler.archiving', true) = 'on' THEN
+        RETURN NULL;
+    END IF;
+
+    IF TG_OP = 'INSERT' THEN
+        UPDATE users SET messages_count = messages_count + 1
+         WHERE id = NEW.user_id;
+    ELSE
+        UPDATE users SET messages_count = messages_count - 1
+         WHERE id = OLD.user_id;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
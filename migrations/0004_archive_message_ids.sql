@@ -0,0 +1,8 @@
+-- Archived messages can be found by id, for their permalinks. Chunks
+-- archived before this have no ids recorded, and their messages 404.
+
+ALTER TABLE message_archive
+    ADD COLUMN IF NOT EXISTS message_ids integer[] NOT NULL DEFAULT '{}';
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_message_archive_message_ids
+    ON message_archive USING gin (message_ids);
@@ -0,0 +1,6 @@
+-- Deleting a message cascades to its timeline entries; without this each
+-- deleted message (messages_destroy, User.purge, MessageArchive.archive)
+-- scanned the whole timelines table.
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_timelines_message_id
+    ON timelines (message_id);
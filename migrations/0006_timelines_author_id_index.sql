@@ -0,0 +1,6 @@
+-- Deleting a user cascades to the timeline entries of their messages, and
+-- unfollowing (TimelineEntry.remove_author) drops one author's entries
+-- from one timeline; both looked them up with a scan of timelines.
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_timelines_author_id_user_id
+    ON timelines (author_id, user_id);
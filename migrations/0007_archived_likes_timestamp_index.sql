@@ -0,0 +1,6 @@
+-- The likes page merges in likes on archived messages, most recent first,
+-- a page at a time; without this it reads and sorts all of a user's
+-- archived likes.
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_archived_likes_user_id_timestamp
+    ON archived_likes (user_id, timestamp, message_id);
@@ -1,12 +1,45 @@
 """SQLAlchemy models for Warbler."""
 
-from datetime import datetime
+import json
+import re
+import zlib
+from datetime import datetime, timedelta
 
-from flask_bcrypt import Bcrypt
-from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import DDL, event
+from sqlalchemy.dialects.postgresql import ARRAY, JSONB, TSVECTOR, insert
+from sqlalchemy.orm.attributes import set_committed_value
+from werkzeug.exceptions import NotFound
 
-bcrypt = Bcrypt()
-db = SQLAlchemy()
+from hashing import PasswordHasher
+from pagination import PAGE_SIZE, Page, paginate, make_page
+from replicas import RoutingSQLAlchemy
+
+hasher = PasswordHasher()
+db = RoutingSQLAlchemy()
+
+SEARCH_PAGE_SIZE = 30
+DIRECTORY_PAGE_SIZE = 30
+
+# how many matches `User.search` ranks at most
+SEARCH_CANDIDATES = 1000
+
+# rows each message's like count is spread over; see `MessageLikeCount`
+LIKE_COUNT_SHARDS = 8
+
+# most messages stored in one `MessageArchive` row
+ARCHIVE_CHUNK_SIZE = 500
+
+# most messages one `MessageArchive.archive` call moves
+ARCHIVE_BATCH_SIZE = 2000
+
+# most rows one `User.purge` call deletes
+PURGE_BATCH_SIZE = 1000
+
+
+def escape_like(text):
+    """Escape LIKE wildcards in user input."""
+
+    return text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
 
 
 class Follows(db.Model):
@@ -26,6 +59,13 @@ class Follows(db.Model):
         primary_key=True,
     )
 
+    __table_args__ = (
+        # the primary key serves lookups by followed user; this one serves
+        # "who does this user follow" (timelines, following_count)
+        db.Index('ix_follows_user_following_id',
+                 'user_following_id', 'user_being_followed_id'),
+    )
+
 
 class Likes(db.Model):
     """Mapping user likes to warbles."""
@@ -45,9 +85,57 @@ class Likes(db.Model):
     message_id = db.Column(
         db.Integer,
         db.ForeignKey('messages.id', ondelete='cascade'),
-        unique=True
     )
 
+    # when the like was made; the likes page is ordered by it
+    timestamp = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+    __table_args__ = (
+        # each user likes a message at most once; also the index `toggle`
+        # deletes and conflicts on
+        db.UniqueConstraint('user_id', 'message_id',
+                            name='uq_likes_user_id_message_id'),
+        db.Index('ix_likes_user_id_timestamp', 'user_id', 'timestamp', 'id'),
+        # counting a message's likes, and the cascade when it is deleted
+        db.Index('ix_likes_message_id', 'message_id'),
+    )
+
+    @classmethod
+    def toggle(cls, user_id, message_id):
+        """Like `message_id` as `user_id`, or unlike it if already liked.
+
+        One statement against the (user_id, message_id) unique index, no
+        matter how many likes either side has. Returns True if the message
+        is now liked. Raises IntegrityError if the message doesn't exist.
+        """
+
+        inserted = db.session.execute(TOGGLE_LIKE, {
+            'user_id': user_id,
+            'message_id': message_id,
+        }).scalar()
+
+        return inserted is not None
+
+
+# delete the like if there is one, otherwise insert it; ON CONFLICT covers a
+# concurrent toggle inserting the same like first
+TOGGLE_LIKE = db.text("""
+    WITH removed AS (
+        DELETE FROM likes
+        WHERE user_id = :user_id AND message_id = :message_id
+        RETURNING id
+    )
+    INSERT INTO likes (user_id, message_id, timestamp)
+    SELECT :user_id, :message_id, timezone('utc', now())
+    WHERE NOT EXISTS (SELECT FROM removed)
+    ON CONFLICT (user_id, message_id) DO NOTHING
+    RETURNING id
+""")
+
 
 class User(db.Model):
     """User in the system."""
@@ -94,8 +182,78 @@ class User(db.Model):
         nullable=False,
     )
 
+    # username, bio and location for full-text search; generated by the
+    # database and deferred so it is never loaded with the user
+    search_vector = db.deferred(db.Column(
+        TSVECTOR,
+        db.Computed("to_tsvector('simple', "
+                    "coalesce(username, '') || ' ' || "
+                    "coalesce(bio, '') || ' ' || "
+                    "coalesce(location, ''))",
+                    persisted=True),
+    ))
+
+    # row version: set by the `users_updated_at` trigger on every change,
+    # including counter updates; used for ETags and Last-Modified
+    updated_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+        server_default=db.text("timezone('utc', now())"),
+    )
+
+    # denormalized counts, kept in step by the triggers at the bottom of
+    # this file; `User.reconcile_counters` rebuilds them if they drift
+    messages_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    following_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    followers_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    likes_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    # set once a user has too many followers to fan their messages out on
+    # write; see `TimelineEntry`
+    fanout_on_read = db.Column(
+        db.Boolean,
+        nullable=False,
+        default=False,
+        server_default=db.false(),
+    )
+
+    # set when the user deletes their account; a `purge_user` job then
+    # deletes their rows in the background (see `User.purge`)
+    deleted_at = db.Column(
+        db.DateTime,
+    )
+
     messages = db.relationship('Message')
 
+    __table_args__ = (
+        db.Index('ix_users_search_vector', 'search_vector',
+                 postgresql_using='gin'),
+    )
+
     followers = db.relationship(
         "User",
         secondary="follows",
@@ -121,14 +279,265 @@ class User(db.Model):
     def is_followed_by(self, other_user):
         """Is this user followed by `other_user`?"""
 
-        found_user_list = [user for user in self.followers if user == other_user]
-        return len(found_user_list) == 1
+        return db.session.query(
+            Follows.query
+            .filter(Follows.user_being_followed_id == self.id,
+                    Follows.user_following_id == other_user.id)
+            .exists()).scalar()
 
     def is_following(self, other_user):
         """Is this user following `other_use`?"""
 
-        found_user_list = [user for user in self.following if user == other_user]
-        return len(found_user_list) == 1
+        return db.session.query(
+            Follows.query
+            .filter(Follows.user_being_followed_id == other_user.id,
+                    Follows.user_following_id == self.id)
+            .exists()).scalar()
+
+    @classmethod
+    def visible_or_404(cls, user_id):
+        """Return user `user_id`, or raise NotFound if there is no such
+        user or they have deleted their account (and are waiting to be
+        purged)."""
+
+        user = cls.query.get(user_id)
+        if user is None or user.deleted_at:
+            raise NotFound()
+        return user
+
+    @classmethod
+    def lower_username(cls):
+        """`lower(username)`, spelled so it matches `ix_users_username_lower`."""
+
+        return db.func.lower(cls.username).collate('C')
+
+    @classmethod
+    def cards(cls):
+        """Query just the columns a user card shows, as plain rows, for
+        users who haven't deleted their accounts.
+
+        User lists render cards for many users at once; plain rows skip
+        loading passwords, hashes and everything else, and ORM bookkeeping.
+        """
+
+        return (db.session
+                .query(cls.id, cls.username, cls.image_url,
+                       cls.header_image_url, cls.bio)
+                .filter(cls.deleted_at.is_(None)))
+
+    @classmethod
+    def directory(cls, after=None, limit=DIRECTORY_PAGE_SIZE):
+        """Return a Page of user cards, in id order, after the id `after`."""
+
+        query = cls.cards()
+        if after:
+            query = query.filter(cls.id > after)
+
+        users = query.order_by(cls.id).limit(limit).all()
+
+        next_cursor = str(users[-1].id) if len(users) == limit else None
+        return Page(users, next_cursor)
+
+    @classmethod
+    def following_of(cls, user_id, after=None, limit=DIRECTORY_PAGE_SIZE):
+        """Return a Page of cards of the users `user_id` follows, in id
+        order, after the id `after`."""
+
+        return cls.related_cards(Follows.user_following_id,
+                                 Follows.user_being_followed_id,
+                                 user_id, after, limit)
+
+    @classmethod
+    def followers_of(cls, user_id, after=None, limit=DIRECTORY_PAGE_SIZE):
+        """Return a Page of cards of `user_id`'s followers, in id order,
+        after the id `after`."""
+
+        return cls.related_cards(Follows.user_being_followed_id,
+                                 Follows.user_following_id,
+                                 user_id, after, limit)
+
+    @classmethod
+    def related_cards(cls, owner, other, user_id, after, limit):
+        """Page through the `other` side of follows whose `owner` side is
+        `user_id`; ordering by `other` walks the (owner, other) index."""
+
+        query = (cls.cards()
+                 .join(Follows, other == cls.id)
+                 .filter(owner == user_id))
+        if after:
+            query = query.filter(other > after)
+
+        users = query.order_by(other).limit(limit).all()
+
+        next_cursor = str(users[-1].id) if len(users) == limit else None
+        return Page(users, next_cursor)
+
+    @classmethod
+    def search(cls, q, page=1, per_page=SEARCH_PAGE_SIZE):
+        """Search users by username, bio and location.
+
+        Every word of `q` is matched as a prefix, case-insensitively. Exact
+        username matches come first, then usernames starting with `q`, then
+        everything else by full-text rank.
+
+        Only the first SEARCH_CANDIDATES username and full-text matches are
+        ranked, so a very common word costs the same as a rare one.
+
+        Returns a list of user cards (see `cards`), one page at a time; an
+        empty list if `q` has no words in it.
+        """
+
+        words = re.findall(r'\w+', q.lower())
+        if not words:
+            return []
+
+        tsquery = db.func.to_tsquery('simple', ' & '.join(f'{w}:*' for w in words))
+        username = cls.lower_username()
+        q = q.strip().lower()
+        prefix = escape_like(q) + '%'
+
+        by_username = (db.session
+                       .query(cls.id.label('id'))
+                       .filter(username.like(prefix))
+                       .order_by(username)
+                       .limit(SEARCH_CANDIDATES))
+        by_text = (db.session
+                   .query(cls.id.label('id'))
+                   .filter(cls.search_vector.op('@@')(tsquery))
+                   .limit(SEARCH_CANDIDATES))
+        candidates = by_username.union(by_text).subquery()
+
+        first = db.case([(username == q, 0),
+                         (username.like(prefix), 1)],
+                        else_=2)
+
+        return (cls.cards()
+                .filter(cls.id.in_(db.session.query(candidates.c.id)))
+                .order_by(first,
+                          db.func.ts_rank(cls.search_vector, tsquery).desc(),
+                          cls.id)
+                .offset((page - 1) * per_page)
+                .limit(per_page)
+                .all())
+
+    @classmethod
+    def autocomplete(cls, prefix, limit=10):
+        """Return up to `limit` (id, username, image_url) rows for usernames
+        starting with `prefix`, case-insensitively, leaving out deleted
+        accounts.
+
+        Walks the `lower(username)` index and stops after `limit` rows, so it
+        is cheap enough to call on every keystroke.
+        """
+
+        prefix = prefix.strip().lower()
+        if not prefix:
+            return []
+
+        username = cls.lower_username()
+        return (db.session
+                .query(cls.id, cls.username, cls.image_url)
+                .filter(username.like(escape_like(prefix) + '%'),
+                        cls.deleted_at.is_(None))
+                .order_by(username)
+                .limit(limit)
+                .all())
+
+    @classmethod
+    def reconcile_counters(cls, user_ids=None):
+        """Recount messages, follows and likes for `user_ids` (or everyone).
+
+        The triggers keep the counters right as rows change; this is for
+        repairing them after bulk loads or anything else that went around
+        them.
+        """
+
+        def count(model, column):
+            return (db.session
+                    .query(db.func.count())
+                    .select_from(model)
+                    .filter(column == cls.id)
+                    .as_scalar())
+
+        archived = (db.session
+                    .query(db.func.coalesce(db.func.sum(MessageArchive.count), 0))
+                    .filter(MessageArchive.user_id == cls.id)
+                    .as_scalar())
+
+        query = cls.query
+        if user_ids is not None:
+            query = query.filter(cls.id.in_(user_ids))
+
+        query.update({
+            cls.messages_count: count(Message, Message.user_id) + archived,
+            cls.following_count: count(Follows, Follows.user_following_id),
+            cls.followers_count: count(Follows, Follows.user_being_followed_id),
+            cls.likes_count: count(Likes, Likes.user_id) + count(ArchivedLike,
+                                                                 ArchivedLike.user_id),
+        }, synchronize_session=False)
+
+    @classmethod
+    def purge(cls, user_id, batch_size=PURGE_BATCH_SIZE):
+        """Delete up to `batch_size` of a deleted user's rows.
+
+        Goes table by table, biggest first, so each call is one short
+        statement; the `ondelete` cascades take each message's likes and
+        timeline entries with it, and the counter triggers keep everyone
+        else's counts right. Once nothing else is left, deletes the user.
+        Returns True when the user is gone. The caller commits.
+        """
+
+        # likes on their archived messages have no cascade, or trigger, to
+        # take them off the likers' counts
+        deleted = db.session.execute("""
+            WITH gone AS (
+                DELETE FROM archived_likes WHERE ctid IN (
+                    SELECT ctid FROM archived_likes WHERE author_id = :user_id LIMIT :limit)
+                RETURNING user_id
+            )
+            UPDATE users SET likes_count = likes_count - gone.count
+            FROM (SELECT user_id, count(*) FROM gone GROUP BY user_id) AS gone
+            WHERE users.id = gone.user_id
+        """, {'user_id': user_id, 'limit': batch_size}).rowcount
+        if deleted:
+            return False
+
+        for table, column in (('messages', 'user_id'),
+                              ('message_archive', 'user_id'),
+                              ('likes', 'user_id'),
+                              ('archived_likes', 'user_id'),
+                              ('follows', 'user_following_id'),
+                              ('follows', 'user_being_followed_id'),
+                              ('timelines', 'user_id')):
+            deleted = db.session.execute(f"""
+                DELETE FROM {table} WHERE ctid IN (
+                    SELECT ctid FROM {table} WHERE {column} = :user_id LIMIT :limit)
+            """, {'user_id': user_id, 'limit': batch_size}).rowcount
+            if deleted:
+                return False
+
+        cls.query.filter(cls.id == user_id).delete(synchronize_session=False)
+        return True
+
+    @classmethod
+    def version(cls, user_id, related=None):
+        """Return `(count, latest updated_at)` over `user_id` and the users
+        selected by the `related` id query, for conditional GETs.
+
+        Touches one primary-key row per user and no messages, so it is far
+        cheaper than the page it stands in for. `count` is 0 if `user_id`
+        doesn't exist.
+        """
+
+        condition = cls.id == user_id
+        if related is not None:
+            # not `id = user_id OR id IN (...)`, which scans every user
+            condition = cls.id.in_(related.union_all(db.session.query(db.literal(user_id))))
+
+        return (db.session
+                .query(db.func.count(cls.id), db.func.max(cls.updated_at))
+                .filter(condition)
+                .one())
 
     @classmethod
     def signup(cls, username, email, password, image_url):
@@ -137,7 +546,7 @@ class User(db.Model):
         Hashes password and adds user to system.
         """
 
-        hashed_pwd = bcrypt.generate_password_hash(password).decode('UTF-8')
+        hashed_pwd = hasher.hash(password)
 
         user = User(
             username=username,
@@ -158,18 +567,64 @@ class User(db.Model):
         and, if it finds such a user, returns that user object.
 
         If can't find matching user (or if password is wrong), returns False.
+
+        If the stored hash was made at a different bcrypt cost than the one
+        configured now, it is replaced with a new hash at the current cost;
+        the caller commits it.
         """
 
-        user = cls.query.filter_by(username=username).first()
+        user = (cls.query
+                .filter_by(username=username, deleted_at=None)
+                .execution_options(prepare=True)
+                .first())
 
         if user:
-            is_auth = bcrypt.check_password_hash(user.password, password)
+            is_auth = hasher.check(user.password, password)
             if is_auth:
+                if hasher.needs_rehash(user.password):
+                    user.password = hasher.hash(password)
                 return user
 
         return False
 
 
+class FollowState:
+    """Which users a viewer follows, looked up in batches.
+
+    Lists of user cards call `resolve` with everyone on the page, which
+    answers for all of them in one query; `is_following` is then a set
+    lookup. Users that were not resolved up front are looked up on demand.
+    One of these lives on `g` for each request with a logged-in user.
+    """
+
+    def __init__(self, viewer):
+        self.viewer = viewer
+        self.resolved = set()
+        self.following = set()
+
+    def resolve(self, users):
+        """Look up the follow state for every user in `users` at once."""
+
+        user_ids = {user.id for user in users} - self.resolved
+        if not user_ids:
+            return
+
+        self.following.update(
+            id for (id,) in (db.session
+                             .query(Follows.user_being_followed_id)
+                             .filter(Follows.user_following_id == self.viewer.id,
+                                     Follows.user_being_followed_id.in_(user_ids))))
+        self.resolved.update(user_ids)
+
+    def is_following(self, user):
+        """Does the viewer follow `user`?"""
+
+        if user.id not in self.resolved:
+            self.resolve([user])
+
+        return user.id in self.following
+
+
 class Message(db.Model):
     """An individual message ("warble")."""
 
@@ -188,7 +643,7 @@ class Message(db.Model):
     timestamp = db.Column(
         db.DateTime,
         nullable=False,
-        default=datetime.utcnow(),
+        default=datetime.utcnow,
     )
 
     user_id = db.Column(
@@ -199,6 +654,985 @@ class Message(db.Model):
 
     user = db.relationship('User')
 
+    __table_args__ = (
+        db.Index('ix_messages_user_id_timestamp', 'user_id', 'timestamp', 'id'),
+    )
+
+    @classmethod
+    def with_author(cls):
+        """Query messages along with their authors, in the same SELECT,
+        leaving out those of deleted accounts.
+
+        Every message list shows the author's name and picture, so feeds
+        start from this rather than `Message.query` to avoid a lazy load
+        per author.
+        """
+
+        return (cls.query
+                .join(cls.user)
+                .options(db.contains_eager(cls.user))
+                .filter(User.deleted_at.is_(None)))
+
+    @classmethod
+    def for_user(cls, user_id, before=None, limit=PAGE_SIZE):
+        """Return a Page of `user_id`'s messages older than `before`."""
+
+        messages = paginate(cls.with_author().filter(cls.user_id == user_id),
+                            cls.timestamp, cls.id, before, limit).all()
+
+        # everything archived is older than everything still in `messages`;
+        # on a first page, the author's message count says if there is any
+        if len(messages) < limit and (before or cls.some_archived(user_id, len(messages))):
+            if messages:
+                before = (messages[-1].timestamp, messages[-1].id)
+            messages += MessageArchive.page(user_id, before, limit - len(messages))
+
+        return make_page(messages, limit, lambda msg: (msg.timestamp, msg.id))
+
+    @staticmethod
+    def some_archived(user_id, recent):
+        """Has `user_id` more messages than the `recent` ones not archived?"""
+
+        user = User.query.get(user_id)
+        return user is not None and user.messages_count > recent
+
+    @classmethod
+    def liked_keys(cls, user_id, before=None, limit=PAGE_SIZE):
+        """Return a subquery of one page of `user_id`'s likes, live and
+        archived, as `(timestamp, id, message_id, author_id)`, leaving out
+        messages whose authors deleted their accounts.
+
+        Each kind is read off its own index and the two merged. Archived
+        likes have no id of their own, so theirs is their message's.
+        """
+
+        live = paginate(db.session
+                        .query(Likes.timestamp.label('timestamp'),
+                               Likes.id.label('id'),
+                               Likes.message_id.label('message_id'),
+                               cls.user_id.label('author_id'))
+                        .join(cls, cls.id == Likes.message_id)
+                        .join(User, User.id == cls.user_id)
+                        .filter(Likes.user_id == user_id,
+                                User.deleted_at.is_(None)),
+                        Likes.timestamp, Likes.id, before, limit)
+        archived = paginate(db.session
+                            .query(ArchivedLike.timestamp.label('timestamp'),
+                                   ArchivedLike.message_id.label('id'),
+                                   ArchivedLike.message_id.label('message_id'),
+                                   ArchivedLike.author_id.label('author_id'))
+                            .join(User, User.id == ArchivedLike.author_id)
+                            .filter(ArchivedLike.user_id == user_id,
+                                    User.deleted_at.is_(None)),
+                            ArchivedLike.timestamp, ArchivedLike.message_id, before, limit)
+
+        return db.union_all(live.subquery().select(), archived.subquery().select()).alias()
+
+    @classmethod
+    def liked_by(cls, user_id, before=None, limit=PAGE_SIZE):
+        """Return a Page of messages `user_id` liked, most recent like first,
+        archived ones included.
+
+        The cursor is on the like, not the message.
+        """
+
+        liked = cls.liked_keys(user_id, before, limit)
+        rows = paginate(db.session
+                        .query(liked.c.timestamp, liked.c.id, liked.c.message_id, cls)
+                        .select_from(liked)
+                        # archived messages have no row, and are read below
+                        .outerjoin(cls, cls.id == liked.c.message_id)
+                        .outerjoin(cls.user)
+                        .options(db.contains_eager(cls.user)),
+                        liked.c.timestamp, liked.c.id, None, limit).all()
+
+        archived = MessageArchive.get_many(
+            [row.message_id for row in rows if row.Message is None])
+        messages = [row.Message or archived[row.message_id] for row in rows]
+
+        page = make_page(rows, limit, lambda row: (row.timestamp, row.id))
+        return page._replace(items=messages)
+
+
+class MessageLikeCount(db.Model):
+    """One shard of a message's like count.
+
+    The `likes_counters` trigger adds each like to a random one of
+    `LIKE_COUNT_SHARDS` rows, so a message being liked by many users at once
+    spreads the row locks instead of queueing on one. The count is the sum
+    of the shards.
+    """
+
+    __tablename__ = 'message_like_counts'
+
+    message_id = db.Column(
+        db.Integer,
+        db.ForeignKey('messages.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    shard = db.Column(
+        db.SmallInteger,
+        primary_key=True,
+    )
+
+    count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+    )
+
+    @classmethod
+    def totals(cls, message_ids):
+        """Return `{message_id: like count}` for `message_ids`, in one query.
+
+        Messages nobody likes are left out.
+        """
+
+        if not message_ids:
+            return {}
+
+        return dict(db.session
+                    .query(cls.message_id, db.func.sum(cls.count))
+                    .filter(cls.message_id.in_(message_ids))
+                    .group_by(cls.message_id))
+
+    @classmethod
+    def for_viewer(cls, user_id, message_ids):
+        """Return `(liked, totals)` for a page of `message_ids`, in one query.
+
+        `liked` is the set of them `user_id` likes, looked up on the likes
+        (user_id, message_id) index; `totals` is as for `totals`. Neither
+        depends on how many likes the viewer or the messages have.
+        """
+
+        if not message_ids:
+            return set(), {}
+
+        counts = (db.session
+                  .query(cls.message_id.label('message_id'),
+                         cls.count.label('count'),
+                         db.false().label('liked'))
+                  .filter(cls.message_id.in_(message_ids)))
+        mine = (db.session
+                .query(Likes.message_id, db.literal(0), db.true())
+                .filter(Likes.user_id == user_id,
+                        Likes.message_id.in_(message_ids)))
+        rows = counts.union_all(mine).subquery()
+
+        liked, totals = set(), {}
+        for message_id, total, is_liked in (db.session
+                .query(rows.c.message_id,
+                       db.func.sum(rows.c.count),
+                       db.func.bool_or(rows.c.liked))
+                .group_by(rows.c.message_id)):
+            if is_liked:
+                liked.add(message_id)
+            if total:
+                totals[message_id] = total
+
+        return liked, totals
+
+    @classmethod
+    def reconcile(cls, message_ids):
+        """Recount the likes of `message_ids` into a single shard each."""
+
+        cls.query.filter(cls.message_id.in_(message_ids)).delete(synchronize_session=False)
+
+        counts = (db.session
+                  .query(Likes.message_id, db.literal(0), db.func.count())
+                  .filter(Likes.message_id.in_(message_ids))
+                  .group_by(Likes.message_id))
+        db.session.execute(cls.__table__.insert().from_select(
+            ['message_id', 'shard', 'count'], counts))
+
+
+class MessageArchive(db.Model):
+    """Up to ARCHIVE_CHUNK_SIZE of one user's old messages, compressed.
+
+    `archive` moves messages older than a cutoff out of `messages`, so the
+    table (and its indexes, vacuuming and cache footprint) only holds
+    recent history. Each row is a run of one user's messages, consecutive
+    in (timestamp, id) order, as zlib-compressed JSON along with their
+    like counts at the time. Their timeline entries go with them; their
+    likes move to `ArchivedLike`, so the author's `messages_count` and
+    the likers' `likes_count` stay as they were.
+
+    Archived messages are read-only. They are listed on the author's
+    profile, past the end of their recent messages, and `get` finds one by
+    id for its permalink.
+    """
+
+    __tablename__ = 'message_archive'
+
+    id = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        nullable=False,
+    )
+
+    first_timestamp = db.Column(db.DateTime, nullable=False)
+    first_message_id = db.Column(db.Integer, nullable=False)
+    last_timestamp = db.Column(db.DateTime, nullable=False)
+    last_message_id = db.Column(db.Integer, nullable=False)
+
+    count = db.Column(
+        db.Integer,
+        nullable=False,
+    )
+
+    data = db.deferred(db.Column(
+        db.LargeBinary,
+        nullable=False,
+    ))
+
+    # the ids in `data`, so a message can be found by id
+    message_ids = db.Column(
+        ARRAY(db.Integer),
+        nullable=False,
+        server_default='{}',
+    )
+
+    __table_args__ = (
+        db.Index('ix_message_archive_user_id_last', 'user_id',
+                 'last_timestamp', 'last_message_id'),
+        db.Index('ix_message_archive_message_ids', 'message_ids',
+                 postgresql_using='gin'),
+    )
+
+    @classmethod
+    def archive(cls, before, after=None, limit=ARCHIVE_BATCH_SIZE):
+        """Move up to `limit` messages older than `before` into the archive.
+
+        Goes in (user_id, timestamp, id) order along the messages index,
+        starting after the `after` key, so however much one user has
+        posted, a call only holds `limit` messages. Returns `(moved, key)`,
+        with the key of the last message moved to pass back as `after`, or
+        `(0, None)` when there is nothing left. The caller commits.
+        """
+
+        query = (db.session
+                 .query(Message.id, Message.user_id, Message.timestamp, Message.text)
+                 .filter(Message.timestamp < before))
+        if after:
+            query = query.filter(
+                db.tuple_(Message.user_id, Message.timestamp, Message.id) > after)
+        messages = (query
+                    .order_by(Message.user_id, Message.timestamp, Message.id)
+                    .limit(limit)
+                    .all())
+        if not messages:
+            return 0, None
+
+        ids = [msg.id for msg in messages]
+        like_counts = MessageLikeCount.totals(ids)
+
+        authors = {msg.id: msg.user_id for msg in messages}
+        likes = (db.session
+                 .query(Likes.user_id, Likes.message_id, Likes.timestamp)
+                 .filter(Likes.message_id.in_(ids))
+                 .all())
+        if likes:
+            db.session.bulk_insert_mappings(ArchivedLike, [{
+                'user_id': like.user_id,
+                'message_id': like.message_id,
+                'author_id': authors[like.message_id],
+                'timestamp': like.timestamp,
+            } for like in likes])
+
+        chunks = []
+        for msg in messages:
+            if (not chunks or chunks[-1][-1].user_id != msg.user_id
+                    or len(chunks[-1]) == ARCHIVE_CHUNK_SIZE):
+                chunks.append([])
+            chunks[-1].append(msg)
+
+        db.session.bulk_insert_mappings(cls, [{
+            'user_id': chunk[0].user_id,
+            'first_timestamp': chunk[0].timestamp,
+            'first_message_id': chunk[0].id,
+            'last_timestamp': chunk[-1].timestamp,
+            'last_message_id': chunk[-1].id,
+            'count': len(chunk),
+            'message_ids': [msg.id for msg in chunk],
+            'data': zlib.compress(json.dumps([
+                [msg.id, msg.timestamp.isoformat(), msg.text, like_counts.get(msg.id, 0)]
+                for msg in chunk
+            ]).encode()),
+        } for chunk in chunks])
+
+        # these are moved, not deleted, so the messages_counters and
+        # likes_counters triggers leave the authors' and likers' counts alone
+        db.session.execute("SET LOCAL warbler.archiving = 'on'")
+        Message.query.filter(Message.id.in_(ids)).delete(synchronize_session=False)
+        db.session.execute("SET LOCAL warbler.archiving = 'off'")
+
+        last = messages[-1]
+        return len(ids), (last.user_id, last.timestamp, last.id)
+
+    @classmethod
+    def get(cls, message_id):
+        """Return archived message `message_id` as a detached Message, or
+        None if there is none or its author deleted their account."""
+
+        return cls.get_many([message_id]).get(message_id)
+
+    @classmethod
+    def get_many(cls, message_ids):
+        """Return `{id: detached Message}` for the archived ones among
+        `message_ids`, leaving out those whose authors deleted their
+        accounts; one query for the chunks however many there are."""
+
+        if not message_ids:
+            return {}
+
+        chunks = (cls.query
+                  .options(db.undefer(cls.data))
+                  .filter(cls.message_ids.overlap(message_ids))
+                  .all())
+
+        wanted = set(message_ids)
+        messages = {}
+        for chunk in chunks:
+            author = User.query.get(chunk.user_id)
+            if author.deleted_at:
+                continue
+
+            for msg_id, timestamp, text, likes in json.loads(zlib.decompress(chunk.data)):
+                if msg_id in wanted:
+                    msg = Message(id=msg_id, text=text, user_id=chunk.user_id,
+                                  timestamp=datetime.fromisoformat(timestamp))
+                    set_committed_value(msg, 'user', author)
+                    messages[msg_id] = msg
+
+        return messages
+
+    @classmethod
+    def page(cls, user_id, before=None, limit=PAGE_SIZE):
+        """Return up to `limit` of `user_id`'s archived messages older than
+        `before`, newest first, as detached Messages.
+
+        Reads chunk sizes first, then decompresses only the chunks the page
+        needs: at most one per message returned, usually one or two.
+        """
+
+        query = cls.query.filter(cls.user_id == user_id)
+        if before:
+            query = query.filter(db.tuple_(cls.first_timestamp, cls.first_message_id) < before)
+
+        chunks = (query
+                  .with_entities(cls.id, cls.count)
+                  .order_by(cls.last_timestamp.desc(), cls.last_message_id.desc())
+                  .limit(limit)
+                  .all())
+
+        # the newest chunk may be partly newer than `before`, so it only
+        # counts towards the page with the ones after it
+        needed = []
+        for chunk in chunks:
+            needed.append(chunk.id)
+            if sum(c.count for c in chunks[1:len(needed)]) >= limit:
+                break
+        if not needed:
+            return []
+
+        data = dict(db.session.query(cls.id, cls.data).filter(cls.id.in_(needed)))
+        user = User.query.get(user_id)
+
+        messages = []
+        for chunk_id in needed:
+            for msg_id, timestamp, text, likes in reversed(json.loads(zlib.decompress(data[chunk_id]))):
+                timestamp = datetime.fromisoformat(timestamp)
+                if before and (timestamp, msg_id) >= tuple(before):
+                    continue
+
+                msg = Message(id=msg_id, text=text, timestamp=timestamp, user_id=user_id)
+                set_committed_value(msg, 'user', user)
+                messages.append(msg)
+                if len(messages) == limit:
+                    return messages
+
+        return messages
+
+
+class ArchivedLike(db.Model):
+    """A like on a message that has been moved to `MessageArchive`.
+
+    Kept so archiving doesn't take likes away from anyone: `likes_count`
+    counts these too. `author_id` is the message's author, so purging them
+    can find the likes on their archived messages.
+    """
+
+    __tablename__ = 'archived_likes'
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    # the message is only in message_archive, so no foreign key
+    message_id = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    author_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        nullable=False,
+        index=True,
+    )
+
+    timestamp = db.Column(
+        db.DateTime,
+        nullable=False,
+    )
+
+    __table_args__ = (
+        # the archived half of the likes page (see Message.liked_keys)
+        db.Index('ix_archived_likes_user_id_timestamp',
+                 'user_id', 'timestamp', 'message_id'),
+    )
+
+
+class TimelineEntry(db.Model):
+    """A message materialized into one user's home timeline.
+
+    Rows are written when a message is posted (fan-out-on-write), so reading
+    the home page is a single bounded lookup on `user_id`. Authors with more
+    than `FANOUT_LIMIT` followers are not fanned out; their messages are
+    merged in at read time instead (fan-out-on-read).
+    """
+
+    __tablename__ = 'timelines'
+
+    # how many entries we keep per user; older pages fall back to querying
+    # `messages` directly
+    MAX_ENTRIES = 800
+
+    # authors with more followers than this are read, not written
+    FANOUT_LIMIT = 10000
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    message_id = db.Column(
+        db.Integer,
+        db.ForeignKey('messages.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    author_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        nullable=False,
+    )
+
+    # copied from the message so the timeline can be read in order
+    # without touching `messages`
+    timestamp = db.Column(
+        db.DateTime,
+        nullable=False,
+    )
+
+    __table_args__ = (
+        db.Index('ix_timelines_user_id_timestamp_message_id',
+                 'user_id', 'timestamp', 'message_id'),
+        # the cascades when a message or its author is deleted, and
+        # `remove_author`; without them each one scans the whole table
+        db.Index('ix_timelines_message_id', 'message_id'),
+        db.Index('ix_timelines_author_id_user_id', 'author_id', 'user_id'),
+    )
+
+    @classmethod
+    def fan_out(cls, message, followers=True):
+        """Push a newly posted `message` into its readers' timelines.
+
+        The author always gets it. Followers only get it if the author is
+        below `FANOUT_LIMIT`; otherwise they pick it up at read time. Pass
+        `followers=False` to do just the author, leaving the rest to a
+        `fan_out` job. Safe to repeat.
+        """
+
+        author = message.user or User.query.get(message.user_id)
+        readers = db.session.query(db.literal(message.user_id).label('user_id'))
+
+        if followers and not author.fanout_on_read:
+            readers = readers.union_all(
+                db.session
+                .query(Follows.user_following_id)
+                .filter(Follows.user_being_followed_id == message.user_id))
+
+        readers = readers.subquery()
+        rows = db.session.query(readers.c.user_id,
+                                db.literal(message.id),
+                                db.literal(message.user_id),
+                                db.literal(message.timestamp))
+
+        db.session.execute(
+            insert(cls.__table__).from_select(
+                ['user_id', 'message_id', 'author_id', 'timestamp'],
+                rows).on_conflict_do_nothing())
+
+        cls.trim(db.session.query(readers.c.user_id))
+
+    @classmethod
+    def publish(cls, message):
+        """Fan out a just-posted `message`: into the author's own timeline
+        now, and their followers' by a `fan_out` job."""
+
+        cls.fan_out(message, followers=False)
+        Job.enqueue('fan_out', key=f'fan_out:{message.id}', message_id=message.id)
+
+    @classmethod
+    def backfill(cls, follower_id, followed_id):
+        """Copy `followed_id`'s recent messages into `follower_id`'s timeline.
+
+        Called when a new follow is made. Also flips the followed user to
+        fan-out-on-read once they cross `FANOUT_LIMIT` followers.
+        """
+
+        followed = User.query.get(followed_id)
+
+        if not followed.fanout_on_read:
+            # read fresh: the follow may have just been flushed
+            followers = (db.session
+                         .query(User.followers_count)
+                         .filter(User.id == followed_id)
+                         .scalar())
+            if followers > cls.FANOUT_LIMIT:
+                followed.fanout_on_read = True
+
+        if followed.fanout_on_read:
+            return
+
+        recent = (db.session
+                  .query(db.literal(follower_id),
+                         Message.id,
+                         Message.user_id,
+                         Message.timestamp)
+                  .filter(Message.user_id == followed_id)
+                  .order_by(Message.timestamp.desc(), Message.id.desc())
+                  .limit(cls.MAX_ENTRIES))
+
+        # some may be there already, e.g. ones fanned out while the follow
+        # was being made
+        db.session.execute(
+            insert(cls.__table__).from_select(
+                ['user_id', 'message_id', 'author_id', 'timestamp'],
+                recent).on_conflict_do_nothing())
+
+        cls.trim(db.session.query(db.literal(follower_id)))
+
+    @classmethod
+    def remove_author(cls, follower_id, followed_id):
+        """Drop `followed_id`'s messages from `follower_id`'s timeline."""
+
+        (cls.query
+         .filter(cls.user_id == follower_id, cls.author_id == followed_id)
+         .delete(synchronize_session=False))
+
+    @classmethod
+    def rebuild(cls, user_id):
+        """Recreate `user_id`'s timeline from scratch.
+
+        Used after bulk loads (e.g. `seed.py`) that bypass `fan_out`.
+        """
+
+        cls.query.filter(cls.user_id == user_id).delete(
+            synchronize_session=False)
+
+        authors = (db.session
+                   .query(Follows.user_being_followed_id)
+                   .join(User, User.id == Follows.user_being_followed_id)
+                   .filter(Follows.user_following_id == user_id,
+                           User.fanout_on_read.is_(False))
+                   .union_all(db.session.query(db.literal(user_id))))
+
+        recent = (db.session
+                  .query(db.literal(user_id),
+                         Message.id,
+                         Message.user_id,
+                         Message.timestamp)
+                  .filter(Message.user_id.in_(authors))
+                  .order_by(Message.timestamp.desc(), Message.id.desc())
+                  .limit(cls.MAX_ENTRIES))
+
+        db.session.execute(
+            cls.__table__.insert().from_select(
+                ['user_id', 'message_id', 'author_id', 'timestamp'],
+                recent))
+
+    @classmethod
+    def trim(cls, readers):
+        """Cut the timelines of `readers` (a query of user ids) to size."""
+
+        ranked = (db.session
+                  .query(cls.user_id,
+                         cls.message_id,
+                         db.func.row_number().over(
+                             partition_by=cls.user_id,
+                             order_by=(cls.timestamp.desc(),
+                                       cls.message_id.desc()),
+                         ).label('position'))
+                  .filter(cls.user_id.in_(readers))
+                  .subquery())
+
+        overflow = (db.session
+                    .query(ranked.c.user_id, ranked.c.message_id)
+                    .filter(ranked.c.position > cls.MAX_ENTRIES))
+
+        (cls.query
+         .filter(db.tuple_(cls.user_id, cls.message_id).in_(overflow))
+         .delete(synchronize_session=False))
+
+    @classmethod
+    def home_timeline(cls, user, before=None, limit=PAGE_SIZE):
+        """Return a Page of `user`'s home timeline older than `before`.
+
+        Reads the materialized timeline and merges in messages from any
+        followed authors who are served fan-out-on-read. Pages past the
+        end of the stored timeline are read from `messages` directly.
+        Authors who deleted their accounts are left out, though their
+        entries stay until they are purged.
+        """
+
+        query = (Message
+                 .with_author()
+                 .join(cls, cls.message_id == Message.id)
+                 .filter(cls.user_id == user.id)
+                 .execution_options(prepare=True))
+        messages = paginate(query, cls.timestamp, cls.message_id,
+                            before, limit).all()
+
+        # there are only ever a handful of these authors, so look them up
+        # first and then check which ones `user` follows by primary key
+        big_authors = (db.session
+                       .query(User.id)
+                       .filter(User.fanout_on_read.is_(True)))
+        followed = (db.session
+                    .query(Follows.user_being_followed_id)
+                    .filter(Follows.user_following_id == user.id))
+
+        if len(messages) < limit:
+            # the page runs past the stored timeline, and reading on from
+            # `messages` below needs every author `user` follows anyway
+            authors = (followed
+                       .join(User, User.id == Follows.user_being_followed_id)
+                       .filter(User.deleted_at.is_(None))
+                       .add_columns(User.fanout_on_read)
+                       .all())
+            followed_big_authors = [(id,) for id, big in authors if big]
+        else:
+            followed_big_authors = followed.filter(
+                Follows.user_being_followed_id.in_(big_authors)).all()
+
+        # one query per author reads each straight off its index, where
+        # one query for all of them would have to sort their messages
+        pulled = []
+        for (author_id,) in followed_big_authors:
+            pulled += paginate(Message.with_author().filter(Message.user_id == author_id),
+                               Message.timestamp, Message.id, before, limit).all()
+
+        if pulled:
+            merged = {msg.id: msg for msg in messages + pulled}
+            messages = sorted(merged.values(),
+                              key=lambda msg: (msg.timestamp, msg.id),
+                              reverse=True)[:limit]
+
+        if len(messages) < limit:
+            if messages:
+                before = (messages[-1].timestamp, messages[-1].id)
+
+            # a page per author, UNION ALLed: the database merges them as
+            # it reads each off its index, where `user_id IN (...)` would
+            # fetch every older message of every author and sort them
+            by_author = [paginate(Message.query.filter(Message.user_id == author_id),
+                                  Message.timestamp, Message.id,
+                                  before, limit - len(messages))
+                         for author_id in [user.id] + [id for id, big in authors]]
+            older = paginate(by_author[0].union_all(*by_author[1:])
+                             .options(db.joinedload(Message.user)),
+                             Message.timestamp, Message.id,
+                             None, limit - len(messages)).all()
+            messages += older
+
+        return make_page(messages, limit, lambda msg: (msg.timestamp, msg.id))
+
+
+class Job(db.Model):
+    """A unit of background work, run by `worker.py`.
+
+    Requests enqueue jobs in their own transaction, so a job exists if and
+    only if the change that needs it was committed. Workers claim jobs with
+    `FOR UPDATE SKIP LOCKED`, so any number can run side by side. A job
+    whose handler raises is retried with exponential backoff, up to
+    `max_attempts`; one whose worker died is claimed again once its lease
+    runs out. Handlers must be safe to run more than once.
+
+    Jobs with a `key` are only enqueued if no job with the same key is
+    still waiting or running. Jobs that finish are deleted, so the table
+    only holds pending and failed work.
+    """
+
+    __tablename__ = 'jobs'
+
+    # seconds a worker may hold a job before others may take it over
+    LEASE = 300
+
+    id = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    kind = db.Column(
+        db.String(50),
+        nullable=False,
+    )
+
+    payload = db.Column(
+        JSONB,
+        nullable=False,
+        default=dict,
+    )
+
+    key = db.Column(
+        db.Text,
+    )
+
+    # queued, running or failed; finished jobs are deleted
+    status = db.Column(
+        db.String(10),
+        nullable=False,
+        default='queued',
+    )
+
+    attempts = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+    )
+
+    max_attempts = db.Column(
+        db.Integer,
+        nullable=False,
+        default=5,
+    )
+
+    run_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+    locked_at = db.Column(
+        db.DateTime,
+    )
+
+    last_error = db.Column(
+        db.Text,
+    )
+
+    __table_args__ = (
+        db.Index('ix_jobs_run_at', 'run_at',
+                 postgresql_where=db.text("status = 'queued'")),
+        db.Index('ix_jobs_locked_at', 'locked_at',
+                 postgresql_where=db.text("status = 'running'")),
+        db.Index('uq_jobs_pending_key', 'key', unique=True,
+                 postgresql_where=db.text("status IN ('queued', 'running')")),
+    )
+
+    @classmethod
+    def enqueue(cls, kind, key=None, **payload):
+        """Queue a `kind` job with `payload`, unless `key` is already
+        pending. The caller commits."""
+
+        db.session.execute(
+            insert(cls.__table__)
+            .values(kind=kind, key=key, payload=payload, status='queued',
+                    attempts=0, max_attempts=5, run_at=datetime.utcnow())
+            .on_conflict_do_nothing(
+                index_elements=['key'],
+                index_where=db.text("status IN ('queued', 'running')")))
+
+    @classmethod
+    def claim(cls, limit=10):
+        """Mark up to `limit` due jobs as running and return them, as rows
+        of (id, kind, payload, attempts, max_attempts)."""
+
+        return db.session.execute("""
+            UPDATE jobs
+               SET status = 'running', locked_at = timezone('utc', now()),
+                   attempts = attempts + 1
+             WHERE id IN (
+                 SELECT id FROM jobs
+                  WHERE status = 'queued' AND run_at <= timezone('utc', now())
+                     OR status = 'running'
+                        AND locked_at < timezone('utc', now()) - make_interval(secs => :lease)
+                  ORDER BY run_at
+                  LIMIT :limit
+                    FOR UPDATE SKIP LOCKED)
+            RETURNING id, kind, payload, attempts, max_attempts
+        """, {'limit': limit, 'lease': cls.LEASE}).fetchall()
+
+    @classmethod
+    def finish(cls, job_id):
+        """Delete a job that has run; only failed jobs are kept, for
+        looking into."""
+
+        cls.query.filter(cls.id == job_id).delete(synchronize_session=False)
+
+    @classmethod
+    def again(cls, job_id):
+        """Requeue a job that has more to do, to run again right away."""
+
+        cls.query.filter(cls.id == job_id).update(
+            {'status': 'queued', 'attempts': 0, 'locked_at': None,
+             'run_at': datetime.utcnow()}, synchronize_session=False)
+
+    @classmethod
+    def fail(cls, job, error):
+        """Retry `job` after 2 ** attempts seconds, or give up on it."""
+
+        if job.attempts >= job.max_attempts:
+            values = {'status': 'failed'}
+        else:
+            values = {'status': 'queued',
+                      'run_at': datetime.utcnow() + timedelta(seconds=2 ** job.attempts)}
+
+        values.update(locked_at=None, last_error=error)
+        cls.query.filter(cls.id == job.id).update(values, synchronize_session=False)
+
+
+##############################################################################
+# Counter triggers
+#
+# Every insert or delete on follows, likes and messages adjusts the matching
+# counters on users in the same transaction. Doing it in the database means
+# relationship appends, bulk inserts and ondelete cascades are all counted.
+
+COUNTER_TRIGGERS = {
+    Follows.__table__: """
+        CREATE OR REPLACE FUNCTION count_follows() RETURNS trigger AS $$
+        DECLARE
+            pair follows;
+            step integer;
+        BEGIN
+            IF TG_OP = 'INSERT' THEN pair := NEW; step := 1;
+            ELSE pair := OLD; step := -1;
+            END IF;
+
+            -- one statement, so both rows are locked in a single pass
+            UPDATE users
+               SET following_count = following_count
+                       + CASE WHEN id = pair.user_following_id THEN step ELSE 0 END,
+                   followers_count = followers_count
+                       + CASE WHEN id = pair.user_being_followed_id THEN step ELSE 0 END
+             WHERE id IN (pair.user_following_id, pair.user_being_followed_id);
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+
+        CREATE TRIGGER follows_counters
+        AFTER INSERT OR DELETE ON follows
+        FOR EACH ROW EXECUTE FUNCTION count_follows();
+    """,
+    Likes.__table__: f"""
+        CREATE OR REPLACE FUNCTION count_likes() RETURNS trigger AS $$
+        BEGIN
+            -- moving likes into archived_likes; see MessageArchive
+            IF current_setting('warbler.archiving', true) = 'on' THEN
+                RETURN NULL;
+            END IF;
+
+            IF TG_OP = 'INSERT' THEN
+                UPDATE users SET likes_count = likes_count + 1
+                 WHERE id = NEW.user_id;
+
+                INSERT INTO message_like_counts (message_id, shard, count)
+                VALUES (NEW.message_id, floor(random() * {LIKE_COUNT_SHARDS}), 1)
+                ON CONFLICT (message_id, shard)
+                DO UPDATE SET count = message_like_counts.count + 1;
+            ELSE
+                UPDATE users SET likes_count = likes_count - 1
+                 WHERE id = OLD.user_id;
+
+                -- skipped when the like goes because its message did; the
+                -- message's counts are cascaded away with it
+                INSERT INTO message_like_counts (message_id, shard, count)
+                SELECT OLD.message_id, floor(random() * {LIKE_COUNT_SHARDS}), -1
+                 WHERE EXISTS (SELECT FROM messages WHERE id = OLD.message_id)
+                ON CONFLICT (message_id, shard)
+                DO UPDATE SET count = message_like_counts.count - 1;
+            END IF;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+
+        CREATE TRIGGER likes_counters
+        AFTER INSERT OR DELETE ON likes
+        FOR EACH ROW EXECUTE FUNCTION count_likes();
+    """,
+    Message.__table__: """
+        CREATE OR REPLACE FUNCTION count_messages() RETURNS trigger AS $$
+        BEGIN
+            -- moving messages into message_archive; see MessageArchive
+            IF current_setting('warbler.archiving', true) = 'on' THEN
+                RETURN NULL;
+            END IF;
+
+            IF TG_OP = 'INSERT' THEN
+                UPDATE users SET messages_count = messages_count + 1
+                 WHERE id = NEW.user_id;
+            ELSE
+                UPDATE users SET messages_count = messages_count - 1
+                 WHERE id = OLD.user_id;
+            END IF;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+
+        CREATE TRIGGER messages_counters
+        AFTER INSERT OR DELETE ON messages
+        FOR EACH ROW EXECUTE FUNCTION count_messages();
+    """,
+}
+
+for table, ddl in COUNTER_TRIGGERS.items():
+    event.listen(table, 'after_create', DDL(ddl).execute_if(dialect='postgresql'))
+
+# any change to a user row, from the ORM or the counter triggers above,
+# moves its `updated_at` forward
+event.listen(User.__table__, 'after_create', DDL("""
+    CREATE OR REPLACE FUNCTION touch_updated_at() RETURNS trigger AS $$
+    BEGIN
+        NEW.updated_at := timezone('utc', clock_timestamp());
+        RETURN NEW;
+    END;
+    $$ LANGUAGE plpgsql;
+
+    CREATE TRIGGER users_updated_at
+    BEFORE UPDATE ON users
+    FOR EACH ROW EXECUTE FUNCTION touch_updated_at();
+""").execute_if(dialect='postgresql'))
+
+# prefix and exact username lookups for search and autocomplete; the "C"
+# collation lets both LIKE 'abc%' and ORDER BY use the index under any
+# database locale (see `User.lower_username`)
+event.listen(User.__table__, 'after_create', DDL("""
+    CREATE INDEX ix_users_username_lower
+    ON users ((lower(username) COLLATE "C"))
+""").execute_if(dialect='postgresql'))
+
 
 def connect_db(app):
     """Connect this database to provided Flask app.
@@ -0,0 +1,63 @@
+"""Keyset ("cursor") pagination for message feeds.
+
+Every feed is ordered newest first on a `(timestamp, id)` pair backed by an
+index, and the next page is fetched by asking for rows strictly older than
+the last row already shown. Unlike OFFSET, that costs the same no matter
+how far someone has scrolled.
+"""
+
+from collections import namedtuple
+from datetime import datetime
+
+from sqlalchemy import tuple_
+
+PAGE_SIZE = 100
+
+CURSOR_FORMAT = '%Y%m%d%H%M%S%f'
+
+Page = namedtuple('Page', ['items', 'next_cursor'])
+
+
+def encode_cursor(timestamp, id):
+    """Turn the `(timestamp, id)` of the last row shown into a cursor."""
+
+    return f"{timestamp.strftime(CURSOR_FORMAT)}-{id}"
+
+
+def decode_cursor(cursor):
+    """Turn a cursor back into `(timestamp, id)`.
+
+    Returns None for a missing or malformed cursor, which callers treat as
+    "start from the newest row".
+    """
+
+    if not cursor:
+        return None
+
+    try:
+        timestamp, id = cursor.split('-')
+        return datetime.strptime(timestamp, CURSOR_FORMAT), int(id)
+    except ValueError:
+        return None
+
+
+def paginate(query, timestamp_col, id_col, before=None, limit=PAGE_SIZE):
+    """Limit `query` to one page of rows older than the `before` key."""
+
+    if before:
+        query = query.filter(tuple_(timestamp_col, id_col) < before)
+
+    return query.order_by(timestamp_col.desc(), id_col.desc()).limit(limit)
+
+
+def make_page(items, limit, key):
+    """Wrap `items` in a Page, with a cursor if there may be more.
+
+    `key` maps the last item to the `(timestamp, id)` it was ordered by.
+    """
+
+    next_cursor = None
+    if items and len(items) >= limit:
+        next_cursor = encode_cursor(*key(items[-1]))
+
+    return Page(items, next_cursor)
@@ -0,0 +1,158 @@
+"""Connection pool settings, pool statistics and prepared statements.
+
+Pool settings come from the environment, so each deployment can size its
+pool without code changes:
+
+    DB_POOL_SIZE        connections kept open (5)
+    DB_MAX_OVERFLOW     extra connections allowed under load (10)
+    DB_POOL_TIMEOUT     seconds to wait for a free connection (30)
+    DB_POOL_RECYCLE     seconds before a connection is replaced (1800)
+    DB_POOL_PRE_PING    check connections before use (1)
+    DB_POOL_MODE        "session" (default), or "pgbouncer" when connecting
+                        through PgBouncer in transaction pooling mode
+
+Every pool counts checkouts, time spent waiting for a connection, checkout
+timeouts and failed connects; `pool_stats()` reports them along with the
+pool's current size, checked-out connections and overflow.
+
+Queries run with `execution_options(prepare=True)` become server-side
+prepared statements: the first run on each connection PREPAREs the SQL,
+and every later run only sends `EXECUTE name(params)`, skipping parsing
+and planning. Prepared statements belong to a server session, which
+PgBouncer's transaction mode does not keep, so that mode turns them off.
+"""
+
+import hashlib
+import re
+import time
+from threading import Lock
+
+from sqlalchemy import event, exc
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import QueuePool
+
+# psycopg2's named placeholders, and its escaped percent signs
+PLACEHOLDER = re.compile(r'%\((\w+)\)s|%%')
+
+
+def engine_options(environ):
+    """SQLALCHEMY_ENGINE_OPTIONS for the settings in `environ`."""
+
+    return {
+        'poolclass': StatsQueuePool,
+        'pool_size': int(environ.get('DB_POOL_SIZE', 5)),
+        'max_overflow': int(environ.get('DB_MAX_OVERFLOW', 10)),
+        'pool_timeout': float(environ.get('DB_POOL_TIMEOUT', 30)),
+        'pool_recycle': int(environ.get('DB_POOL_RECYCLE', 1800)),
+        'pool_pre_ping': environ.get('DB_POOL_PRE_PING', '1') not in ('0', 'false', ''),
+    }
+
+
+class StatsQueuePool(QueuePool):
+    """A QueuePool that keeps count of what checkouts cost."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.stats_lock = Lock()
+        self.checkouts = 0
+        self.wait_time = 0.0
+        self.max_wait = 0.0
+        self.timeouts = 0
+        self.connect_errors = 0
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        except exc.TimeoutError:
+            with self.stats_lock:
+                self.timeouts += 1
+            raise
+        finally:
+            waited = time.perf_counter() - started
+            with self.stats_lock:
+                self.checkouts += 1
+                self.wait_time += waited
+                self.max_wait = max(self.max_wait, waited)
+
+    def _create_connection(self):
+        try:
+            return super()._create_connection()
+        except Exception:
+            with self.stats_lock:
+                self.connect_errors += 1
+            raise
+
+    def stats(self):
+        with self.stats_lock:
+            return {
+                'size': self.size(),
+                'checked_in': self.checkedin(),
+                'checked_out': self.checkedout(),
+                'overflow': max(self.overflow(), 0),
+                'checkouts': self.checkouts,
+                'wait_ms_total': round(self.wait_time * 1000, 2),
+                'wait_ms_max': round(self.max_wait * 1000, 2),
+                'timeouts': self.timeouts,
+                'connect_errors': self.connect_errors,
+            }
+
+
+def pool_stats(db, app):
+    """Stats for the pool of each of `app`'s engines, by bind name."""
+
+    stats = {}
+    for bind in [None] + list(app.config.get('SQLALCHEMY_BINDS') or ()):
+        pool = db.get_engine(app, bind=bind).pool
+        if isinstance(pool, StatsQueuePool):
+            stats[bind or 'primary'] = pool.stats()
+    return stats
+
+
+def prepare(statement):
+    """Return `(name, PREPARE statement)` for a psycopg2 statement, and
+    the parameter names in placeholder order."""
+
+    names = []
+
+    def placeholder(match):
+        if match.group(0) == '%%':
+            return '%'
+        if match.group(1) not in names:
+            names.append(match.group(1))
+        return f'${names.index(match.group(1)) + 1}'
+
+    body = PLACEHOLDER.sub(placeholder, statement)
+    name = 'warbler_' + hashlib.blake2b(statement.encode(), digest_size=8).hexdigest()
+    return name, f'PREPARE {name} AS {body}', names
+
+
+def init_prepared_statements(app):
+    """Run queries marked `prepare=True` as prepared statements."""
+
+    mode = app.config.setdefault('DB_POOL_MODE', 'session')
+    app.config.setdefault('PREPARED_STATEMENTS', mode != 'pgbouncer')
+    if not app.config['PREPARED_STATEMENTS']:
+        return
+
+    # statement -> (name, PREPARE statement, parameter names)
+    prepared = {}
+
+    @event.listens_for(Engine, 'before_cursor_execute', retval=True)
+    def use_prepared(conn, cursor, statement, parameters, context, executemany):
+        if (executemany or context is None or not isinstance(parameters, dict)
+                or not context.execution_options.get('prepare')):
+            return statement, parameters
+
+        if statement not in prepared:
+            prepared[statement] = prepare(statement)
+        name, prepare_statement, names = prepared[statement]
+
+        # `conn.info` lives as long as the database connection does
+        done = conn.info.setdefault('prepared_statements', set())
+        if name not in done:
+            cursor.execute(prepare_statement)
+            done.add(name)
+
+        args = ', '.join(f'%({param})s' for param in names)
+        return f'EXECUTE {name}({args})' if names else f'EXECUTE {name}', parameters
@@ -0,0 +1,54 @@
+"""Count the SQL statements run against an engine.
+
+Used by the tests to put a ceiling on how many queries a route may run,
+so an N+1 (one lazy load per row) fails the suite instead of shipping.
+"""
+
+from contextlib import contextmanager
+
+from sqlalchemy import event
+
+from models import db
+
+
+class QueryCounter:
+    """Records each statement an engine sends to the database."""
+
+    def __init__(self):
+        self.statements = []
+
+    def __call__(self, conn, cursor, statement, parameters, context, executemany):
+        self.statements.append(statement)
+
+    @property
+    def count(self):
+        return len(self.statements)
+
+
+@contextmanager
+def count_queries(engine=None):
+    """Count the statements run inside the `with` block."""
+
+    engine = engine or db.engine
+    counter = QueryCounter()
+
+    event.listen(engine, 'before_cursor_execute', counter)
+    try:
+        yield counter
+    finally:
+        event.remove(engine, 'before_cursor_execute', counter)
+
+
+class QueryCountMixin:
+    """TestCase mixin adding `assertMaxQueries`."""
+
+    @contextmanager
+    def assertMaxQueries(self, max_queries, engine=None):
+        """Fail if the `with` block runs more than `max_queries` statements."""
+
+        with count_queries(engine) as counter:
+            yield counter
+
+        if counter.count > max_queries:
+            self.fail(f"{counter.count} queries run, expected at most "
+                      f"{max_queries}:\n\n" + "\n\n".join(counter.statements))
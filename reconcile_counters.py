@@ -0,0 +1,47 @@
+"""Rebuild the counters on users from follows, likes and messages, and
+each message's like count.
+
+The database triggers keep them right as rows change; run this after bulk
+loads, or any time the counters look wrong:
+
+    python reconcile_counters.py
+
+It only queues the work, as `reconcile_counters` and
+`reconcile_like_counts` jobs of BATCH_SIZE ids each, for `worker.py` to
+run; queueing the same batches again while they wait does nothing.
+"""
+
+from app import db
+from models import User, Message, Job
+
+BATCH_SIZE = 1000
+
+
+def in_batches(model, kind, ids_name):
+    """Queue a `kind` job for every BATCH_SIZE `model` ids."""
+
+    last_id = 0
+    batches = 0
+
+    while True:
+        ids = [id for (id,) in (db.session
+                                .query(model.id)
+                                .filter(model.id > last_id)
+                                .order_by(model.id)
+                                .limit(BATCH_SIZE))]
+        if not ids:
+            break
+
+        Job.enqueue(kind, key=f'{kind}:{ids[0]}-{ids[-1]}', **{ids_name: ids})
+        db.session.commit()
+
+        last_id = ids[-1]
+        batches += 1
+
+    return batches
+
+
+if __name__ == '__main__':
+    users = in_batches(User, 'reconcile_counters', 'user_ids')
+    messages = in_batches(Message, 'reconcile_like_counts', 'message_ids')
+    print(f'queued {users + messages} jobs; run worker.py to process them')
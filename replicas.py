@@ -0,0 +1,68 @@
+"""Send read-only requests to read replicas.
+
+GET and HEAD requests run their queries on one of the replicas listed in
+`READ_REPLICAS` (bind names from `SQLALCHEMY_BINDS`), picked at random per
+request; everything else, and any flush, uses the primary.
+
+Replicas lag the primary a little, so a user who has just changed
+something would not always see it. `pin_to_primary()` (called whenever the
+logged-in user's rows change) sends that user's reads to the primary for
+`REPLICA_PIN_SECONDS`, using a timestamp in their session so every process
+honours it.
+"""
+
+import random
+import time
+
+from flask import current_app, g, has_request_context, request, session
+from flask_sqlalchemy import SignallingSession, SQLAlchemy
+from sqlalchemy import orm
+
+PIN_KEY = 'primary_until'
+
+
+class RoutingSession(SignallingSession):
+    """A session that reads from the request's replica, if it has one."""
+
+    def __init__(self, db, **options):
+        self.db = db
+        super().__init__(db, **options)
+
+    def get_bind(self, mapper=None, clause=None):
+        bind = g.get('replica_bind') if has_request_context() else None
+        if bind and not self._flushing:
+            return self.db.get_engine(self.app, bind=bind)
+
+        return super().get_bind(mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+def replica_binds(urls):
+    """`SQLALCHEMY_BINDS` entries for a list of replica URLs."""
+
+    return {f'replica{i}': url for i, url in enumerate(urls)}
+
+
+def init_replicas(app):
+    app.config.setdefault('READ_REPLICAS', [])
+    app.config.setdefault('REPLICA_PIN_SECONDS', 10)
+
+    @app.before_request
+    def choose_replica():
+        g.replica_bind = None
+
+        replicas = current_app.config['READ_REPLICAS']
+        if (replicas and request.method in ('GET', 'HEAD')
+                and session.get(PIN_KEY, 0) < time.time()):
+            g.replica_bind = random.choice(replicas)
+
+
+def pin_to_primary():
+    """Read from the primary for a while, to see this request's writes."""
+
+    session[PIN_KEY] = time.time() + current_app.config['REPLICA_PIN_SECONDS']
+    g.replica_bind = None
@@ -1,20 +1,45 @@
-"""Seed database with sample data from CSV Files."""
+"""Seed database with sample data from CSV Files.
 
-from csv import DictReader
-from app import db
-from models import User, Message, Follows
+    python seed.py [--workers N] [--chunk-rows N] [--no-timelines] [--data DIR]
 
+Drops and recreates every table, then streams the CSVs in with COPY (see
+bulk_load.py). Large datasets are best generated and loaded with the same
+number of workers as there are cores.
+"""
 
-db.drop_all()
-db.create_all()
+import argparse
+import os
 
-with open('generator/users.csv') as users:
-    db.session.bulk_insert_mappings(User, DictReader(users))
+from app import app, db
+from bulk_load import BulkLoader, Source, CHUNK_ROWS
 
-with open('generator/messages.csv') as messages:
-    db.session.bulk_insert_mappings(Message, DictReader(messages))
 
-with open('generator/follows.csv') as follows:
-    db.session.bulk_insert_mappings(Follows, DictReader(follows))
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--data', default='generator',
+                        help='directory with users.csv, messages.csv and follows.csv')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 2)
+    parser.add_argument('--chunk-rows', type=int, default=CHUNK_ROWS)
+    parser.add_argument('--no-timelines', dest='timelines', action='store_false',
+                        help="skip rebuilding home timelines; they fall back to "
+                             "reading followed users' messages directly")
+    args = parser.parse_args()
 
-db.session.commit()
+    db.drop_all()
+    db.create_all()
+    db.session.remove()
+    db.engine.dispose()
+
+    sources = [
+        Source('users', os.path.join(args.data, 'users.csv'), numbered=True),
+        Source('messages', os.path.join(args.data, 'messages.csv'), numbered=True),
+        Source('follows', os.path.join(args.data, 'follows.csv'), numbered=False),
+    ]
+
+    loader = BulkLoader(app.config['SQLALCHEMY_DATABASE_URI'], sources,
+                        workers=args.workers, chunk_rows=args.chunk_rows)
+    loader.run(timelines=args.timelines)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+/* Load older: swap the "Load older" item for the next page of messages,
+ * either when it is clicked or when it scrolls into view. */
+
+$(function () {
+  let loading = false;
+
+  function loadOlder($link) {
+    if (loading) return;
+    loading = true;
+
+    $.get($link.data('fragment'))
+      .done(function (html) {
+        $link.closest('li.load-older').replaceWith(html);
+        watchOlder();
+      })
+      .always(function () {
+        loading = false;
+      });
+  }
+
+  $('#messages').on('click', 'li.load-older a[data-fragment]', function (evt) {
+    evt.preventDefault();
+    loadOlder($(this));
+  });
+
+  const observer = 'IntersectionObserver' in window
+    ? new IntersectionObserver(function (entries) {
+        entries
+          .filter(entry => entry.isIntersecting)
+          .forEach(entry => loadOlder($(entry.target).find('a[data-fragment]')));
+      })
+    : null;
+
+  function watchOlder() {
+    if (!observer) return;
+    observer.disconnect();
+    $('#messages li.load-older').each(function () {
+      observer.observe(this);
+    });
+  }
+
+  watchOlder();
+});
+
+/* Search box: suggest usernames as the user types. */
+
+$(function () {
+  const $search = $('#search');
+  const $suggestions = $('#search-suggestions');
+  let pending = null;
+
+  $search.on('input', function () {
+    const q = $search.val().trim();
+
+    clearTimeout(pending);
+    if (!q) {
+      $suggestions.empty();
+      return;
+    }
+
+    pending = setTimeout(function () {
+      $.getJSON('/users/autocomplete', { q: q }, function (users) {
+        $suggestions.empty();
+        users.forEach(user => $('<option>').val(user.username).appendTo($suggestions));
+      });
+    }, 150);
+  });
+});
+
+/* Like buttons: toggle the like in place rather than reloading the page. */
+
+$(function () {
+  $('#messages').on('submit', 'form.like-form', function (evt) {
+    evt.preventDefault();
+
+    const $form = $(this);
+    const $button = $form.find('button').prop('disabled', true);
+
+    $.post($form.data('like-url'))
+      .done(function (result) {
+        $button
+          .toggleClass('btn-primary', result.liked)
+          .toggleClass('btn-secondary', !result.liked)
+          .find('.like-count').text(result.likes || '');
+      })
+      .fail(function () {
+        // fall back to the plain form post (which fires no submit event)
+        $form[0].submit();
+      })
+      .always(function () {
+        $button.prop('disabled', false);
+      });
+  });
+});
@@ -0,0 +1,150 @@
+"""JSON API tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_api.py
+
+
+import os
+from datetime import datetime
+from unittest import TestCase
+
+from models import db, User, Message, Follows, TimelineEntry
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+
+# Now we can import app
+
+from app import app, CURR_USER_KEY
+
+# Create our tables (we do this here, so we only create the tables
+# once for all tests --- in each test, we'll delete the data
+# and create fresh new clean test data
+
+db.create_all()
+
+
+class ApiTestCase(TestCase):
+    """Test the /api/v1 endpoints."""
+
+    def setUp(self):
+        """A viewer following two authors with a few messages each."""
+
+        db.drop_all()
+        db.create_all()
+
+        self.client = app.test_client()
+
+        users = [User(id=i, username=f'user{i}', email=f'user{i}@test.com',
+                      password='HASHED_PASSWORD')
+                 for i in range(1, 5)]
+        db.session.add_all(users)
+        db.session.commit()
+
+        for author_id in (2, 3):
+            db.session.add(Follows(user_being_followed_id=author_id, user_following_id=1))
+            for i in range(3):
+                msg = Message(text=f'user{author_id} #{i}', user_id=author_id)
+                db.session.add(msg)
+                db.session.flush()
+                TimelineEntry.fan_out(msg)
+        db.session.commit()
+
+    def tearDown(self):
+        res = super().tearDown()
+        db.session.rollback()
+        return res
+
+    def logged_in(self):
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = 1
+        return self.client
+
+    def test_timeline_pages(self):
+        """Does the timeline page with a cursor and trim fields?"""
+
+        c = self.logged_in()
+        first = c.get('/api/v1/timeline?limit=4&fields=text,liked').json
+        rest = c.get(f"/api/v1/timeline?limit=4&fields=text&before={first['next']}").json
+
+        self.assertEqual(first['data'][0], {'text': 'user3 #2', 'liked': False})
+        self.assertEqual(len(first['data']), 4)
+        self.assertEqual([m['text'] for m in rest['data']], ['user2 #1', 'user2 #0'])
+        self.assertIsNone(rest['next'])
+
+    def test_profile(self):
+        resp = self.client.get('/api/v1/users/1?fields=username,following_count')
+
+        self.assertEqual(resp.json, {'username': 'user1', 'following_count': 2})
+
+    def test_deleted_profile(self):
+        """Is a deleted account's profile gone before it is purged?"""
+
+        User.query.get(2).deleted_at = datetime.utcnow()
+        db.session.commit()
+
+        self.assertEqual(self.client.get('/api/v1/users/2').status_code, 404)
+
+    def test_deleted_messages(self):
+        """Are a deleted account's messages and likes gone, and its messages
+        out of the timeline?"""
+
+        User.query.get(2).deleted_at = datetime.utcnow()
+        db.session.commit()
+
+        c = self.logged_in()
+        self.assertEqual(c.get('/api/v1/users/2/messages').status_code, 404)
+        self.assertEqual(c.get('/api/v1/users/2/likes').status_code, 404)
+        self.assertEqual([m['text'] for m in c.get('/api/v1/timeline').json['data']],
+                         ['user3 #2', 'user3 #1', 'user3 #0'])
+
+    def test_following(self):
+        """Do follow lists page by id and resolve follow state?"""
+
+        c = self.logged_in()
+        first = c.get('/api/v1/users/1/following?limit=1').json
+        rest = c.get(f"/api/v1/users/1/following?limit=1&after={first['next']}").json
+
+        self.assertEqual(first['data'][0]['username'], 'user2')
+        self.assertTrue(first['data'][0]['is_following'])
+        self.assertEqual(rest['data'][0]['username'], 'user3')
+
+    def test_create_delete_message(self):
+        c = self.logged_in()
+
+        resp = c.post('/api/v1/messages', json={'text': 'hello api'})
+        self.assertEqual(resp.status_code, 201)
+        self.assertEqual(resp.json['user']['username'], 'user1')
+
+        msg_id = resp.json['id']
+        self.assertEqual(c.delete(f'/api/v1/messages/{msg_id}').status_code, 204)
+        self.assertIsNone(Message.query.get(msg_id))
+
+        other = Message.query.filter_by(user_id=2).first()
+        self.assertEqual(c.delete(f'/api/v1/messages/{other.id}').status_code, 403)
+
+    def test_errors(self):
+        """Are errors JSON, for logged-out users and bad requests alike?"""
+
+        self.assertEqual(self.client.get('/api/v1/timeline').status_code, 401)
+
+        c = self.logged_in()
+        resp = c.get('/api/v1/timeline?fields=text,password')
+        self.assertEqual(resp.status_code, 400)
+        self.assertIn('password', resp.json['error'])
+
+        self.assertEqual(c.post('/api/v1/messages', json={'text': ''}).status_code, 400)
+
+        # nothing is posted by a request that can't be answered
+        resp = c.post('/api/v1/messages?fields=nope', json={'text': 'lost'})
+        self.assertEqual(resp.status_code, 400)
+        self.assertEqual(Message.query.filter_by(text='lost').count(), 0)
+        resp = c.get('/api/v1/users/99')
+        self.assertEqual(resp.status_code, 404)
+        self.assertIn('error', resp.json)
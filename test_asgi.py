@@ -0,0 +1,160 @@
+"""ASGI entry point tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_asgi.py
+
+
+import asyncio
+import json
+import os
+from datetime import datetime
+from unittest import TestCase
+
+from models import db, User, Message, Follows, Likes, TimelineEntry
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+
+# Now we can import app
+
+from app import app, CURR_USER_KEY
+from asgi import Application
+
+# Create our tables (we do this here, so we only create the tables
+# once for all tests --- in each test, we'll delete the data
+# and create fresh new clean test data
+
+db.create_all()
+
+
+class AsgiTestCase(TestCase):
+    """Compare the async views with the Flask ones, and check the rest
+    still reaches Flask."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.loop = asyncio.new_event_loop()
+        cls.application = Application(app)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.loop.run_until_complete(cls.application.close())
+        cls.loop.close()
+
+    def setUp(self):
+        """A viewer following two authors with a few messages each."""
+
+        db.drop_all()
+        db.create_all()
+
+        self.client = app.test_client()
+
+        users = [User(id=i, username=f'user{i}', email=f'user{i}@test.com',
+                      password='HASHED_PASSWORD')
+                 for i in range(1, 5)]
+        db.session.add_all(users)
+        db.session.commit()
+
+        for author_id in (2, 3):
+            db.session.add(Follows(user_being_followed_id=author_id, user_following_id=1))
+            for i in range(3):
+                msg = Message(text=f'user{author_id} #{i}', user_id=author_id)
+                db.session.add(msg)
+                db.session.flush()
+                TimelineEntry.fan_out(msg)
+        db.session.commit()
+
+        self.msg_id = Message.query.filter_by(user_id=2).first().id
+        db.session.add(Likes(user_id=1, message_id=self.msg_id))
+        db.session.commit()
+
+        # the site's session cookie for user 1
+        serializer = app.session_interface.get_signing_serializer(app)
+        self.cookie = f'{app.session_cookie_name}={serializer.dumps({CURR_USER_KEY: 1})}'
+
+    def tearDown(self):
+        res = super().tearDown()
+        db.session.rollback()
+        return res
+
+    def request(self, path, method='GET', body=b'', cookie=None):
+        """`(status, body)` of one request to the ASGI app."""
+
+        path, _, query = path.partition('?')
+        scope = {'type': 'http', 'method': method, 'path': path,
+                 'query_string': query.encode(), 'headers': [],
+                 'client': ('127.0.0.1', 50000), 'server': ('localhost', 80)}
+        if cookie:
+            scope['headers'].append((b'cookie', cookie.encode()))
+        if body:
+            scope['headers'].append((b'content-type', b'application/json'))
+
+        sent = []
+
+        async def receive():
+            return {'type': 'http.request', 'body': body}
+
+        async def send(message):
+            sent.append(message)
+
+        self.loop.run_until_complete(self.application(scope, receive, send))
+        return sent[0]['status'], b''.join(m.get('body', b'') for m in sent[1:])
+
+    def test_same_as_flask(self):
+        """Do the async reads answer exactly as the Flask views do?"""
+
+        self.client.set_cookie('localhost', app.session_cookie_name,
+                               self.cookie.split('=', 1)[1])
+        paths = ['/api/v1/timeline',
+                 '/api/v1/timeline?limit=4',
+                 '/api/v1/timeline?limit=2&fields=id,likes,liked',
+                 '/api/v1/users/1',
+                 '/api/v1/users/2?fields=username,is_following,messages_count',
+                 '/api/v1/users/2/messages?limit=2',
+                 f'/api/v1/messages/{self.msg_id}']
+
+        for path in paths:
+            status, body = self.request(path, cookie=self.cookie)
+            self.assertEqual(status, 200)
+            self.assertEqual(json.loads(body), self.client.get(path).json, path)
+
+        # and following the cursor
+        cursor = json.loads(self.request('/api/v1/timeline?limit=4', cookie=self.cookie)[1])['next']
+        status, body = self.request(f'/api/v1/timeline?limit=4&before={cursor}',
+                                    cookie=self.cookie)
+        self.assertEqual([m['text'] for m in json.loads(body)['data']],
+                         ['user2 #1', 'user2 #0'])
+
+    def test_errors(self):
+        self.assertEqual(self.request('/api/v1/timeline')[0], 401)
+        self.assertEqual(self.request('/api/v1/users/99')[0], 404)
+
+        User.query.get(2).deleted_at = datetime.utcnow()
+        db.session.commit()
+        self.assertEqual(self.request('/api/v1/users/2')[0], 404)
+        self.assertEqual(self.request('/api/v1/users/2/messages')[0], 404)
+        self.assertEqual([m['text'] for m in json.loads(
+                             self.request('/api/v1/timeline', cookie=self.cookie)[1])['data']],
+                         ['user3 #2', 'user3 #1', 'user3 #0'])
+
+        status, body = self.request('/api/v1/users/1?fields=password')
+        self.assertEqual(status, 400)
+        self.assertIn('password', json.loads(body)['error'])
+
+    def test_flask_routes(self):
+        """Do pages and writes still go to Flask?"""
+
+        status, body = self.request('/signup')
+        self.assertEqual(status, 200)
+        self.assertIn(b'<form', body)
+
+        status, body = self.request('/api/v1/messages', method='POST',
+                                    body=b'{"text": "via asgi"}', cookie=self.cookie)
+        self.assertEqual(status, 201)
+        self.assertEqual(Message.query.filter_by(text='via asgi').count(), 1)
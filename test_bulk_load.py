@@ -0,0 +1,89 @@
+"""Bulk loader tests: the CSV handling, which needs no database."""
+
+# run these tests like:
+#
+#    python -m unittest test_bulk_load.py
+
+
+import csv
+import io
+import os
+import tempfile
+from unittest import TestCase
+
+from bulk_load import Source, csv_records, interleave, number_rows
+
+
+class BulkLoadTestCase(TestCase):
+    """Splitting CSV files into records and chunks, and numbering rows."""
+
+    def test_csv_records(self):
+        """Do quoted fields keep their newlines and doubled quotes?"""
+
+        text = ('alice,"plain"\n'
+                'bob,"two\nlines"\n'
+                'carol,"say ""hi""\nand ""bye"""\n'
+                'dave,last')
+
+        records = list(csv_records(io.StringIO(text, newline='')))
+
+        self.assertEqual(records, ['alice,"plain"\n',
+                                   'bob,"two\nlines"\n',
+                                   'carol,"say ""hi""\nand ""bye"""\n',
+                                   'dave,last'])
+        self.assertEqual([row for record in records for row in csv.reader([record])],
+                         [['alice', 'plain'],
+                          ['bob', 'two\nlines'],
+                          ['carol', 'say "hi"\nand "bye"'],
+                          ['dave', 'last']])
+
+    def test_interleave(self):
+        """Does it go round-robin, carrying on past the shorter ones?"""
+
+        self.assertEqual(list(interleave([[1, 2, 3], [], ['a'], 'xy'])),
+                         [1, 'a', 'x', 2, 'y', 3])
+        self.assertEqual(list(interleave([])), [])
+
+    def test_number_rows(self):
+        """Are records numbered from the chunk's first id?"""
+
+        text, rows = number_rows('hello,1\n"multi\nline",2\n', 41)
+
+        self.assertEqual(rows, 2)
+        self.assertEqual(list(csv.reader(io.StringIO(text, newline=''))),
+                         [['41', 'hello', '1'], ['42', 'multi\nline', '2']])
+        self.assertEqual(number_rows('', 1), ('', 0))
+
+    def test_chunk_ids(self):
+        """Do ids run on from one chunk to the next, in file order?"""
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'messages.csv')
+            with open(path, 'w', newline='') as file:
+                file.write('text,user_id\n'
+                           'one,1\n'
+                           '"two\nlines",1\n'
+                           'three,2\n'
+                           'four,2\n'
+                           'five,3\n')
+
+            chunks = list(Source('messages', path, numbered=True).chunks(2))
+            unnumbered = list(Source('follows', path, numbered=False).chunks(2))
+
+        self.assertEqual([(table, columns, first_id)
+                          for table, columns, first_id, _ in chunks],
+                         [('messages', ['id', 'text', 'user_id'], 1),
+                          ('messages', ['id', 'text', 'user_id'], 3),
+                          ('messages', ['id', 'text', 'user_id'], 5)])
+
+        numbered = [row for _, _, first_id, text in chunks
+                    for row in csv.reader(io.StringIO(number_rows(text, first_id)[0],
+                                                      newline=''))]
+        self.assertEqual(numbered, [['1', 'one', '1'],
+                                    ['2', 'two\nlines', '1'],
+                                    ['3', 'three', '2'],
+                                    ['4', 'four', '2'],
+                                    ['5', 'five', '3']])
+
+        self.assertEqual([(columns, first_id) for _, columns, first_id, _ in unnumbered],
+                         [(['text', 'user_id'], None)] * 3)
@@ -0,0 +1,152 @@
+"""SQL instrumentation tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_instrumentation.py
+
+
+import json
+import os
+from unittest import TestCase
+
+from sqlalchemy.exc import ProgrammingError
+
+from models import db, User, Message
+from instrumentation import log_slow_query
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+
+# Now we can import app
+
+from app import app, CURR_USER_KEY
+
+# Create our tables (we do this here, so we only create the tables
+# once for all tests --- in each test, we'll delete the data
+# and create fresh new clean test data
+
+db.create_all()
+
+
+class InstrumentationTestCase(TestCase):
+    """Test per-request SQL stats."""
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+
+        self.client = app.test_client()
+
+        user = User(id=1, username='testuser', email='test@test.com',
+                    password='HASHED_PASSWORD')
+        db.session.add(user)
+        db.session.add(Message(id=1, text='hello', user_id=1))
+        db.session.commit()
+
+    def tearDown(self):
+        res = super().tearDown()
+        db.session.rollback()
+        return res
+
+    def test_server_timing(self):
+        """Does every response report its SQL cost?"""
+
+        with self.assertLogs('warbler.sql', 'INFO') as logs:
+            resp = self.client.get('/messages/1')
+
+        self.assertEqual(resp.status_code, 200)
+
+        timing = resp.headers['Server-Timing']
+        self.assertIn('db;dur=', timing)
+        self.assertIn('orm;desc="2 objects"', timing)
+
+        line = json.loads(logs.records[-1].getMessage())
+        self.assertEqual(line['endpoint'], 'messages_show')
+        # the ETag lookup (see http_cache.py), then the message itself
+        self.assertEqual(line['queries'], 2)
+        self.assertEqual(line['rows'], 2)
+
+    def test_slow_query_plan(self):
+        """Are slow statements logged with their plan?"""
+
+        conn = db.engine.raw_connection()
+        cursor = conn.cursor()
+        try:
+            with self.assertLogs('warbler.sql', 'WARNING') as logs:
+                log_slow_query(cursor, 'SELECT * FROM messages WHERE id = %(id)s',
+                               {'id': 1}, 1.5)
+        finally:
+            conn.close()
+
+        line = json.loads(logs.records[-1].getMessage())
+        self.assertEqual(line['slow_query_ms'], 1500)
+        self.assertIn('messages', line['plan'])
+
+    def test_slow_query_plan_transactions(self):
+        """Does a failed EXPLAIN leave the transaction usable, and does
+        EXPLAIN work outside a transaction too?"""
+
+        conn = db.engine.raw_connection()
+        cursor = conn.cursor()
+        try:
+            cursor.execute('SELECT 1')
+            with self.assertLogs('warbler.sql', 'WARNING') as logs:
+                log_slow_query(cursor, 'SELECT * FROM no_such_table', {}, 1.5)
+            self.assertIn('EXPLAIN failed', json.loads(logs.records[-1].getMessage())['plan'])
+            cursor.execute('SELECT 2')
+            self.assertEqual(cursor.fetchone(), (2,))
+            conn.rollback()
+
+            conn.connection.autocommit = True
+            with self.assertLogs('warbler.sql', 'WARNING') as logs:
+                log_slow_query(cursor, 'SELECT * FROM messages', {}, 1.5)
+            self.assertIn('messages', json.loads(logs.records[-1].getMessage())['plan'])
+        finally:
+            conn.connection.autocommit = False
+            conn.close()
+
+    def test_failed_statement_timer(self):
+        """Is a failed statement's start time dropped?"""
+
+        with db.engine.connect() as conn:
+            with self.assertRaises(ProgrammingError):
+                conn.execute('SELECT * FROM no_such_table')
+            self.assertEqual(conn.info['query_started'], [])
+
+    def test_slow_prepared_statement_plan(self):
+        """Is a slow prepared statement logged as its SQL, with a plan?"""
+
+        query = db.text('SELECT pg_sleep(:seconds)').execution_options(prepare=True)
+        seconds = app.config['SLOW_QUERY_MS'] / 1000 + 0.05
+
+        with self.assertLogs('warbler.sql', 'WARNING') as logs:
+            db.session.execute(query, {'seconds': seconds})
+
+        line = json.loads(logs.records[-1].getMessage())
+        self.assertIn('pg_sleep', line['statement'])
+        self.assertNotIn('EXECUTE', line['statement'])
+        self.assertIn('Result', line['plan'])
+
+    def test_prepared_statement(self):
+        """Do marked queries run as EXECUTE after their first PREPARE?"""
+
+        query = User.query.filter_by(username='testuser').execution_options(prepare=True)
+
+        self.assertEqual(query.first().id, 1)
+        self.assertEqual(query.first().id, 1)
+
+        names = [name for name, in db.session.execute(
+            "SELECT name FROM pg_prepared_statements")]
+        self.assertTrue(any(name.startswith('warbler_') for name in names))
+
+    def test_pool_stats(self):
+        stats = self.client.get('/internal/pool-stats').json['primary']
+
+        self.assertGreater(stats['checkouts'], 0)
+        self.assertEqual(stats['connect_errors'], 0)
+        self.assertIn('wait_ms_total', stats)
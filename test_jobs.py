@@ -0,0 +1,158 @@
+"""Background job tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_jobs.py
+
+
+import os
+from datetime import datetime
+from unittest import TestCase
+
+from models import db, User, Message, MessageArchive, Follows, Likes, TimelineEntry, Job
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+
+# Now we can import app
+
+from app import app, CURR_USER_KEY
+import worker
+
+# Create our tables (we do this here, so we only create the tables
+# once for all tests --- in each test, we'll delete the data
+# and create fresh new clean test data
+
+db.create_all()
+
+# Don't have WTForms use CSRF at all, since it's a pain to test
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class JobTestCase(TestCase):
+    """Test the job queue and the jobs that use it."""
+
+    def setUp(self):
+        """Two users who follow each other and like each other's message."""
+
+        db.drop_all()
+        db.create_all()
+
+        self.client = app.test_client()
+
+        db.session.add_all([
+            User(id=1, username='leaving', email='leaving@test.com', password='HASHED_PASSWORD'),
+            User(id=2, username='staying', email='staying@test.com', password='HASHED_PASSWORD'),
+        ])
+        db.session.commit()
+        bye = Message(text='bye', user_id=1)
+        hi = Message(text='hi', user_id=2)
+        db.session.add_all([
+            Follows(user_being_followed_id=1, user_following_id=2),
+            Follows(user_being_followed_id=2, user_following_id=1),
+            bye,
+            hi,
+        ])
+        db.session.commit()
+        db.session.add_all([Likes(user_id=1, message_id=hi.id), Likes(user_id=2, message_id=bye.id)])
+        db.session.commit()
+
+    def tearDown(self):
+        res = super().tearDown()
+        db.session.rollback()
+        return res
+
+    def test_delete_account(self):
+        """Is the account hidden at once, and purged by the worker?"""
+
+        # with 'bye' archived, staying's like on it is an archived like
+        Message.query.filter_by(text='bye').update({'timestamp': datetime(2020, 1, 1)})
+        MessageArchive.archive(datetime(2021, 1, 1))
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = 1
+
+            resp = c.post('/users/delete')
+            self.assertEqual(resp.status_code, 302)
+            self.assertIsNotNone(User.query.get(1).deleted_at)
+            self.assertEqual(c.get('/users/1').status_code, 404)
+
+        # one row per batch, so the job has to come back for more
+        worker.HANDLERS['purge_user'] = lambda user_id: User.purge(user_id, batch_size=1)
+        try:
+            worker.work(once=True)
+        finally:
+            worker.HANDLERS['purge_user'] = worker.purge_user
+
+        db.session.expire_all()
+        staying = User.query.get(2)
+        self.assertIsNone(User.query.get(1))
+        self.assertEqual(Message.query.count(), 1)
+        self.assertEqual((staying.following_count, staying.followers_count,
+                          staying.likes_count), (0, 0, 0))
+        self.assertEqual(Job.query.count(), 0)
+
+    def test_fan_out(self):
+        """Do followers get a new message once the job has run?"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = 1
+            c.post('/messages/new', data={'text': 'fanned out'})
+
+        msg = Message.query.filter_by(text='fanned out').one()
+        readers = lambda: {entry.user_id for entry
+                           in TimelineEntry.query.filter_by(message_id=msg.id)}
+        self.assertEqual(readers(), {1})
+
+        worker.work(once=True)
+        self.assertEqual(readers(), {1, 2})
+
+    def test_pending_key(self):
+        """Is a keyed job only queued once while it is pending?"""
+
+        Job.enqueue('fan_out', key='fan_out:1', message_id=1)
+        Job.enqueue('fan_out', key='fan_out:1', message_id=1)
+        db.session.commit()
+        self.assertEqual(Job.query.count(), 1)
+
+        worker.work(once=True)
+        self.assertEqual(Job.query.count(), 0)
+        Job.enqueue('fan_out', key='fan_out:1', message_id=1)
+        db.session.commit()
+        self.assertEqual(Job.query.one().status, 'queued')
+
+    def test_retry(self):
+        """Are failing jobs retried later, then given up on?"""
+
+        def broken(**payload):
+            raise RuntimeError('broken')
+
+        worker.HANDLERS['broken'] = broken
+        try:
+            Job.enqueue('broken')
+            db.session.commit()
+            worker.work(once=True)
+
+            job = Job.query.one()
+            self.assertEqual((job.status, job.attempts), ('queued', 1))
+            self.assertIn('RuntimeError', job.last_error)
+            self.assertGreater(job.run_at, datetime.utcnow())
+
+            job.run_at = job.run_at.min
+            job.attempts = job.max_attempts - 1
+            db.session.commit()
+            worker.work(once=True)
+
+            db.session.expire_all()
+            self.assertEqual(Job.query.one().status, 'failed')
+        finally:
+            del worker.HANDLERS['broken']
@@ -6,9 +6,11 @@
 
 
 import os
+from datetime import datetime
 from unittest import TestCase
 
-from models import db, User, Message, Follows, Likes
+from models import db, User, Message, Follows, Likes, MessageLikeCount, MessageArchive, ArchivedLike
+from pagination import decode_cursor
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
@@ -90,4 +92,128 @@ class UserModelTestCase(TestCase):
 
 
 
-    
\ No newline at end of file
+    
+
+    def test_like_counts(self):
+        """Do the sharded counts follow likes, unlikes and deletes?"""
+
+        m1 = Message(text='test1', user_id=self.uid)
+        m2 = Message(text='test2', user_id=self.uid)
+        db.session.add_all([m1, m2])
+        db.session.commit()
+
+        users = [User(username=f'fan{i}', email=f'fan{i}@test.com', password='HASHED')
+                 for i in range(20)]
+        db.session.add_all(users)
+        db.session.commit()
+
+        for user in users:
+            user.likes.append(m1)
+        users[0].likes.append(m2)
+        db.session.commit()
+
+        self.assertEqual(MessageLikeCount.totals([m1.id, m2.id]),
+                         {m1.id: 20, m2.id: 1})
+
+        users[1].likes.remove(m1)
+        db.session.delete(users[2])
+        db.session.commit()
+        self.assertEqual(MessageLikeCount.totals([m1.id])[m1.id], 18)
+
+        # a message's likes go with it, without tripping the trigger
+        db.session.delete(m2)
+        db.session.commit()
+        self.assertEqual(MessageLikeCount.totals([m2.id]), {})
+
+        MessageLikeCount.reconcile([m1.id])
+        db.session.commit()
+        self.assertEqual(MessageLikeCount.query.filter_by(message_id=m1.id).count(), 1)
+        self.assertEqual(MessageLikeCount.totals([m1.id])[m1.id], 18)
+
+    def test_like_counts_for_viewer(self):
+        """Does for_viewer pick out the viewer's likes on a page?"""
+
+        messages = [Message(text=f'test{i}', user_id=self.uid) for i in range(3)]
+        fan = User(username='fan', email='fan@test.com', password='HASHED')
+        db.session.add_all(messages + [fan])
+        db.session.commit()
+
+        self.u.likes.append(messages[1])
+        fan.likes.extend(messages[1:])
+        db.session.commit()
+
+        ids = [msg.id for msg in messages]
+        self.assertEqual(MessageLikeCount.for_viewer(self.uid, ids),
+                         ({messages[1].id}, {messages[1].id: 2, messages[2].id: 1}))
+        self.assertEqual(MessageLikeCount.for_viewer(self.uid, []), (set(), {}))
+
+    def test_archive(self):
+        """Do profile pages run on into archived messages, in order?"""
+
+        for day in range(1, 8):
+            db.session.add(Message(text=f"day {day}", user_id=self.uid,
+                                   timestamp=datetime(2020, 1, day)))
+        db.session.commit()
+        old_id = Message.query.filter_by(text="day 2").one().id
+        db.session.add(Likes(user_id=self.uid, message_id=old_id))
+        db.session.commit()
+
+        # in batches of 3, so the second starts where the first left off
+        moved, after = MessageArchive.archive(datetime(2020, 1, 5), limit=3)
+        self.assertEqual(moved, 3)
+        moved, after = MessageArchive.archive(datetime(2020, 1, 5), after, limit=3)
+        self.assertEqual(moved, 1)
+        self.assertEqual(MessageArchive.archive(datetime(2020, 1, 5), after, limit=3), (0, None))
+        db.session.commit()
+        db.session.expire_all()
+
+        self.assertEqual(Message.query.count(), 3)
+        self.assertEqual(self.u.messages_count, 7)
+        # the like is kept with the message, and still counted
+        self.assertEqual(self.u.likes_count, 1)
+        self.assertEqual(ArchivedLike.query.filter_by(user_id=self.uid).one().message_id, old_id)
+
+        texts = []
+        page = Message.for_user(self.uid, limit=2)
+        while True:
+            texts += [msg.text for msg in page.items]
+            if not page.next_cursor:
+                break
+            page = Message.for_user(self.uid, before=decode_cursor(page.next_cursor), limit=2)
+
+        self.assertEqual(texts, [f"day {day}" for day in range(7, 0, -1)])
+
+        User.reconcile_counters([self.uid])
+        db.session.expire_all()
+        self.assertEqual(self.u.messages_count, 7)
+        self.assertEqual(self.u.likes_count, 1)
+
+    def test_liked_by_archived(self):
+        """Do likes on archived messages stay on the likes page, in the
+        order they were made?"""
+
+        for day in range(1, 5):
+            msg = Message(text=f"day {day}", user_id=self.uid,
+                          timestamp=datetime(2020, 1, day))
+            db.session.add(msg)
+            db.session.flush()
+            # liked in reverse: day 4 first, day 1 last
+            db.session.add(Likes(user_id=self.uid, message_id=msg.id,
+                                 timestamp=datetime(2021, 1, 5 - day)))
+        db.session.commit()
+
+        MessageArchive.archive(datetime(2020, 1, 3))
+        db.session.commit()
+        db.session.expire_all()
+        self.assertEqual(ArchivedLike.query.count(), 2)
+
+        texts = []
+        page = Message.liked_by(self.uid, limit=1)
+        while True:
+            texts += [msg.text for msg in page.items]
+            if not page.next_cursor:
+                break
+            page = Message.liked_by(self.uid, before=decode_cursor(page.next_cursor), limit=1)
+
+        self.assertEqual(texts, ["day 1", "day 2", "day 3", "day 4"])
+        self.assertEqual(self.u.likes_count, 4)
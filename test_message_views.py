@@ -6,9 +6,11 @@
 
 
 import os
+from datetime import datetime
 from unittest import TestCase
 
-from models import db, connect_db, Message, User
+from models import db, connect_db, Message, MessageArchive, User, Follows
+from pagination import encode_cursor
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
@@ -20,7 +22,7 @@ os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
 
 # Now we can import app
 
-from app import app, CURR_USER_KEY
+from app import app, CURR_USER_KEY, fragment_cache
 
 # Create our tables (we do this here, so we only create the tables
 # once for all tests --- in each test, we'll delete the data
@@ -67,6 +69,29 @@ class MessageViewTestCase(TestCase):
             self.assertEqual(resp.status_code, 200)
             self.assertIn('testing', str(resp.data))
 
+    def test_show_archived_message(self):
+        """Do archived messages keep their permalinks, and others 404?"""
+
+        m = Message(id=1234, text="old news", user_id=self.testuser_id,
+                    timestamp=datetime(2020, 1, 1))
+        db.session.add(m)
+        db.session.commit()
+        MessageArchive.archive(datetime(2021, 1, 1))
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            resp = c.get('/messages/1234')
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn('old news', str(resp.data))
+            # archived messages are read-only
+            self.assertNotIn('/messages/1234/delete', str(resp.data))
+
+            self.assertEqual(c.get('/messages/4321').status_code, 404)
+            self.assertEqual(c.post('/messages/4321/delete').status_code, 404)
+
     def test_add_message(self):
         """Can use add a message?"""
 
@@ -88,6 +113,73 @@ class MessageViewTestCase(TestCase):
             msg = Message.query.one()
             self.assertEqual(msg.text, "Hello")
 
+    def test_add_message_reaches_followers(self):
+        """Does a new message show up on a follower's home page?"""
+
+        follower = User.signup("follower", "f@test.com", "password", None)
+        follower.id = 7777
+        db.session.commit()
+        db.session.add(Follows(user_being_followed_id=self.testuser_id,
+                               user_following_id=7777))
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            c.post("/messages/new", data={"text": "Fanned out"})
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = 7777
+
+            resp = c.get("/")
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("Fanned out", str(resp.data))
+
+    def test_load_older(self):
+        """Does load older return just the next page of a profile?"""
+
+        for i in range(3):
+            db.session.add(Message(text=f"warble {i}", user_id=self.testuser_id,
+                                   timestamp=datetime(2020, 1, 1 + i)))
+        db.session.commit()
+
+        with self.client as c:
+            resp = c.get(f"/messages/older?feed=user&user_id={self.testuser_id}"
+                         f"&before={encode_cursor(datetime(2020, 1, 3), 0)}")
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertNotIn("<html", str(resp.data))
+            self.assertNotIn("warble 2", str(resp.data))
+            self.assertIn("warble 1", str(resp.data))
+            self.assertIn("warble 0", str(resp.data))
+
+    def test_cached_rows(self):
+        """Are message rows served from the fragment cache until their
+        author's profile changes, but not when only their counters do?"""
+
+        db.session.add(Message(text="cached warble", user_id=self.testuser_id))
+        db.session.commit()
+
+        with self.client as c:
+            c.get(f"/users/{self.testuser_id}")
+            hits = fragment_cache.hits
+            c.get(f"/users/{self.testuser_id}")
+            self.assertEqual(fragment_cache.hits, hits + 1)
+
+            db.session.add(Message(text="bumps the counter", user_id=self.testuser_id))
+            db.session.commit()
+            c.get(f"/users/{self.testuser_id}")
+            self.assertEqual(fragment_cache.hits, hits + 2)
+
+            User.query.get(self.testuser_id).username = "renamed"
+            db.session.commit()
+            resp = c.get(f"/users/{self.testuser_id}")
+
+            self.assertEqual(fragment_cache.hits, hits + 2)
+            self.assertIn("@renamed", str(resp.data))
+
     def test_add_without_session(self):
 
         with self.client as c:
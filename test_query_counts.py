@@ -0,0 +1,161 @@
+"""Query count tests: pages must not run a query per row."""
+
+# run these tests like:
+#
+#    python -m unittest test_query_counts.py
+
+
+import os
+from unittest import TestCase
+
+from models import db, User, Message, Follows, Likes, TimelineEntry
+from query_counter import QueryCountMixin
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+
+# Now we can import app
+
+from app import app, CURR_USER_KEY, CURR_USER_VERSION_KEY
+
+# Create our tables (we do this here, so we only create the tables
+# once for all tests --- in each test, we'll delete the data
+# and create fresh new clean test data
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+NUM_AUTHORS = 10
+
+
+class QueryCountTestCase(QueryCountMixin, TestCase):
+    """Each page's query count is fixed, however many rows it shows."""
+
+    def setUp(self):
+        """A viewer following NUM_AUTHORS authors, who all follow back."""
+
+        db.drop_all()
+        db.create_all()
+
+        self.client = app.test_client()
+
+        self.viewer_id = 1
+        users = [User(id=i, username=f'user{i}', email=f'user{i}@test.com',
+                      password='HASHED_PASSWORD')
+                 for i in range(1, NUM_AUTHORS + 2)]
+        db.session.add_all(users)
+        db.session.commit()
+
+        for author in users[1:]:
+            db.session.add(Follows(user_being_followed_id=author.id,
+                                   user_following_id=self.viewer_id))
+            db.session.add(Follows(user_being_followed_id=self.viewer_id,
+                                   user_following_id=author.id))
+            for i in range(2):
+                msg = Message(text=f'{author.username} #{i}', user_id=author.id)
+                db.session.add(msg)
+                db.session.flush()
+                db.session.add(Likes(user_id=self.viewer_id, message_id=msg.id))
+
+        db.session.commit()
+        TimelineEntry.rebuild(self.viewer_id)
+        db.session.commit()
+
+        self.message_id = Message.query.first().id
+
+    def tearDown(self):
+        res = super().tearDown()
+        db.session.rollback()
+        return res
+
+    def get(self, url, max_queries):
+        """GET `url` as the viewer, running at most `max_queries` queries."""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.viewer_id
+
+            # start from an empty identity map, like a fresh request would
+            db.session.remove()
+
+            with self.assertMaxQueries(max_queries) as counter:
+                resp = c.get(url)
+
+        self.assertEqual(resp.status_code, 200)
+        return resp
+
+    def test_home(self):
+        """Home timeline: authors come with their messages."""
+
+        resp = self.get('/', 5)
+        self.assertIn('@user11', str(resp.data))
+
+    def test_home_likes(self):
+        """Home timeline: likes and like counts cost the same however many
+        likes there are."""
+
+        self.get('/', 5)
+
+        for user in User.query.filter(User.id != self.viewer_id):
+            for msg in Message.query.filter(Message.user_id != user.id):
+                db.session.add(Likes(user_id=user.id, message_id=msg.id))
+        db.session.commit()
+
+        self.get('/', 5)
+
+    def test_profile(self):
+        """Profile page."""
+
+        self.get('/users/2', 4)
+
+    def test_likes(self):
+        """Likes page: authors of liked messages come with them."""
+
+        resp = self.get(f'/users/{self.viewer_id}/likes', 3)
+        self.assertIn('@user11', str(resp.data))
+
+    def test_following(self):
+        """Following page: follow buttons are resolved in one query."""
+
+        resp = self.get(f'/users/{self.viewer_id}/following', 3)
+        self.assertIn('@user11', str(resp.data))
+
+    def test_followers(self):
+        """Followers page: follow buttons are resolved in one query."""
+
+        resp = self.get(f'/users/{self.viewer_id}/followers', 3)
+        self.assertIn('@user11', str(resp.data))
+
+    def test_users_index(self):
+        """User directory."""
+
+        resp = self.get('/users', 3)
+        self.assertIn('@user11', str(resp.data))
+
+    def test_message(self):
+        """Single message page."""
+
+        self.get(f'/messages/{self.message_id}', 3)
+
+    def test_cached_current_user(self):
+        """Is the logged-in user served from the cache after the first request?"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.viewer_id
+                sess[CURR_USER_VERSION_KEY] = 'v1'
+
+            c.get('/messages/new')
+            db.session.remove()
+
+            with self.assertMaxQueries(0):
+                resp = c.get('/messages/new')
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn('alt="user1"', str(resp.data))
@@ -0,0 +1,238 @@
+"""Query plan regression tests.
+
+Runs the hot queries behind each page against a seeded database, EXPLAINs
+every statement they issue, and fails if any plan has a sequential scan or
+a sort: a sign that an index the query relies on is missing or no longer
+matches it. Sequential scans and sorts are switched off for the EXPLAIN,
+so the planner only falls back to them when no index can do the job,
+however small the tables.
+"""
+
+# run these tests like:
+#
+#    python -m unittest test_query_plans.py
+
+
+import os
+from contextlib import contextmanager
+from unittest import TestCase
+
+from flask import g
+from sqlalchemy import event
+
+from models import db, User, Message, MessageLikeCount, TimelineEntry, FollowState
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+
+# Now we can import app
+
+from app import app, profile_version, following_version, followers_version, likes_version
+
+db.create_all()
+
+USERS = 1000
+FOLLOWING = 20
+MESSAGES = 10
+
+SEED = [
+    """
+    INSERT INTO users (id, email, username, password)
+    SELECT i, 'user' || i || '@example.com', 'user' || i, 'HASHED_PASSWORD'
+    FROM generate_series(1, :users) AS i
+    """,
+    """
+    INSERT INTO follows (user_following_id, user_being_followed_id)
+    SELECT i, (i + j - 1) % :users + 1
+    FROM generate_series(1, :users) AS i, generate_series(1, :following) AS j
+    """,
+    """
+    INSERT INTO messages (text, timestamp, user_id)
+    SELECT 'warble ' || j, timestamp '2020-01-01' + (i * :messages + j) * interval '1 minute', i
+    FROM generate_series(1, :users) AS i, generate_series(1, :messages) AS j
+    """,
+    """
+    INSERT INTO timelines (user_id, message_id, author_id, timestamp)
+    SELECT follows.user_following_id, messages.id, messages.user_id, messages.timestamp
+    FROM follows JOIN messages ON messages.user_id = follows.user_being_followed_id
+    """,
+    # one author popular enough to be read at read time, not fanned out
+    "UPDATE users SET fanout_on_read = true WHERE id = 2",
+    """
+    INSERT INTO likes (user_id, message_id, timestamp)
+    SELECT i, (i * 7 + j * 131) % (:users * :messages) + 1,
+           timestamp '2020-06-01' + (i * 10 + j) * interval '1 minute'
+    FROM generate_series(1, :users) AS i, generate_series(1, 10) AS j
+    ON CONFLICT DO NOTHING
+    """,
+]
+
+
+def plan_nodes(plan):
+    """Every node in an EXPLAIN (FORMAT JSON) plan tree."""
+
+    yield plan
+    for child in plan.get('Plans', ()):
+        yield from plan_nodes(child)
+
+
+class QueryPlanTestCase(TestCase):
+    """Check the plans of the queries behind the busiest pages."""
+
+    @classmethod
+    def setUpClass(cls):
+        """One dataset for every test: seeding is the slow part."""
+
+        db.drop_all()
+        db.create_all()
+
+        for statement in SEED:
+            db.session.execute(statement, {'users': USERS, 'following': FOLLOWING,
+                                           'messages': MESSAGES})
+        db.session.commit()
+        db.session.execute('ANALYZE')
+        db.session.commit()
+
+    def setUp(self):
+        self.user = User.query.get(1)
+
+    def tearDown(self):
+        db.session.rollback()
+
+    @contextmanager
+    def assertPlansUseIndexes(self):
+        """Fail if a statement run inside the block scans or sorts."""
+
+        statements = []
+
+        def record(conn, cursor, statement, parameters, context, executemany):
+            statement = context.statement if context is not None else statement
+            if statement.lstrip().upper().startswith(('SELECT', 'WITH')):
+                statements.append((statement, parameters))
+
+        event.listen(db.engine, 'before_cursor_execute', record)
+        try:
+            yield
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', record)
+
+        self.assertTrue(statements)
+        self.assertPlansUseIndexesFor(statements)
+
+    def assertPlansUseIndexesFor(self, statements):
+        """Fail if any of the `(statement, parameters)` scans or sorts."""
+
+        db.session.execute('SET LOCAL enable_seqscan = off')
+        db.session.execute('SET LOCAL enable_sort = off')
+        cursor = db.session.connection().connection.cursor()
+
+        for statement, parameters in statements:
+            cursor.execute('EXPLAIN (FORMAT JSON) ' + statement, parameters)
+            plan = cursor.fetchone()[0][0]['Plan']
+
+            bad = [f"{node['Node Type']} on {node.get('Relation Name', '?')}"
+                   if 'Relation Name' in node else node['Node Type']
+                   for node in plan_nodes(plan)
+                   if node['Node Type'] == 'Seq Scan' or 'Sort' in node['Node Type']]
+            self.assertFalse(bad, f"{', '.join(bad)} in:\n{statement}")
+
+    def test_log_in(self):
+        with self.assertPlansUseIndexes():
+            User.authenticate('nobody', 'password')
+
+    def test_current_user(self):
+        db.session.expunge_all()
+
+        with self.assertPlansUseIndexes():
+            User.query.execution_options(prepare=True).get(5)
+
+    def test_home_timeline(self):
+        with self.assertPlansUseIndexes():
+            page = TimelineEntry.home_timeline(self.user)
+            self.assertTrue(page.next_cursor)
+
+            TimelineEntry.home_timeline(self.user, before=(page.items[-1].timestamp,
+                                                           page.items[-1].id))
+
+    def test_home_timeline_past_stored(self):
+        """Pages past the end of the stored timeline come from messages."""
+
+        oldest = (TimelineEntry.query
+                  .filter_by(user_id=self.user.id)
+                  .order_by(TimelineEntry.timestamp, TimelineEntry.message_id)
+                  .first())
+
+        with self.assertPlansUseIndexes():
+            page = TimelineEntry.home_timeline(self.user, before=(oldest.timestamp,
+                                                                  oldest.message_id))
+            self.assertTrue(page.items)
+
+    def test_profile(self):
+        with self.assertPlansUseIndexes():
+            page = Message.for_user(5, limit=4)
+            Message.for_user(5, before=(page.items[-1].timestamp, page.items[-1].id),
+                             limit=4)
+
+    def test_likes(self):
+        with self.assertPlansUseIndexes():
+            Message.liked_by(5)
+
+    def test_like_state(self):
+        messages = Message.for_user(5).items
+
+        with self.assertPlansUseIndexes():
+            MessageLikeCount.for_viewer(1, [msg.id for msg in messages])
+
+    def test_follow_lists(self):
+        with self.assertPlansUseIndexes():
+            User.following_of(5)
+            User.followers_of(5)
+
+    def test_follow_relationships(self):
+        """The following and followers pages load these relationships."""
+
+        user = User.query.get(5)
+
+        with self.assertPlansUseIndexes():
+            self.assertEqual(len(user.following), FOLLOWING)
+            self.assertEqual(len(user.followers), FOLLOWING)
+
+    def test_follow_state(self):
+        users = User.directory().items
+
+        with self.assertPlansUseIndexes():
+            FollowState(self.user).resolve(users)
+
+    def test_cascaded_deletes(self):
+        """Deleting a message or a user (messages_destroy, User.purge,
+        MessageArchive.archive) deletes or checks the rows referencing it,
+        one statement per foreign key, run by the database itself and so
+        missing from the EXPLAIN of the DELETE. These are those statements.
+        """
+
+        foreign_keys = db.session.execute("""
+            SELECT conrelid::regclass::text, attname
+              FROM pg_constraint
+              JOIN pg_attribute ON attrelid = conrelid AND attnum = conkey[1]
+             WHERE contype = 'f' AND confrelid IN ('messages'::regclass, 'users'::regclass)
+        """).fetchall()
+        self.assertIn(('timelines', 'message_id'), foreign_keys)
+
+        self.assertPlansUseIndexesFor(
+            [(f'DELETE FROM ONLY {table} WHERE {column} = %(id)s', {'id': 5})
+             for table, column in foreign_keys])
+
+    def test_page_versions(self):
+        """The ETag lookups that run before every cacheable page."""
+
+        with app.test_request_context(), self.assertPlansUseIndexes():
+            g.user = self.user
+            profile_version(5)
+            following_version(5)
+            followers_version(5)
+            likes_version(5)
@@ -0,0 +1,109 @@
+"""Read replica routing tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_replicas.py
+#
+# They need a second database standing in for a replica:
+#
+#    createdb warbler-test-replica
+
+
+import os
+from unittest import TestCase
+
+from models import db, User
+from replicas import PIN_KEY, replica_binds
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+
+# Now we can import app
+
+from app import app, CURR_USER_KEY
+
+# Create our tables (we do this here, so we only create the tables
+# once for all tests --- in each test, we'll delete the data
+# and create fresh new clean test data
+
+db.create_all()
+
+# Don't have WTForms use CSRF at all, since it's a pain to test
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class ReplicaTestCase(TestCase):
+    """Test routing reads to a replica that has fallen behind."""
+
+    def setUp(self):
+        """The same user on both databases, with a stale bio on the replica."""
+
+        db.drop_all()
+        db.create_all()
+
+        app.config['SQLALCHEMY_BINDS'] = replica_binds(["postgresql:///warbler-test-replica"])
+        app.config['READ_REPLICAS'] = ['replica0']
+
+        self.replica = db.get_engine(app, bind='replica0')
+        db.Model.metadata.drop_all(self.replica)
+        db.Model.metadata.create_all(self.replica)
+
+        for engine, bio in ((db.engine, "fresh bio"), (self.replica, "stale bio")):
+            engine.execute(User.__table__.insert(), id=1, username="user1",
+                           email="user1@test.com", password="HASHED_PASSWORD", bio=bio)
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        db.session.rollback()
+        db.session.remove()
+        app.config['READ_REPLICAS'] = []
+        app.config['SQLALCHEMY_BINDS'] = {}
+
+    def test_reads_use_replica(self):
+        resp = self.client.get("/users/1")
+
+        self.assertIn("stale bio", str(resp.data))
+
+    def test_read_your_writes(self):
+        """After posting, does the user read from the primary until the
+        pin runs out?"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = 1
+
+            resp = c.post("/messages/new", data={"text": "just posted"})
+            self.assertEqual(resp.status_code, 302)
+
+            resp = c.get("/users/1")
+            self.assertIn("fresh bio", str(resp.data))
+            self.assertIn("just posted", str(resp.data))
+
+            with c.session_transaction() as sess:
+                sess[PIN_KEY] = 0
+
+            # (the user's own row now comes from the current user cache)
+            resp = c.get("/users/1")
+            self.assertNotIn("just posted", str(resp.data))
+
+    def test_signup_reads_primary(self):
+        """Is a new account logged in, though the replica hasn't got it?"""
+
+        # past the user made with an explicit id
+        db.session.execute("SELECT setval(pg_get_serial_sequence('users', 'id'), 100)")
+        db.session.commit()
+
+        with self.client as c:
+            resp = c.post("/signup", data={"username": "newbie", "password": "password",
+                                           "email": "newbie@test.com"})
+            self.assertEqual(resp.status_code, 302)
+
+            resp = c.get("/messages/new")
+            self.assertEqual(resp.status_code, 200)
@@ -0,0 +1,186 @@
+"""Timeline model tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_timeline_model.py
+
+
+import os
+from datetime import datetime, timedelta
+from unittest import TestCase
+
+from models import db, User, Message, Follows, TimelineEntry
+from pagination import decode_cursor
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+
+# Now we can import app
+
+from app import app
+
+# Create our tables (we do this here, so we only create the tables
+# once for all tests --- in each test, we'll delete the data
+# and create fresh new clean test data
+
+db.create_all()
+
+
+class TimelineModelTestCase(TestCase):
+    """Test the materialized home timeline."""
+
+    def setUp(self):
+        """Create an author with two followers."""
+
+        db.drop_all()
+        db.create_all()
+
+        self.author = User(id=100, username='author', email='a@test.com',
+                           password='HASHED_PASSWORD')
+        self.reader = User(id=200, username='reader', email='r@test.com',
+                           password='HASHED_PASSWORD')
+        self.other = User(id=300, username='other', email='o@test.com',
+                          password='HASHED_PASSWORD')
+        db.session.add_all([self.author, self.reader, self.other])
+        db.session.commit()
+
+        db.session.add_all([
+            Follows(user_being_followed_id=100, user_following_id=200),
+            Follows(user_being_followed_id=100, user_following_id=300),
+        ])
+        db.session.commit()
+
+        self.max_entries = TimelineEntry.MAX_ENTRIES
+        self.fanout_limit = TimelineEntry.FANOUT_LIMIT
+
+    def tearDown(self):
+        """Clean up fouled transactions and restore limits."""
+
+        TimelineEntry.MAX_ENTRIES = self.max_entries
+        TimelineEntry.FANOUT_LIMIT = self.fanout_limit
+
+        res = super().tearDown()
+        db.session.rollback()
+        return res
+
+    def post(self, user_id, text, minutes_ago=0):
+        msg = Message(text=text, user_id=user_id,
+                      timestamp=datetime.utcnow() - timedelta(minutes=minutes_ago))
+        db.session.add(msg)
+        db.session.flush()
+        TimelineEntry.fan_out(msg)
+        db.session.commit()
+        return msg
+
+    def test_fan_out(self):
+        """Does a new message reach the author and every follower?"""
+
+        msg = self.post(100, 'hello')
+
+        readers = {e.user_id for e in TimelineEntry.query.filter_by(message_id=msg.id)}
+        self.assertEqual(readers, {100, 200, 300})
+        self.assertEqual(TimelineEntry.home_timeline(self.reader).items, [msg])
+
+    def test_timeline_order(self):
+        """Is the home timeline newest first?"""
+
+        old = self.post(100, 'old', minutes_ago=10)
+        new = self.post(100, 'new', minutes_ago=1)
+
+        self.assertEqual(TimelineEntry.home_timeline(self.reader).items, [new, old])
+
+    def test_trim(self):
+        """Are timelines capped at MAX_ENTRIES?"""
+
+        TimelineEntry.MAX_ENTRIES = 2
+
+        self.post(100, 'first', minutes_ago=3)
+        second = self.post(100, 'second', minutes_ago=2)
+        third = self.post(100, 'third', minutes_ago=1)
+
+        self.assertEqual(TimelineEntry.query.filter_by(user_id=200).count(), 2)
+        self.assertEqual(TimelineEntry.home_timeline(self.reader, limit=2).items,
+                         [third, second])
+
+    def test_pages(self):
+        """Does the before cursor page through, past the stored timeline?"""
+
+        TimelineEntry.MAX_ENTRIES = 2
+
+        msgs = [self.post(100, f'msg {i}', minutes_ago=10 - i) for i in range(5)]
+        msgs.reverse()
+
+        first = TimelineEntry.home_timeline(self.reader, limit=2)
+        self.assertEqual(first.items, msgs[:2])
+
+        second = TimelineEntry.home_timeline(
+            self.reader, before=decode_cursor(first.next_cursor), limit=2)
+        self.assertEqual(second.items, msgs[2:4])
+
+        third = TimelineEntry.home_timeline(
+            self.reader, before=decode_cursor(second.next_cursor), limit=2)
+        self.assertEqual(third.items, msgs[4:])
+        self.assertIsNone(third.next_cursor)
+
+    def test_backfill_and_remove(self):
+        """Do follows and unfollows update the follower's timeline?"""
+
+        msg = self.post(200, 'from reader')
+        self.assertEqual(TimelineEntry.home_timeline(self.other).items, [])
+
+        db.session.add(Follows(user_being_followed_id=200, user_following_id=300))
+        TimelineEntry.backfill(300, 200)
+        db.session.commit()
+        self.assertEqual(TimelineEntry.home_timeline(self.other).items, [msg])
+
+        Follows.query.filter_by(user_being_followed_id=200, user_following_id=300).delete()
+        TimelineEntry.remove_author(300, 200)
+        db.session.commit()
+        self.assertEqual(TimelineEntry.home_timeline(self.other).items, [])
+
+    def test_backfill_existing_entries(self):
+        """Is backfilling messages already in the timeline a no-op?"""
+
+        msg = self.post(200, 'from reader')
+        db.session.add(Follows(user_being_followed_id=200, user_following_id=300))
+        TimelineEntry.backfill(300, 200)
+        TimelineEntry.backfill(300, 200)
+        db.session.commit()
+
+        self.assertEqual(TimelineEntry.home_timeline(self.other).items, [msg])
+
+    def test_fanout_on_read(self):
+        """Are big authors merged in at read time instead of fanned out?"""
+
+        TimelineEntry.FANOUT_LIMIT = 1
+        db.session.add(Follows(user_being_followed_id=300, user_following_id=200))
+        TimelineEntry.backfill(200, 300)
+        db.session.commit()
+
+        # author has 2 followers > FANOUT_LIMIT
+        TimelineEntry.backfill(200, 100)
+        db.session.commit()
+        self.assertTrue(User.query.get(100).fanout_on_read)
+
+        msg = self.post(100, 'popular')
+
+        self.assertEqual(TimelineEntry.query.filter_by(message_id=msg.id).count(), 1)
+        self.assertEqual(TimelineEntry.home_timeline(self.reader).items, [msg])
+        self.assertEqual(TimelineEntry.home_timeline(self.author).items, [msg])
+
+    def test_rebuild(self):
+        """Does rebuild recover a timeline for messages that skipped fan-out?"""
+
+        msg = Message(text='bulk loaded', user_id=100)
+        db.session.add(msg)
+        db.session.commit()
+
+        TimelineEntry.rebuild(200)
+        db.session.commit()
+
+        self.assertEqual(TimelineEntry.home_timeline(self.reader).items, [msg])
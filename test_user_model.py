@@ -10,7 +10,8 @@ from unittest import TestCase
 #  we need to import exception otherwise we cannot use "with self.assertRaise(exc.IntegrityError) as context"
 from sqlalchemy import exc
 
-from models import db, User, Message, Follows, Likes
+from models import db, hasher, User, Message, Follows, Likes, FollowState
+from hashing import HasherBusy
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
@@ -177,6 +178,73 @@ class UserModelTestCase(TestCase):
         # this is testing user is not followed by
         self.assertFalse(self.user2.is_followed_by(self.user1))
 
+    def test_follow_state(self):
+        """Does FollowState answer for a batch of users?"""
+
+        self.user1.following.append(self.user2)
+        db.session.commit()
+
+        state = FollowState(self.user1)
+        state.resolve([self.user1, self.user2])
+
+        self.assertEqual(state.resolved, {self.uid1, self.uid2})
+        self.assertTrue(state.is_following(self.user2))
+        self.assertFalse(state.is_following(self.user1))
+        self.assertFalse(FollowState(self.user2).is_following(self.user1))
+
+    def test_directory(self):
+        """Does the directory page through users in id order?"""
+
+        first = User.directory(limit=1)
+        self.assertEqual([u.username for u in first.items], ['test1'])
+        self.assertEqual(first.next_cursor, str(self.uid1))
+
+        second = User.directory(after=int(first.next_cursor), limit=1)
+        self.assertEqual([u.username for u in second.items], ['test2'])
+
+        last = User.directory(after=self.uid2, limit=1)
+        self.assertEqual(last.items, [])
+        self.assertIsNone(last.next_cursor)
+
+    def test_counters(self):
+        """Do the counters follow follows, likes and messages?"""
+
+        msg = Message(text='counted', user_id=self.uid2)
+        db.session.add(msg)
+        self.user1.following.append(self.user2)
+        db.session.commit()
+
+        self.user1.likes.append(msg)
+        db.session.commit()
+
+        self.assertEqual(self.user1.following_count, 1)
+        self.assertEqual(self.user1.likes_count, 1)
+        self.assertEqual(self.user2.followers_count, 1)
+        self.assertEqual(self.user2.messages_count, 1)
+
+        # deleting the message cascades to the like as well
+        db.session.delete(msg)
+        db.session.commit()
+
+        self.assertEqual(self.user1.likes_count, 0)
+        self.assertEqual(self.user2.messages_count, 0)
+
+    def test_reconcile_counters(self):
+        """Does reconcile_counters repair counters that drifted?"""
+
+        self.user1.following.append(self.user2)
+        db.session.commit()
+
+        User.query.update({User.following_count: 42, User.followers_count: 42})
+        db.session.commit()
+
+        User.reconcile_counters()
+        db.session.commit()
+
+        self.assertEqual(self.user1.following_count, 1)
+        self.assertEqual(self.user1.followers_count, 0)
+        self.assertEqual(self.user2.followers_count, 1)
+
     # def test_is_not_followed_by(self):
     #     """Does is_following successfully detect when user1 not is followed user2?"""
     #     user1 = User(
@@ -255,6 +323,33 @@ class UserModelTestCase(TestCase):
         self.assertEqual(u.id, self.uid1)
      
     
+    def test_authenticate_rehash(self):
+        """Is a hash made at another cost replaced at the next login?"""
+
+        rounds = hasher.rounds
+        hasher.rounds = 4
+        try:
+            u = User.authenticate(self.user1.username, "password")
+            db.session.commit()
+        finally:
+            hasher.rounds = rounds
+
+        self.assertTrue(u.password.startswith("$2b$04$"))
+        self.assertTrue(User.authenticate(self.user1.username, "password"))
+
+    def test_hasher_busy(self):
+        """Does the hasher refuse work past its pending limit?"""
+
+        max_pending = app.config['HASH_MAX_PENDING']
+        for _ in range(max_pending):
+            hasher.pending.acquire()
+        try:
+            with self.assertRaises(HasherBusy):
+                User.authenticate(self.user1.username, "password")
+        finally:
+            for _ in range(max_pending):
+                hasher.pending.release()
+
     def test_authenticate_invalid_username(self):
         """Does User.authenticate fail to return a user when the username is invalid?"""
     
@@ -6,9 +6,10 @@
 
 
 import os
+from datetime import datetime
 from unittest import TestCase
 
-from models import db, connect_db, User, Message, Follows, Likes
+from models import db, connect_db, User, Message, Follows, Likes, TimelineEntry
 from bs4 import BeautifulSoup
 
 # BEFORE we import our app, let's set an environmental variable
@@ -22,6 +23,7 @@ os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
 # Now we can import app
 
 from app import app, CURR_USER_KEY
+from admission import buckets
 
 # Create our tables (we do this here, so we only create the tables
 # once for all tests --- in each test, we'll delete the data
@@ -89,6 +91,15 @@ class UserViewFunctionTestCase(TestCase):
         self.assertIn('@hij', str(response.data))
         self.assertIn('@testing', str(response.data))
 
+    def test_users_index_after(self):
+        """Does the directory start after the 'after' id?"""
+        with self.client as c:
+            response = c.get(f'/users?after={self.u2_id}')
+
+        self.assertIn('@testuser', str(response.data))
+        self.assertNotIn('@abc', str(response.data))
+        self.assertNotIn('@efg', str(response.data))
+
     def test_users_search(self):
         """Does Search function work correctly?"""
         with self.client as c:
@@ -100,6 +111,46 @@ class UserViewFunctionTestCase(TestCase):
         self.assertNotIn('@efg', str(response.data))
         self.assertNotIn('@hij', str(response.data))
 
+    def test_users_search_ranking(self):
+        """Are exact and prefix username matches ranked first, case-insensitively?"""
+
+        self.u3.bio = "not a testing account"
+        db.session.commit()
+
+        with self.client as c:
+            response = c.get('/users?q=TESTING')
+
+        soup = BeautifulSoup(response.data, 'html.parser')
+        usernames = [p.text for p in soup.select('.card-link p')]
+        self.assertEqual(usernames, ['@testing', '@hij'])
+
+    def test_users_autocomplete(self):
+        """Does autocomplete return usernames with the prefix?"""
+
+        with self.client as c:
+            response = c.get('/users/autocomplete?q=Te')
+
+        self.assertEqual([u['username'] for u in response.json],
+                         ['testing', 'testuser'])
+
+    def test_deleted_users_hidden(self):
+        """Do deleted accounts drop out of the directory, search and
+        autocomplete straight away, before they are purged?"""
+
+        self.u4.deleted_at = datetime.utcnow()
+        db.session.commit()
+
+        with self.client as c:
+            directory = str(c.get('/users').data)
+            search = str(c.get('/users?q=test').data)
+            autocomplete = c.get('/users/autocomplete?q=te').json
+
+        self.assertIn('@testuser', directory)
+        self.assertNotIn('@testing', directory)
+        self.assertIn('@testuser', search)
+        self.assertNotIn('@testing', search)
+        self.assertEqual([u['username'] for u in autocomplete], ['testuser'])
+
     def test_user_show(self):
         """does each user's page show?"""
         with self.client as c:
@@ -108,6 +159,119 @@ class UserViewFunctionTestCase(TestCase):
             self.assertEqual(response.status_code, 200)
             self.assertIn('@testuser', str(response.data))
 
+    def test_profile_update_visible(self):
+        """Is a profile edit visible on the very next request?"""
+
+        with self.client as c:
+            c.post('/login', data={'username': 'testuser', 'password': 'testuser'})
+            c.get('/messages/new')
+
+            c.post('/users/profile', data={'username': 'renamed',
+                                           'email': 'test@test.com',
+                                           'password': 'testuser'})
+            response = c.get('/messages/new')
+
+        self.assertIn('alt="renamed"', str(response.data))
+
+    def test_login_admission_control(self):
+        """Are repeated logins for one username turned away with a 429,
+        while other usernames and addresses still get through?"""
+
+        buckets.clear()
+        burst = app.config['ADMISSION_USERNAME_BURST']
+
+        for _ in range(burst):
+            response = self.client.post('/login', data={'username': 'abc', 'password': 'wrong'})
+            self.assertEqual(response.status_code, 200)
+
+        response = self.client.post('/login', data={'username': 'ABC', 'password': 'wrong'})
+        self.assertEqual(response.status_code, 429)
+        self.assertTrue(int(response.headers['Retry-After']) > 0)
+
+        response = self.client.post('/login', data={'username': 'efg', 'password': 'password'})
+        self.assertEqual(response.status_code, 302)
+
+        for _ in range(app.config['ADMISSION_IP_BURST']):
+            self.client.post('/login', data={'username': 'nobody', 'password': 'wrong'})
+        response = self.client.post('/login', data={'username': 'efg', 'password': 'password'})
+        self.assertEqual(response.status_code, 429)
+
+        response = self.client.post('/login', data={'username': 'efg', 'password': 'password'},
+                                    environ_base={'REMOTE_ADDR': '192.0.2.1'})
+        self.assertEqual(response.status_code, 302)
+
+        buckets.clear()
+
+    def test_login_flood_spares_profile(self):
+        """Can a user still edit their profile while logins for their
+        username are being turned away?"""
+
+        buckets.clear()
+
+        with self.client as c:
+            c.post('/login', data={'username': 'abc', 'password': 'password'})
+
+            for _ in range(app.config['ADMISSION_USERNAME_BURST'] + 1):
+                response = self.client.post('/login',
+                                            data={'username': 'abc', 'password': 'wrong'},
+                                            environ_base={'REMOTE_ADDR': '192.0.2.1'})
+            self.assertEqual(response.status_code, 429)
+
+            response = c.post('/users/profile', data={'username': 'abc',
+                                                      'email': 'test1@test.com',
+                                                      'password': 'password',
+                                                      'bio': 'still here'})
+            self.assertEqual(response.status_code, 302)
+
+        self.assertEqual(User.query.get(self.u1_id).bio, 'still here')
+        buckets.clear()
+
+    def test_user_show_not_modified(self):
+        """Does a profile revalidate with 304 until the user changes?"""
+
+        with self.client as c:
+            response = c.get(f'/users/{self.u1_id}')
+            etag = response.headers['ETag']
+
+            response = c.get(f'/users/{self.u1_id}', headers={'If-None-Match': etag})
+            self.assertEqual(response.status_code, 304)
+            self.assertEqual(response.data, b'')
+
+            db.session.add(Message(text="new warble", user_id=self.u1_id))
+            db.session.commit()
+
+            response = c.get(f'/users/{self.u1_id}', headers={'If-None-Match': etag})
+            self.assertEqual(response.status_code, 200)
+            self.assertIn('new warble', str(response.data))
+
+    def test_following_etag_follows_viewer(self):
+        """Does following someone change the viewer's follow list ETag?"""
+
+        with self.client as c:
+            c.post('/login', data={'username': 'testuser', 'password': 'testuser'})
+            c.get('/')
+
+            etag = c.get(f'/users/{self.testuser_id}/following').headers['ETag']
+            c.post(f'/users/follow/{self.u1_id}')
+            response = c.get(f'/users/{self.testuser_id}/following',
+                             headers={'If-None-Match': etag})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('@abc', str(response.data))
+
+    def test_follow_self(self):
+        """Is following yourself refused, rather than an error?"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            response = c.post(f'/users/follow/{self.testuser_id}', follow_redirects=True)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("You can&#39;t follow yourself", str(response.data))
+        self.assertEqual(Follows.query.count(), 0)
+
     def setup_likes(self):
         """this function is not a test itself. It is used in the next test to set up to test likes. Notice that this function does not start with "test_" """
 
@@ -146,6 +310,27 @@ class UserViewFunctionTestCase(TestCase):
             self.assertIn('0', found[2].text)
             self.assertIn('1', found[3].text)
 
+    def test_likes_etag_follows_like_counts(self):
+        """Does someone else's like on a listed message change the likes
+        page's ETag?"""
+
+        self.setup_likes()
+
+        with self.client as c:
+            c.post('/login', data={'username': 'testuser', 'password': 'testuser'})
+            c.get('/')
+
+            url = f'/users/{self.testuser_id}/likes'
+            etag = c.get(url).headers['ETag']
+            self.assertEqual(c.get(url, headers={'If-None-Match': etag}).status_code, 304)
+
+            db.session.add(Likes(user_id=self.u2_id, message_id=9876))
+            db.session.commit()
+
+            response = c.get(url, headers={'If-None-Match': etag})
+            self.assertEqual(response.status_code, 200)
+            self.assertNotIn('Last-Modified', response.headers)
+
     def test_add_likes(self):
 
         m = Message(id=1984, text="hello test", user_id=self.u1_id)
@@ -193,7 +378,26 @@ class UserViewFunctionTestCase(TestCase):
             likes = Likes.query.filter(Likes.message_id == m.id).all()
 
             self.assertEqual(len(likes), 0)
-    
+
+    def test_like_json(self):
+        """Does the JSON endpoint toggle a like and report the count?"""
+
+        self.setup_likes()
+        db.session.add(Likes(user_id=self.u2_id, message_id=9876))
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            unliked = c.post('/messages/9876/like').json
+            liked = c.post('/messages/9876/like').json
+            missing = c.post('/messages/123456/like')
+
+        self.assertEqual(unliked, {'message_id': 9876, 'liked': False, 'likes': 1})
+        self.assertEqual(liked, {'message_id': 9876, 'liked': True, 'likes': 2})
+        self.assertEqual(missing.status_code, 404)
+
     def test_unauthenticated_likes(self):
         self.setup_likes()
 
@@ -286,6 +490,72 @@ class UserViewFunctionTestCase(TestCase):
         self.assertNotIn('@testing', str(response.data))
         self.assertNotIn('@hij', str(response.data))
 
+    def test_follow_lists_hide_deleted_users(self):
+        """Are deleted accounts left off follow lists, and their own lists
+        gone?"""
+
+        self.setup_followers()
+        User.query.get(self.u2_id).deleted_at = datetime.utcnow()
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            following = c.get(f'/users/{self.testuser_id}/following')
+            self.assertIn('@abc', str(following.data))
+            self.assertNotIn('@efg', str(following.data))
+
+            self.assertEqual(c.get(f'/users/{self.u2_id}/following').status_code, 404)
+            self.assertEqual(c.get(f'/users/{self.u2_id}/followers').status_code, 404)
+
+    def test_deleted_users_content_gone(self):
+        """Are a deleted account's messages and likes gone, and its messages
+        left out of other users' likes and home timelines?"""
+
+        self.setup_followers()
+        msg = Message(text='from efg', user_id=self.u2_id)
+        db.session.add(msg)
+        db.session.flush()
+        TimelineEntry.fan_out(msg)
+        msg_id = msg.id
+        db.session.add(Likes(user_id=self.testuser_id, message_id=msg_id))
+        db.session.add(Likes(user_id=self.u2_id, message_id=msg_id))
+        db.session.commit()
+
+        User.query.get(self.u2_id).deleted_at = datetime.utcnow()
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            for path in [f'/messages/{msg_id}',
+                         f'/users/{self.u2_id}/likes',
+                         f'/messages/older?feed=user&user_id={self.u2_id}',
+                         f'/messages/older?feed=likes&user_id={self.u2_id}']:
+                self.assertEqual(c.get(path).status_code, 404, path)
+
+            self.assertNotIn('from efg', str(c.get(f'/users/{self.testuser_id}/likes').data))
+            self.assertNotIn('from efg', str(c.get('/').data))
+
+    def test_users_index_follow_buttons(self):
+        """Do user cards show Unfollow only for users we follow?"""
+
+        self.setup_followers()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            response = c.get('/users')
+
+        soup = BeautifulSoup(response.data, 'html.parser')
+        unfollow = soup.find_all('form', {'action': lambda a: a and 'stop-following' in a})
+        self.assertEqual({f['action'] for f in unfollow},
+                         {f'/users/stop-following/{self.u1_id}',
+                          f'/users/stop-following/{self.u2_id}'})
+
     def test_unauthorized_following_page_access(self):
         self.setup_followers()
 
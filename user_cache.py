@@ -0,0 +1,114 @@
+"""Per-process cache of logged-in users, for `add_user_to_g`.
+
+Every request needs the logged-in user, and nearly every request would
+otherwise start with the same primary-key SELECT. Instead, each process
+keeps the column values of recently seen users in a small LRU and rebuilds
+`g.user` from them without touching the database.
+
+Entries are stamped with a version token that lives in the user's session.
+Anything that changes the user's row (profile edits, posting, following,
+liking, ...) calls `user_changed`, which issues a new token and drops the
+local entry, so the next request, in this process or any other, misses and
+reloads. Changes made by
+*other* users (e.g. a new follower bumping `followers_count`) are picked
+up when the entry expires after `ttl` seconds.
+"""
+
+import secrets
+import time
+from collections import OrderedDict
+from threading import Lock
+
+from flask import current_app, g, session
+from sqlalchemy import inspect
+from sqlalchemy.orm import make_transient_to_detached
+
+from replicas import pin_to_primary
+
+# where the logged-in user's version token lives in their session
+CURR_USER_VERSION_KEY = "curr_user_version"
+
+
+def new_version():
+    """A fresh version token for a user's session."""
+
+    return secrets.token_hex(4)
+
+
+def user_changed(*user_ids):
+    """Stop serving cached copies of users whose rows just changed.
+
+    The logged-in user gets a new version in their session, so every
+    process reloads them, and reads from the primary for a while so they
+    see their change; `user_ids` are dropped from this process's cache.
+    """
+
+    cache = current_app.extensions['user_cache']
+    cache.invalidate(g.user.id)
+    session[CURR_USER_VERSION_KEY] = new_version()
+    pin_to_primary()
+
+    for user_id in user_ids:
+        cache.invalidate(user_id)
+
+
+class CurrentUserCache:
+    """LRU of `{user_id: (version, expires, column values)}`."""
+
+    def __init__(self, model, max_size=1024, ttl=30):
+        self.model = model
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+        # only plain columns; deferred ones stay unloaded as usual
+        self.columns = [attr.key for attr in inspect(model).column_attrs
+                        if not attr.deferred]
+
+    def init_app(self, app):
+        app.config.setdefault('CURRENT_USER_CACHE_SIZE', self.max_size)
+        app.config.setdefault('CURRENT_USER_CACHE_TTL', self.ttl)
+        self.max_size = app.config['CURRENT_USER_CACHE_SIZE']
+        self.ttl = app.config['CURRENT_USER_CACHE_TTL']
+        app.extensions['user_cache'] = self
+
+    def get(self, session, user_id, version):
+        """Return the user attached to `session`, or None on a miss."""
+
+        with self.lock:
+            entry = self.entries.get(user_id)
+            if (entry is None or entry[0] != version
+                    or entry[1] < time.monotonic()):
+                self.misses += 1
+                return None
+
+            self.entries.move_to_end(user_id)
+            self.hits += 1
+            values = entry[2]
+
+        # rebuild the user as if it had just been loaded: persistent, with
+        # these column values, and relationships lazy-loading as usual
+        user = self.model(**values)
+        make_transient_to_detached(user)
+        return session.merge(user, load=False)
+
+    def put(self, user, version):
+        """Remember `user`'s column values under `version`."""
+
+        if not self.max_size:
+            return
+
+        values = {key: getattr(user, key) for key in self.columns}
+
+        with self.lock:
+            self.entries[user.id] = (version, time.monotonic() + self.ttl, values)
+            self.entries.move_to_end(user.id)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, user_id):
+        with self.lock:
+            self.entries.pop(user_id, None)
@@ -0,0 +1,97 @@
+"""Background job worker; see `Job` in models.py.
+
+    python worker.py            # run jobs until stopped
+    python worker.py --once     # run everything that's due, then exit
+
+Run as many as needed; they share the queue without running a job twice
+at the same time.
+"""
+
+import argparse
+import logging
+import time
+import traceback
+
+from app import db
+from models import User, Message, MessageLikeCount, TimelineEntry, Job
+
+logger = logging.getLogger('warbler.jobs')
+
+
+def purge_user(user_id):
+    """One batch of a deleted account's rows; queued again until done."""
+
+    return User.purge(user_id)
+
+
+def fan_out(message_id):
+    """Put a new message in its author's followers' timelines."""
+
+    message = Message.query.get(message_id)
+    if message:
+        TimelineEntry.fan_out(message)
+
+
+def reconcile_counters(user_ids):
+    User.reconcile_counters(user_ids)
+
+
+def reconcile_like_counts(message_ids):
+    MessageLikeCount.reconcile(message_ids)
+
+
+HANDLERS = {
+    'purge_user': purge_user,
+    'fan_out': fan_out,
+    'reconcile_counters': reconcile_counters,
+    'reconcile_like_counts': reconcile_like_counts,
+}
+
+
+def run(job):
+    """Run one claimed job in its own transaction."""
+
+    try:
+        done = HANDLERS[job.kind](**job.payload)
+    except Exception:
+        db.session.rollback()
+        logger.exception('job %s (%s) failed, attempt %s', job.id, job.kind, job.attempts)
+        Job.fail(job, traceback.format_exc())
+    else:
+        # a handler returning False has more to do in another transaction
+        if done is False:
+            Job.again(job.id)
+        else:
+            Job.finish(job.id)
+
+    db.session.commit()
+
+
+def work(once=False, batch_size=10, poll_seconds=1.0):
+    """Claim and run jobs; with `once`, stop when none are due."""
+
+    while True:
+        jobs = Job.claim(batch_size)
+        db.session.commit()
+
+        for job in jobs:
+            run(job)
+
+        if not jobs:
+            if once:
+                return
+            time.sleep(poll_seconds)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--once', action='store_true',
+                        help='run every due job, then exit')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    work(once=args.once)
+
+
+if __name__ == '__main__':
+    main()